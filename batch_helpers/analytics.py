@@ -0,0 +1,143 @@
+"""Queue wait, runtime and throughput of Batch jobs, from the timestamps Batch reports.
+
+pandas is only imported when a report is made.
+"""
+from batch_helpers.tables import format_table
+
+# Timestamps (in milliseconds) reported by DescribeJobs and ListJobs
+TIMESTAMP_FIELDS = ["createdAt", "startedAt", "stoppedAt"]
+
+
+def job_times(job_details):
+    """The timestamps and number of attempts of a job, as returned by DescribeJobs or ListJobs."""
+    times = {
+        k: job_details[k]
+        for k in TIMESTAMP_FIELDS
+        if job_details.get(k) is not None
+    }
+    # Only DescribeJobs lists the attempts
+    if "attempts" in job_details:
+        times["attempts"] = len(job_details["attempts"])
+    return times
+
+
+def jobs_frame(jobs):
+    """One row per Batch job, with its queue wait and runtime in seconds.
+
+    `jobs` is a list of dicts with the jobId, job_definition, queue, status,
+    timestamps and attempts of each job, and optionally `depends_on` (a list
+    of job IDs). Jobs packed together (which share a jobId) are counted once.
+    A job is ready to run once it has been created and the jobs it depends
+    on have stopped, and its queue wait is measured from then until it starts.
+    """
+    import pandas as pd
+
+    df = pd.DataFrame(
+        jobs,
+        columns=["jobId", "job_definition", "queue", "status", "attempts", "depends_on"] + TIMESTAMP_FIELDS
+    )
+    df = df.loc[df["jobId"].notnull()].drop_duplicates(subset="jobId")
+    for k in TIMESTAMP_FIELDS:
+        df[k] = pd.to_numeric(df[k], errors="coerce") / 1000.
+
+    # When the last dependency of each job stopped
+    deps = df[["jobId", "depends_on"]].explode("depends_on").dropna()
+    deps = deps.merge(
+        df[["jobId", "stoppedAt"]].rename(columns={"jobId": "depends_on", "stoppedAt": "dependency_stoppedAt"}),
+        on="depends_on",
+        how="inner"
+    )
+    df = df.merge(
+        deps.groupby("jobId")["dependency_stoppedAt"].max().reset_index(),
+        on="jobId",
+        how="left"
+    )
+
+    df["ready_at"] = df[["createdAt", "dependency_stoppedAt"]].max(axis=1)
+    df["wait_seconds"] = (df["startedAt"] - df["ready_at"]).clip(lower=0)
+    df["runtime_seconds"] = df["stoppedAt"] - df["startedAt"]
+    return df.drop(columns=["depends_on", "dependency_stoppedAt"]).set_index("jobId")
+
+
+def timing_summary(df, by="job_definition"):
+    """p50/p95 queue wait and runtime, attempts and throughput for each group of jobs."""
+    import pandas as pd
+
+    grouped = df.groupby(by)
+    summary = pd.DataFrame({
+        "jobs": grouped.size(),
+        "finished": grouped["stoppedAt"].count(),
+        "wait_p50": grouped["wait_seconds"].quantile(0.5),
+        "wait_p95": grouped["wait_seconds"].quantile(0.95),
+        "runtime_p50": grouped["runtime_seconds"].quantile(0.5),
+        "runtime_p95": grouped["runtime_seconds"].quantile(0.95),
+        "attempts_mean": grouped["attempts"].mean(),
+        "attempts_max": grouped["attempts"].max(),
+    })
+
+    # Jobs finished per hour, between the first start and the last stop
+    span_hours = (grouped["stoppedAt"].max() - grouped["startedAt"].min()) / 3600.
+    summary["per_hour"] = summary["finished"] / span_hours.where(span_hours > 0)
+    return summary
+
+
+def throughput(df, by="job_definition", freq="1h"):
+    """Number of jobs stopping in each interval of time (rows), for each group (columns)."""
+    import pandas as pd
+
+    finished = df.loc[df["stoppedAt"].notnull()]
+    if finished.shape[0] == 0:
+        return pd.DataFrame()
+    return finished.assign(
+        stopped=pd.to_datetime(finished["stoppedAt"], unit="s").dt.floor(freq)
+    ).pivot_table(
+        index="stopped",
+        columns=by,
+        values="status",
+        aggfunc="count",
+        fill_value=0
+    )
+
+
+def timing_report(jobs, freq="1h", max_intervals=24):
+    """Text report of queue wait, runtime and throughput by job definition and by queue."""
+    df = jobs_frame(jobs)
+    n_missing = int(df["startedAt"].isnull().sum())
+
+    sections = []
+    for by, label in [("job_definition", "Job definition"), ("queue", "Queue")]:
+        summary = timing_summary(df, by=by)
+        # Rows are taken column by column, so that the counts stay integers
+        sections.append("By {} (seconds):\n".format(label.lower()) + format_table(
+            [
+                [name] + [_round(v) for v in row]
+                for name, row in zip(summary.index, summary.itertuples(index=False))
+            ],
+            [label] + list(summary.columns),
+            align_right=True
+        ))
+
+        over_time = throughput(df, by=by, freq=freq).tail(max_intervals)
+        if over_time.shape[0] > 0:
+            sections.append("Jobs finished per {} by {}:\n".format(freq, label.lower()) + format_table(
+                [
+                    [str(t)] + row
+                    for t, row in zip(over_time.index, over_time.values.tolist())
+                ],
+                ["Interval"] + [str(c) for c in over_time.columns]
+            ))
+
+    if n_missing > 0:
+        sections.append("{:,} of {:,} jobs have not started (or have no timestamps)".format(
+            n_missing, df.shape[0]
+        ))
+    return "\n\n".join(sections)
+
+
+def _round(v):
+    """Round a value for printing, leaving gaps blank."""
+    if v != v:
+        return ""
+    if isinstance(v, float):
+        return round(v, 1)
+    return v
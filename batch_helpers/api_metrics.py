@@ -0,0 +1,211 @@
+"""Count and time every AWS API call made through the shared clients."""
+import os
+import json
+import time
+import threading
+from collections import defaultdict
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# Error codes returned by AWS when a request is throttled
+THROTTLE_CODES = set([
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestThrottled",
+    "RequestThrottledException",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+    "SlowDown",
+])
+
+
+def bucket_percentile(counts, q):
+    """Upper bound of the latency bucket holding the q-th percentile of these counts (None if unbounded)."""
+    target = q * sum(counts)
+    total = 0
+    for ix, n in enumerate(counts):
+        total += n
+        if n > 0 and total >= target:
+            return LATENCY_BUCKETS[ix] if ix < len(LATENCY_BUCKETS) else None
+    return None
+
+
+class ApiMetrics:
+    """Calls, errors, retries, throttles and latencies by (service, operation).
+
+    attach(service, client) registers botocore event handlers which record
+    each call, and is run for every client made by batch_helpers.aws.get_client.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget all of the calls recorded so far."""
+        with self.lock:
+            self.calls = defaultdict(int)
+            self.errors = defaultdict(int)
+            self.retries = defaultdict(int)
+            self.throttles = defaultdict(int)
+            self.latency_sum = defaultdict(float)
+            self.latency_buckets = defaultdict(lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+
+    def attach(self, service, client):
+        """Record every call made by a client."""
+        events = client.meta.events
+        events.register("before-parameter-build", self.call_started)
+        events.register("needs-retry", self.attempt_finished)
+        events.register("after-call", self.call_finished)
+        events.register("after-call-error", self.call_failed)
+
+    def call_started(self, model, context, **kwargs):
+        context["api_metrics_operation"] = (model.service_model.service_name, model.name)
+        context["api_metrics_start"] = time.perf_counter()
+
+    def attempt_finished(self, request_dict, attempts, operation, response=None, **kwargs):
+        """Called after every attempt, before botocore decides whether to retry."""
+        context = request_dict.get("context", {})
+        context["api_metrics_attempts"] = attempts
+
+        if response is not None:
+            status = response[0].status_code
+            code = response[1].get("Error", {}).get("Code")
+            if status == 429 or code in THROTTLE_CODES:
+                key = (operation.service_model.service_name, operation.name)
+                with self.lock:
+                    self.throttles[key] += 1
+
+    def call_finished(self, http_response, parsed, model, context, **kwargs):
+        self.record(
+            model.service_model.service_name,
+            model.name,
+            context,
+            http_response.status_code >= 300
+        )
+
+    def call_failed(self, context, **kwargs):
+        # Errors raised while sending (e.g. connection errors) are not
+        # passed with the operation model
+        if "api_metrics_operation" in context:
+            self.record(*context["api_metrics_operation"], context, True)
+
+    def record(self, service, operation, context, error):
+        """Add a single finished call (including any retries)."""
+        if "api_metrics_start" not in context:
+            return
+        elapsed = time.perf_counter() - context.pop("api_metrics_start")
+        n_retries = max(0, context.pop("api_metrics_attempts", 1) - 1)
+
+        # Index of the first bucket which the latency fits in
+        bucket = len(LATENCY_BUCKETS)
+        for ix, upper in enumerate(LATENCY_BUCKETS):
+            if elapsed <= upper:
+                bucket = ix
+                break
+
+        key = (service, operation)
+        with self.lock:
+            self.calls[key] += 1
+            if error:
+                self.errors[key] += 1
+            self.retries[key] += n_retries
+            self.latency_sum[key] += elapsed
+            self.latency_buckets[key][bucket] += 1
+
+    def percentile(self, key, q):
+        """Upper bound of the bucket holding the q-th percentile of latency (None if unbounded)."""
+        with self.lock:
+            counts = list(self.latency_buckets.get(key, []))
+        return bucket_percentile(counts, q)
+
+    def to_dict(self):
+        """All of the metrics, keyed by "service.operation"."""
+        with self.lock:
+            return {
+                "{}.{}".format(*key): {
+                    "calls": n,
+                    "errors": self.errors[key],
+                    "retries": self.retries[key],
+                    "throttles": self.throttles[key],
+                    "latency_seconds_sum": round(self.latency_sum[key], 6),
+                    "latency_buckets": dict(zip(
+                        [str(b) for b in LATENCY_BUCKETS] + ["+Inf"],
+                        self.latency_buckets[key]
+                    )),
+                }
+                for key, n in sorted(self.calls.items())
+            }
+
+    def summary(self):
+        """One line per operation, e.g. for logging."""
+        # Copy the metrics, as other threads may be adding calls
+        with self.lock:
+            rows = [
+                (key, n, self.latency_sum[key], list(self.latency_buckets[key]),
+                 self.retries[key], self.throttles[key], self.errors[key])
+                for key, n in sorted(self.calls.items())
+            ]
+        lines = []
+        for key, n, latency_sum, buckets, n_retries, n_throttles, n_errors in rows:
+            p95 = bucket_percentile(buckets, 0.95)
+            lines.append(
+                "{}.{}: {:,} calls, mean {:.0f} ms, p95 {} ms, {:,} retries, {:,} throttled, {:,} errors".format(
+                    key[0], key[1], n,
+                    1000 * latency_sum / n,
+                    "<= {:,.0f}".format(1000 * p95) if p95 is not None else "> {:,.0f}".format(1000 * LATENCY_BUCKETS[-1]),
+                    n_retries, n_throttles, n_errors
+                )
+            )
+        return "\n".join(lines)
+
+    def to_prometheus(self):
+        """The metrics in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            counters = [
+                ("calls", "AWS API calls", self.calls),
+                ("errors", "AWS API calls which failed", self.errors),
+                ("retries", "Retried AWS API requests", self.retries),
+                ("throttles", "Throttled AWS API requests", self.throttles),
+            ]
+            keys = sorted(self.calls.keys())
+            for name, description, values in counters:
+                lines.append("# HELP batch_helpers_aws_api_{}_total {}".format(name, description))
+                lines.append("# TYPE batch_helpers_aws_api_{}_total counter".format(name))
+                for key in keys:
+                    lines.append('batch_helpers_aws_api_{}_total{{service="{}",operation="{}"}} {}'.format(
+                        name, key[0], key[1], values[key]
+                    ))
+
+            name = "batch_helpers_aws_api_latency_seconds"
+            lines.append("# HELP {} Latency of AWS API calls, including retries".format(name))
+            lines.append("# TYPE {} histogram".format(name))
+            for key in keys:
+                labels = 'service="{}",operation="{}"'.format(*key)
+                total = 0
+                for upper, n in zip(LATENCY_BUCKETS + ["+Inf"], self.latency_buckets[key]):
+                    total += n
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, upper, total))
+                lines.append("{}_sum{{{}}} {}".format(name, labels, self.latency_sum[key]))
+                lines.append("{}_count{{{}}} {}".format(name, labels, self.calls[key]))
+        return "\n".join(lines) + "\n"
+
+    def export(self, fp):
+        """Write the metrics to a Prometheus textfile (.prom) or otherwise to JSON."""
+        if fp.endswith(".prom"):
+            text = self.to_prometheus()
+        else:
+            text = json.dumps(self.to_dict(), indent=4)
+
+        # Replace the file in one step, so that collectors never read a partial file
+        tmp_fp = fp + ".tmp"
+        with open(tmp_fp, "wt") as fo:
+            fo.write(text)
+        os.replace(tmp_fp, fp)
+
+
+# Metrics for all of the clients in this process
+api_metrics = ApiMetrics()
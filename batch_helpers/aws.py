@@ -0,0 +1,85 @@
+"""Shared, pooled connections to AWS, reused across the whole process."""
+import threading
+from batch_helpers.api_metrics import api_metrics
+
+# Connection settings used for every client
+MAX_POOL_CONNECTIONS = 50
+MAX_ATTEMPTS = 10
+
+_clients = {}
+_session = None
+_lock = threading.Lock()
+
+# Functions called with (service, client) for every client that is created,
+# starting with the one recording the calls made by each client
+_client_hooks = [api_metrics.attach]
+
+
+def client_config():
+    """Connection pool, keep-alive and retry settings for all clients."""
+    from botocore.config import Config
+    return Config(
+        max_pool_connections=MAX_POOL_CONNECTIONS,
+        tcp_keepalive=True,
+        retries={
+            "max_attempts": MAX_ATTEMPTS,
+            "mode": "adaptive",
+        },
+    )
+
+
+def get_client(service, **kwargs):
+    """Get the client for an AWS service, creating it only the first time."""
+    key = (service, tuple(sorted(kwargs.items())))
+
+    # Clients are thread-safe once they exist, so only creation is locked
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            if key not in _clients:
+                client = _get_session().client(
+                    service,
+                    config=client_config(),
+                    **kwargs
+                )
+                for hook in _client_hooks:
+                    hook(service, client)
+                _clients[key] = client
+            client = _clients[key]
+    return client
+
+
+def add_client_hook(hook):
+    """Call hook(service, client) for every shared client, now and in the future.
+
+    This can be used to register botocore event handlers on all of the
+    clients used by this package.
+    """
+    with _lock:
+        _client_hooks.append(hook)
+        for (service, _), client in _clients.items():
+            hook(service, client)
+
+
+def remove_client_hook(hook):
+    """Stop calling a hook for new clients."""
+    with _lock:
+        _client_hooks.remove(hook)
+
+
+def reset_clients():
+    """Drop all of the shared clients (e.g. after forking a new process)."""
+    global _session
+    with _lock:
+        _clients.clear()
+        _session = None
+
+
+def _get_session():
+    """Sessions are not thread-safe, so a single one is only used under the lock."""
+    global _session
+    if _session is None:
+        # boto3 is slow to import, so only load it once a client is needed
+        import boto3
+        _session = boto3.session.Session()
+    return _session
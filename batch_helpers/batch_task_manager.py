@@ -1,12 +1,17 @@
 """Python object managing task submission in AWS Batch."""
 import json
 import time
-import boto3
 import json
 import logging
-import pandas as pd
-from tabulate import tabulate
 from collections import defaultdict
+from batch_helpers.analytics import job_times, timing_report
+from batch_helpers.aws import get_client
+from batch_helpers.api_metrics import api_metrics
+from batch_helpers.cache import FolderCache
+from batch_helpers.events import EventConsumer, job_status_moved_on, wait_for_events
+from batch_helpers.existence_store import open_existence_store
+from batch_helpers.routing import QueueRouter, queue_list
+from batch_helpers.tables import count_table
 
 
 class BatchTaskManager:
@@ -15,9 +20,21 @@ class BatchTaskManager:
         self,
         job_queue=None,
         s3_folder_checking_interval=30,
+        s3_folder_cache_size=10000,
         monitor_interval=60,
         log_fp=None,
         dryrun=False,
+        s3_cache_db=None,
+        s3_cache_max_age=None,
+        s3_inventory=None,
+        s3_event_queue=None,
+        s3_safety_sweep_interval=3600,
+        job_event_queue=None,
+        job_reconcile_interval=600,
+        api_metrics_fp=None,
+        job_queues=None,
+        queue_depth_ttl=60,
+        queue_latency_weight=1.0,
     ):
 
         # Set up logging
@@ -43,27 +60,85 @@ class BatchTaskManager:
         if dryrun:
             logging.info("Dryrun mode, no jobs will be submitted")
 
-        # Keep track of the contents of various S3 folders
-        self.s3_folder_contents = {}
-        self.s3_folder_contents_last_checked = {}
+        # Keep track of the contents of various S3 folders.
+        # When new objects are reported by S3 events, folders only need
+        # to be listed again as an occasional safety sweep
+        if s3_event_queue is not None:
+            s3_folder_checking_interval = max(
+                s3_folder_checking_interval, s3_safety_sweep_interval
+            )
         self.s3_folder_checking_interval = s3_folder_checking_interval
+        self.s3_folder_cache = FolderCache(
+            max_folders=s3_folder_cache_size,
+            ttl=s3_folder_checking_interval
+        )
         self.monitor_interval = monitor_interval
 
-        # Keep track of the job queue
+        # Optionally, trust objects confirmed by previous runs
+        self.s3_existence_store = open_existence_store(
+            s3_cache_db, max_age=s3_cache_max_age
+        )
+
+        # Optionally, trust objects listed in S3 Inventory snapshots,
+        # except those reported as deleted since
+        self.s3_inventory = s3_inventory if s3_inventory is not None else []
+        self.s3_removed = set()
+
+        # Optionally, apply S3 object and Batch job notifications from queues
+        # (which may both be the same queue)
+        event_queues = []
+        for event_queue in [s3_event_queue, job_event_queue]:
+            if event_queue is not None and event_queue not in event_queues:
+                logging.info("Reading events from {}".format(event_queue))
+                event_queues.append(event_queue)
+        self.event_consumers = [
+            EventConsumer(event_queue, [self])
+            for event_queue in event_queues
+        ]
+
+        # With job events, Batch is only asked for the status of every job
+        # occasionally, to catch any events which were lost
+        self.job_events = job_event_queue is not None
+        self.job_reconcile_interval = job_reconcile_interval
+        self.last_reconciled = 0
+
+        # Optionally, export the AWS API call metrics after every check
+        # (as a Prometheus textfile if the path ends in .prom, otherwise JSON)
+        self.api_metrics_fp = api_metrics_fp
+
+        # Keep track of the job queue, or the list of queues to spread jobs across.
+        # Optionally, `job_queues` lists the eligible queues for particular
+        # job definitions ({job_definition: [queue, ...]})
         assert job_queue is not None, "Must specify job queue"
         self.job_queue = job_queue
-        logging.info("Job queue: " + job_queue)
+        self.job_queues = {
+            job_definition: queue_list(queues)
+            for job_definition, queues in (job_queues if job_queues is not None else {}).items()
+        }
+        self.all_queues = queue_list(job_queue)
+        for queues in self.job_queues.values():
+            for queue in queues:
+                if queue not in self.all_queues:
+                    self.all_queues.append(queue)
+        logging.info("Job queue: " + ", ".join(self.all_queues))
+
+        # Send each job to the least busy of its eligible queues
+        self.router = QueueRouter(
+            ttl=queue_depth_ttl,
+            latency_weight=queue_latency_weight
+        )
 
         # Keep track of what jobs were submitted as part of this workflow
         self.jobs_in_workflow = set([])
 
         # Keep a client connection open to Batch and S3
         logging.info("Opening connections to AWS Batch and AWS S3")
-        self.batch_client = boto3.client('batch')
-        self.s3_client = boto3.client("s3")
+        self.batch_client = get_client('batch')
+        self.s3_client = get_client("s3")
 
         # Keep track of what jobs are currently extant on AWS Batch
         self.current_jobs = {}
+        self.job_id_index = {}
         self.get_extant_jobs()
 
         # Keep track of the job definitions that are available
@@ -191,10 +266,13 @@ class BatchTaskManager:
                 }
                 return
 
-            logging.info("Submitting job for " + job_name)
+            job_queue = self.router.choose(
+                self.job_queues.get(job_definition, self.job_queue)
+            )
+            logging.info("Submitting job for {} to {}".format(job_name, job_queue))
             r = self.batch_client.submit_job(
                 jobName=job_name,
-                jobQueue=self.job_queue,
+                jobQueue=job_queue,
                 dependsOn=[
                     {
                         "jobId": dependency_job_id,
@@ -234,6 +312,7 @@ class BatchTaskManager:
                 "environment": environment,
                 "timeout_seconds": timeout_seconds,
                 "output_files": output_files,
+                "job_queue": job_queue,
             }
             logging.info("{}: {}".format(
                 job_name, json.dumps(self.current_jobs[job_hash_id])
@@ -247,7 +326,14 @@ class BatchTaskManager:
         while True:
             # Keep track of the number of jobs by their status
             to_print = defaultdict(lambda: defaultdict(int))
-            
+
+            # Catch up on any events since the last check
+            for consumer in self.event_consumers:
+                consumer.poll(force=True)
+
+            # Jobs which need their status checked with Batch
+            to_describe = []
+
             # Iterate over the jobs submitted as part of this workflow
             for job_id_hash in list(self.jobs_in_workflow):
                 # If the job has succeeded, do nothing more
@@ -264,11 +350,15 @@ class BatchTaskManager:
                     self.current_jobs[job_id_hash]["status"] = "SUCCEEDED"
                 # Otherwise, check the status
                 else:
-                    r = self.batch_client.describe_jobs(
-                        jobs=[self.current_jobs[job_id_hash]["job_id"]]
-                    )
-                    self.current_jobs[job_id_hash]["status"] = r["jobs"][0]["status"]
+                    to_describe.append(job_id_hash)
+
+            # Unless job events are keeping the status current, ask Batch
+            if not self.job_events or \
+                    time.time() - self.last_reconciled > self.job_reconcile_interval:
+                self.describe_job_status(to_describe)
+                self.last_reconciled = time.time()
 
+            for job_id_hash in list(self.jobs_in_workflow):
                 # Add to the counters we're going to print
                 to_print[
                     self.current_jobs[job_id_hash]["job_definition"]
@@ -277,23 +367,104 @@ class BatchTaskManager:
                 ] += 1
             
             # Print the table
-            to_print = pd.DataFrame(to_print).T.fillna(0)
-            if "SUCCEEDED" in to_print.columns:
-                to_print.sort_values(by="SUCCEEDED", ascending=False, inplace=True)
             print(
-                tabulate(
+                count_table(
                     to_print,
-                    headers="keys"
+                    sort_by="SUCCEEDED"
                 ) + "\n\n\nWaiting {:,} seconds...\n\n\n".format(
                     self.monitor_interval
                 )
             )
 
+            logging.info("S3 folder cache: {}".format(
+                json.dumps(self.s3_folder_cache.stats())
+            ))
+            logging.info("AWS API calls:\n{}".format(api_metrics.summary()))
+            if len(self.all_queues) > 1:
+                logging.info("Job queues: {}".format(json.dumps(self.router.stats())))
+            if self.api_metrics_fp is not None:
+                api_metrics.export(self.api_metrics_fp)
+
             # If all jobs SUCCEEDED or FAILED, finish
-            if all([col_name in ["SUCCEEDED", "FAILED", "SKIPPED"] for col_name in to_print.columns]):
+            if all([
+                status in ["SUCCEEDED", "FAILED", "SKIPPED"]
+                for job_counts in to_print.values()
+                for status in job_counts
+            ]):
+                logging.info("Job timing:\n{}".format(self.timing_report()))
                 break
 
-            time.sleep(self.monitor_interval)
+            # Apply events while waiting, so that they are current at the next check
+            if len(self.event_consumers) > 0:
+                wait_for_events(self.event_consumers, self.monitor_interval)
+            else:
+                time.sleep(self.monitor_interval)
+
+    def describe_job_status(self, job_id_hashes):
+        """Update the status of a set of jobs, describing 100 at a time."""
+        job_id_hashes = {
+            self.current_jobs[job_id_hash]["job_id"]: job_id_hash
+            for job_id_hash in job_id_hashes
+            if self.current_jobs[job_id_hash]["job_id"] is not None
+        }
+        id_list = list(job_id_hashes.keys())
+
+        while len(id_list) > 0:
+            r = self.batch_client.describe_jobs(jobs=id_list[:100])
+            for job_details in r["jobs"]:
+                job = self.current_jobs[job_id_hashes[job_details["jobId"]]]
+                job["status"] = job_details["status"]
+                # Keep the timestamps for the timing report
+                job.update(job_times(job_details))
+            id_list = id_list[100:]
+
+    def timing_report(self):
+        """Queue wait, runtime and throughput of the jobs in this workflow."""
+        jobs = [
+            {
+                "jobId": job.get("job_id"),
+                "job_definition": job["job_definition"],
+                "queue": job.get("job_queue"),
+                "status": job["status"],
+                "attempts": job.get("attempts"),
+                # Jobs found on Batch list their dependencies as {"jobId", "type"}
+                "depends_on": [
+                    d["jobId"] if isinstance(d, dict) else d
+                    for d in job.get("depends_on", [])
+                ],
+                "createdAt": job.get("createdAt"),
+                "startedAt": job.get("startedAt"),
+                "stoppedAt": job.get("stoppedAt"),
+            }
+            for job in [self.current_jobs[job_id_hash] for job_id_hash in self.jobs_in_workflow]
+            if job.get("job_id") is not None
+        ]
+        if len(jobs) == 0:
+            return "No jobs were submitted"
+        return timing_report(jobs)
+
+    def job_state_changed(self, detail):
+        """Update the status of a job from a Batch event."""
+        # Index the jobs by their ID, adding any jobs submitted since last time
+        if detail["jobId"] not in self.job_id_index:
+            self.job_id_index = {
+                job["job_id"]: job_id_hash
+                for job_id_hash, job in self.current_jobs.items()
+                if job.get("job_id") is not None
+            }
+        # Leave the events for other workflows in the queue
+        if detail["jobId"] not in self.job_id_index:
+            return False
+
+        job = self.current_jobs[self.job_id_index[detail["jobId"]]]
+
+        # Events may arrive out of order, so only apply those which move the job on
+        times = job_times(detail)
+        if job_status_moved_on(job["status"], job.get("attempts"), detail["status"], times.get("attempts")):
+            job["status"] = detail["status"]
+            # Keep the timestamps for the timing report
+            job.update(times)
+        return True
 
     def all_complete(self):
         """Check to see if all of the jobs are complete."""
@@ -330,26 +501,52 @@ class BatchTaskManager:
         # Split up the folder (includes the bucket) and the file
         s3_folder, s3_file = s3_path.rsplit("/", 1)
 
-        # Check if the S3 folder has been checked before
-        if s3_folder in self.s3_folder_contents:
-            # If the file is in the folder, return True
-            if s3_file in self.s3_folder_contents[s3_folder]:
+        # Objects confirmed recently by a previous run don't need to be listed
+        if self.s3_existence_store is not None:
+            if self.s3_existence_store.exists(s3_folder, s3_file):
                 return True
-            # If the folder hasn't been checked recently, check it again
-            elif time.time() - self.s3_folder_contents_last_checked[s3_folder] > self.s3_folder_checking_interval:
-                self.get_s3_folder_contents(s3_folder)
-                return s3_file in self.s3_folder_contents[s3_folder]
-            # Otherwise return False (the file doesn't exist)
-            else:
-                return False
-        # If this is the first time, check the folder contents
-        else:
-            self.get_s3_folder_contents(s3_folder)
-            # Return whether the file is in the folder
-            return s3_file in self.s3_folder_contents[s3_folder]
 
-    def get_s3_folder_contents(self, s3_folder):
-        """Get the contents of an S3 folder."""
+        # Objects in the inventory snapshot don't need to be listed either,
+        # unless they have been deleted since
+        bucket_name, key = s3_path[5:].split("/", 1)
+        if s3_path not in self.s3_removed and \
+                any([index.contains(bucket_name, key) for index in self.s3_inventory]):
+            return True
+
+        # List the folder again unless the file was found in an earlier
+        # listing, or was missing from a recent one
+        found = self.s3_folder_cache.contains(s3_folder, s3_file)
+        if found is None:
+            found = s3_file in self.get_s3_folder_contents(s3_folder, s3_file=s3_file)
+
+        return found
+
+    def object_created(self, s3_path):
+        """Record an object reported by an S3 event, returning False if it couldn't be applied."""
+        s3_folder, s3_file = s3_path.rsplit("/", 1)
+        self.s3_removed.discard(s3_path)
+        applied = self.s3_folder_cache.add(s3_folder, s3_file)
+        if self.s3_existence_store is not None:
+            self.s3_existence_store.record_object(s3_folder, s3_file)
+            applied = True
+        return applied
+
+    def object_removed(self, s3_path):
+        """Forget an object reported as deleted by an S3 event."""
+        s3_folder, s3_file = s3_path.rsplit("/", 1)
+        applied = self.s3_folder_cache.discard(s3_folder, s3_file)
+        if self.s3_existence_store is not None:
+            self.s3_existence_store.forget_object(s3_folder, s3_file)
+            applied = True
+        # Don't trust the inventory for this object any more
+        bucket_name, key = s3_path[5:].split("/", 1)
+        if any([index.contains(bucket_name, key) for index in self.s3_inventory]):
+            self.s3_removed.add(s3_path)
+            applied = True
+        return applied
+
+    def get_s3_folder_contents(self, s3_folder, s3_file=None):
+        """Get the contents of an S3 folder, which was listed to look for s3_file."""
         # Make sure the string is properly formatted
         assert s3_folder.startswith("s3://")
 
@@ -358,22 +555,23 @@ class BatchTaskManager:
         # Split the bucket and the folder name
         bucket_name, bucket_prefix = s3_folder[5:].split("/", 1)
 
+        # Only list the files in this folder, not in any subfolders
+        bucket_prefix = bucket_prefix + "/"
+
         tot_objs = []
         # Retrieve in batches of 1,000
         objs = self.s3_client.list_objects_v2(
             Bucket=bucket_name,
-            Prefix=bucket_prefix
+            Prefix=bucket_prefix,
+            Delimiter="/"
         )
 
         continue_flag = True
         while continue_flag:
             continue_flag = False
 
-            if 'Contents' not in objs:
-                break
-
             # Add this batch to the list
-            tot_objs.extend([x["Key"].rsplit("/", 1)[-1] for x in objs['Contents']])
+            tot_objs.extend(objs.get('Contents', []))
 
             # Check to see if there are more to fetch
             if objs['IsTruncated']:
@@ -382,11 +580,28 @@ class BatchTaskManager:
                 objs = self.s3_client.list_objects_v2(
                     Bucket=bucket_name,
                     Prefix=bucket_prefix,
+                    Delimiter="/",
                     ContinuationToken=token
                 )
-        
-        self.s3_folder_contents_last_checked[s3_folder] = time.time()
-        self.s3_folder_contents[s3_folder] = tot_objs
+
+        if self.s3_existence_store is not None:
+            n_changed = self.s3_existence_store.record_folder(s3_folder, tot_objs)
+            if n_changed > 0:
+                logging.info("{:,} objects changed in {} since last checked".format(
+                    n_changed, s3_folder
+                ))
+
+        contents = frozenset([x["Key"].rsplit("/", 1)[-1] for x in tot_objs])
+        self.s3_folder_cache.put(s3_folder, contents)
+
+        # Stop trusting the inventory for the folder if it has changed since
+        missing_key = None
+        if s3_file is not None and s3_file not in contents:
+            missing_key = bucket_prefix + s3_file
+        for index in self.s3_inventory:
+            index.prefix_changed(bucket_name, bucket_prefix, tot_objs, missing_key=missing_key)
+
+        return contents
 
     def get_job_definitions(self):
         """Get the job definitions that are currently defined."""
@@ -423,12 +638,16 @@ class BatchTaskManager:
     def get_extant_jobs(self):
         """Get all of the extant jobs on AWS Batch."""
         logging.info("Getting the list of jobs existing on Batch")
-        for job_status in [
-            "SUBMITTED", "PENDING", "RUNNABLE",
-            "STARTING", "RUNNING", "SUCCEEDED"
+        for job_queue, job_status in [
+            (job_queue, job_status)
+            for job_queue in self.all_queues
+            for job_status in [
+                "SUBMITTED", "PENDING", "RUNNABLE",
+                "STARTING", "RUNNING", "SUCCEEDED"
+            ]
         ]:
             job_list = self.batch_client.list_jobs(
-                jobQueue=self.job_queue,
+                jobQueue=job_queue,
                 jobStatus=job_status
             )
 
@@ -472,15 +691,17 @@ class BatchTaskManager:
                             "memory": job_details["container"]["memory"],
                             "command": job_details["container"]["command"],
                             "environment": job_details["container"]["environment"],
-                            "timeout_seconds": job_details.get("timeout", {}).get("attemptDurationSeconds", 0)
+                            "timeout_seconds": job_details.get("timeout", {}).get("attemptDurationSeconds", 0),
+                            "job_queue": job_queue
                         }
+                        self.current_jobs[job_hash_id].update(job_times(job_details))
                     job_id_list = job_id_list[100:]
 
                 # Check to see if there are more to fetch
                 if "nextToken" in job_list and job_list['nextToken'] is not None:
                     continue_flag = True
                     job_list = self.batch_client.list_jobs(
-                        jobQueue=self.job_queue,
+                        jobQueue=job_queue,
                         jobStatus=job_status,
                         nextToken = job_list['nextToken']
                     )
@@ -0,0 +1,105 @@
+"""Size-bounded cache of S3 folder listings.
+
+Files found in a listing are trusted for as long as the folder is cached,
+while the absence of a file expires after a TTL, so that folders are only
+listed again while they are still missing outputs.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+
+class FolderCache:
+    """LRU cache of the file names in each folder, keyed by folder."""
+
+    def __init__(self, max_folders=10000, ttl=300):
+        self.max_folders = max_folders
+        self.ttl = ttl
+
+        # Values are (time listed, frozenset of file names), oldest use first
+        self.folders = OrderedDict()
+        self.lock = threading.Lock()
+
+        # Keep track of how well the cache is working
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, folder):
+        """Return the set of file names in a folder, or None if it must be listed."""
+        with self.lock:
+            if folder not in self.folders:
+                self.misses += 1
+                return None
+
+            listed_at, contents = self.folders[folder]
+
+            # Drop the listing once it is older than the TTL
+            if time.time() - listed_at > self.ttl:
+                del self.folders[folder]
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self.folders.move_to_end(folder)
+            self.hits += 1
+            return contents
+
+    def contains(self, folder, name):
+        """True or False from the cached listing of a folder, or None if it must be listed."""
+        with self.lock:
+            if folder not in self.folders:
+                self.misses += 1
+                return None
+
+            listed_at, contents = self.folders[folder]
+            self.folders.move_to_end(folder)
+
+            # A file which was found never expires, only its absence does
+            if name not in contents and time.time() - listed_at > self.ttl:
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return name in contents
+
+    def put(self, folder, contents):
+        """Save the listing of a folder, evicting the least recently used."""
+        with self.lock:
+            self.folders[folder] = (time.time(), frozenset(contents))
+            self.folders.move_to_end(folder)
+
+            while len(self.folders) > self.max_folders:
+                self.folders.popitem(last=False)
+                self.evictions += 1
+
+    def add(self, folder, name):
+        """Record a new file in a folder, returning True if that folder is cached."""
+        with self.lock:
+            if folder not in self.folders:
+                return False
+            listed_at, contents = self.folders[folder]
+            self.folders[folder] = (listed_at, contents | {name})
+            return True
+
+    def discard(self, folder, name):
+        """Remove a deleted file from a folder, returning True if that folder is cached."""
+        with self.lock:
+            if folder not in self.folders:
+                return False
+            listed_at, contents = self.folders[folder]
+            self.folders[folder] = (listed_at, contents - {name})
+            return True
+
+    def stats(self):
+        """Summary of cache hits, misses and evictions."""
+        with self.lock:
+            return {
+                "folders": len(self.folders),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
@@ -0,0 +1,316 @@
+"""Consume AWS event notifications from SQS (or a local stand-in queue)."""
+import json
+import time
+import queue
+import logging
+import threading
+from urllib.parse import unquote_plus
+from batch_helpers.analytics import job_times
+from batch_helpers.aws import get_client
+
+# Order of the statuses in each attempt of a job (a job which is retried
+# goes back to RUNNABLE, listing one more attempt)
+JOB_STATUS_ORDER = ["SUBMITTED", "PENDING", "RUNNABLE", "STARTING", "RUNNING", "SUCCEEDED", "FAILED"]
+
+
+class SQSQueue:
+    """Receive and delete messages from an SQS queue."""
+
+    def __init__(self, queue_url):
+        self.queue_url = queue_url
+        self.client = get_client("sqs")
+
+    def receive(self, wait_seconds=0):
+        """Return a list of (receipt handle, message body)."""
+        r = self.client.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=10,
+            WaitTimeSeconds=int(wait_seconds)
+        )
+        return [
+            (m["ReceiptHandle"], m["Body"])
+            for m in r.get("Messages", [])
+        ]
+
+    def delete(self, handles):
+        """Remove messages which have been processed."""
+        for ix in range(0, len(handles), 10):
+            self.client.delete_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[
+                    {"Id": str(i), "ReceiptHandle": h}
+                    for i, h in enumerate(handles[ix:ix + 10])
+                ]
+            )
+
+
+class LocalQueue:
+    """In-process stand-in for SQSQueue, e.g. for testing.
+
+    As with SQS, messages which are received but not deleted are delivered
+    again after `visibility_timeout` seconds.
+    """
+
+    def __init__(self, visibility_timeout=30):
+        self.messages = queue.Queue()
+        self.visibility_timeout = visibility_timeout
+
+        # Messages which have been received but not deleted, as (received at, body) by handle
+        self.in_flight = {}
+        self.n_received = 0
+        self.lock = threading.Lock()
+
+    def send(self, body):
+        """Add a message (a string, or anything that can be serialized to JSON)."""
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        self.messages.put(body)
+
+    def receive(self, wait_seconds=0):
+        # Deliver again any messages which weren't deleted in time
+        with self.lock:
+            for h, (received_at, body) in list(self.in_flight.items()):
+                if time.time() - received_at >= self.visibility_timeout:
+                    del self.in_flight[h]
+                    self.messages.put(body)
+
+        batch = []
+        try:
+            batch.append(self.messages.get(timeout=wait_seconds) if wait_seconds > 0
+                         else self.messages.get_nowait())
+            while len(batch) < 10:
+                batch.append(self.messages.get_nowait())
+        except queue.Empty:
+            pass
+
+        received = []
+        with self.lock:
+            for body in batch:
+                self.n_received += 1
+                self.in_flight[self.n_received] = (time.time(), body)
+                received.append((self.n_received, body))
+        return received
+
+    def delete(self, handles):
+        with self.lock:
+            for h in handles:
+                self.in_flight.pop(h, None)
+
+
+def open_queue(queue_url):
+    """Connect to an SQS queue by URL, or pass through a queue object."""
+    if queue_url is None or not isinstance(queue_url, str):
+        return queue_url
+    return SQSQueue(queue_url)
+
+
+def unwrap_message(body):
+    """Parse a message body, unwrapping any SNS envelope."""
+    msg = json.loads(body)
+    if msg.get("Type") == "Notification" and "Message" in msg:
+        msg = json.loads(msg["Message"])
+    return msg
+
+
+def parse_s3_events(msg):
+    """Yield (created, s3_path) for each object in an S3 event notification."""
+    # Events delivered through EventBridge
+    if msg.get("source") == "aws.s3":
+        detail = msg["detail"]
+        yield (
+            msg["detail-type"] == "Object Created",
+            "s3://{}/{}".format(detail["bucket"]["name"], detail["object"]["key"])
+        )
+        return
+
+    # Notifications sent directly from the bucket, which URL-encode the key
+    for record in msg.get("Records", []):
+        if "s3" not in record:
+            continue
+        yield (
+            record["eventName"].startswith("ObjectCreated"),
+            "s3://{}/{}".format(
+                record["s3"]["bucket"]["name"],
+                unquote_plus(record["s3"]["object"]["key"])
+            )
+        )
+
+
+def job_status_moved_on(status, attempts, new_status, new_attempts):
+    """Whether a job has moved on from one status (and number of attempts) to another.
+
+    Events may arrive out of order, but a finished job never changes.
+    """
+    if status in ["SUCCEEDED", "FAILED"]:
+        return False
+    if status not in JOB_STATUS_ORDER or new_status not in JOB_STATUS_ORDER:
+        return True
+    return (new_attempts or 0, JOB_STATUS_ORDER.index(new_status)) >= \
+        (attempts or 0, JOB_STATUS_ORDER.index(status))
+
+
+def parse_batch_events(msg):
+    """Yield the details of a Batch "Job State Change" event."""
+    if msg.get("source") == "aws.batch" and msg.get("detail-type") == "Batch Job State Change":
+        yield msg["detail"]
+
+
+class EventConsumer:
+    """Apply queued events to targets.
+
+    S3 notifications are passed to target.object_created / object_removed
+    and Batch job state changes to target.job_state_changed, for each
+    target which has those methods. Each method returns True if the event
+    concerned the target. The queue may be shared with other consumers, so
+    a message is only deleted once every event in it has been applied by
+    one of the targets. Other messages are left in the queue, and become
+    visible to the other consumers again after its visibility timeout.
+    Events which no consumer applies (e.g. for jobs of finished workflows)
+    are received again and again, so the queue should have a dead-letter
+    queue (redrive policy) to move them out after a few receives.
+    """
+
+    def __init__(self, event_queue, targets, min_interval=5, max_poll_seconds=30):
+        self.queue = open_queue(event_queue)
+        self.targets = targets
+
+        # Don't check the queue more often than this (in seconds)
+        self.min_interval = min_interval
+        self.last_polled = 0
+        self.n_events = 0
+
+        # Stop reading a busy queue after this long (in seconds), noting
+        # that there may be events which have not been applied yet
+        self.max_poll_seconds = max_poll_seconds
+        self.drained = False
+
+        # Events are applied by one thread at a time (e.g. in the status daemon)
+        self.lock = threading.Lock()
+
+    def poll(self, wait_seconds=0, force=False):
+        """Process the messages waiting in the queue, for up to max_poll_seconds."""
+        with self.lock:
+            return self._poll(wait_seconds=wait_seconds, force=force)
+
+    def _poll(self, wait_seconds=0, force=False):
+        if not force and time.time() - self.last_polled < self.min_interval:
+            return 0
+        self.last_polled = time.time()
+        deadline = self.last_polled + wait_seconds + self.max_poll_seconds
+
+        n_events = 0
+        self.drained = False
+        while True:
+            batch = self.queue.receive(wait_seconds=wait_seconds)
+            if len(batch) == 0:
+                self.drained = True
+                break
+            applied = []
+            for h, body in batch:
+                try:
+                    n, all_applied = self.handle(unwrap_message(body))
+                except (ValueError, KeyError):
+                    logging.info("Skipping malformed event: {}".format(body))
+                    applied.append(h)
+                    continue
+                n_events += n
+                if all_applied:
+                    applied.append(h)
+            self.queue.delete(applied)
+            if time.time() > deadline:
+                logging.info("Stopped reading events after {:,} seconds".format(self.max_poll_seconds))
+                break
+            # Only wait for the first batch
+            wait_seconds = 0
+
+        self.n_events += n_events
+        return n_events
+
+    def handle(self, msg):
+        """Pass a single message on to the targets.
+
+        Returns the number of events, and whether each was applied by a target.
+        """
+        n_events = 0
+        all_applied = True
+        for created, s3_path in parse_s3_events(msg):
+            applied = False
+            for target in self.targets:
+                if created and hasattr(target, "object_created"):
+                    applied = target.object_created(s3_path) or applied
+                elif not created and hasattr(target, "object_removed"):
+                    applied = target.object_removed(s3_path) or applied
+            all_applied = all_applied and applied
+            n_events += 1
+
+        for detail in parse_batch_events(msg):
+            applied = False
+            for target in self.targets:
+                if hasattr(target, "job_state_changed"):
+                    applied = target.job_state_changed(detail) or applied
+            all_applied = all_applied and applied
+            n_events += 1
+
+        # Messages with no events in them (e.g. the s3:TestEvent sent when
+        # notifications are set up) are deleted, as nothing will apply them
+        return n_events, all_applied
+
+
+def wait_for_events(consumers, seconds):
+    """Spend the time until the next check processing events as they arrive."""
+    end = time.time() + seconds
+    while time.time() < end:
+        for consumer in consumers:
+            consumer.poll(
+                wait_seconds=min(20, max(1, (end - time.time()) / len(consumers))),
+                force=True
+            )
+
+
+class JobStatusTracker:
+    """Latest status of each job, as reported by Batch events.
+
+    The status of every job is kept, but only the events for jobs which have
+    been passed to track() are deleted from the queue, so that a queue can
+    be shared by the projects (and processes) following different jobs.
+    """
+
+    def __init__(self, event_queue, reconcile_interval=600, min_interval=5, max_poll_seconds=30):
+        self.status = {}
+        # Timestamps and number of attempts reported with the latest status
+        self.times = {}
+        self.job_ids = set()
+
+        # Jobs are still described this often, to catch any lost events
+        self.reconcile_interval = reconcile_interval
+
+        self.consumer = EventConsumer(
+            event_queue,
+            [self],
+            min_interval=min_interval,
+            max_poll_seconds=max_poll_seconds
+        )
+
+    def track(self, job_ids):
+        """Follow the events for these jobs."""
+        self.job_ids.update(job_ids)
+
+    def job_state_changed(self, detail):
+        job_id = detail["jobId"]
+        times = job_times(detail)
+        if job_id not in self.status or job_status_moved_on(
+            self.status[job_id], self.times[job_id].get("attempts"),
+            detail["status"], times.get("attempts")
+        ):
+            self.status[job_id] = detail["status"]
+            self.times[job_id] = times
+        return job_id in self.job_ids
+
+    def poll(self):
+        """Apply any events waiting in the queue."""
+        return self.consumer.poll()
+
+    @property
+    def drained(self):
+        """Whether the last poll read every event waiting in the queue."""
+        return self.consumer.drained
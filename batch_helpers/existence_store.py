@@ -0,0 +1,119 @@
+"""Persistent record of S3 objects already confirmed to exist, shared across runs."""
+import os
+import time
+import sqlite3
+import threading
+
+# Environment variable used to turn on the cache without any other changes
+CACHE_DB_ENV = "BATCH_S3_CACHE_DB"
+
+
+class ExistenceStore:
+    """SQLite table of confirmed S3 objects with their ETag and LastModified."""
+
+    def __init__(self, db_fp, max_age=7 * 24 * 3600):
+        # Objects confirmed more than max_age seconds ago are checked again
+        self.max_age = max_age
+
+        self.db_fp = db_fp
+        self.conn = sqlite3.connect(db_fp, check_same_thread=False)
+        self.lock = threading.Lock()
+
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS objects (
+                    folder TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    checked_at REAL NOT NULL,
+                    PRIMARY KEY (folder, name)
+                ) WITHOUT ROWID
+            """)
+
+    def exists(self, folder, name):
+        """True if the object was confirmed recently, None if S3 must be checked."""
+        with self.lock:
+            r = self.conn.execute(
+                "SELECT checked_at FROM objects WHERE folder = ? AND name = ?",
+                (folder, name)
+            ).fetchone()
+        if r is not None and time.time() - r[0] <= self.max_age:
+            return True
+        return None
+
+    def record_folder(self, folder, objects):
+        """Save a fresh listing of a folder, returning the number of changed objects."""
+        now = time.time()
+        # A missing LastModified is stored as NULL
+        listed = {
+            o["Key"].rsplit("/", 1)[-1]: (
+                o.get("ETag"),
+                str(o["LastModified"]) if o.get("LastModified") is not None else None
+            )
+            for o in objects
+        }
+
+        with self.lock, self.conn:
+            previous = {
+                name: (etag, last_modified)
+                for name, etag, last_modified in self.conn.execute(
+                    "SELECT name, etag, last_modified FROM objects WHERE folder = ?",
+                    (folder,)
+                )
+            }
+
+            # Objects that were removed from S3 are no longer trusted
+            removed = [name for name in previous if name not in listed]
+            self.conn.executemany(
+                "DELETE FROM objects WHERE folder = ? AND name = ?",
+                [(folder, name) for name in removed]
+            )
+
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)",
+                [
+                    (folder, name, etag, last_modified, now)
+                    for name, (etag, last_modified) in listed.items()
+                ]
+            )
+
+        # Count the objects that were overwritten or deleted since last seen
+        n_changed = len(removed) + sum([
+            previous[name] != listed[name]
+            for name in listed
+            if name in previous
+        ])
+        return n_changed
+
+    def record_object(self, folder, name, etag=None, last_modified=None):
+        """Save a single object reported to exist (e.g. by an S3 event)."""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)",
+                (folder, name, etag, last_modified, time.time())
+            )
+
+    def forget_object(self, folder, name):
+        """Stop trusting an object which was deleted."""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "DELETE FROM objects WHERE folder = ? AND name = ?",
+                (folder, name)
+            )
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def open_existence_store(db_fp=None, max_age=None):
+    """Open the store at db_fp (or $BATCH_S3_CACHE_DB), or return None if neither is set."""
+    if db_fp is None:
+        db_fp = os.environ.get(CACHE_DB_ENV)
+    if db_fp is None:
+        return None
+    if max_age is None:
+        return ExistenceStore(db_fp)
+    return ExistenceStore(db_fp, max_age=max_age)
@@ -1,10 +1,24 @@
+import os
 import sys
 import json
-import boto3
+import queue
+import time
 import shutil
+import socket
 import logging
+import threading
 import traceback
 import subprocess
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from batch_helpers.aws import get_client
+from batch_helpers.s3_writer import open_s3_writer
+# Also available to scripts importing from this module
+from batch_helpers.staging import stage_s3_input, staged_s3_input  # noqa: F401
+
+# Resources used by every command run with run_cmds in this process
+command_telemetry = []
 
 def exit_and_clean_up(temp_folder):
     """Log the error messages and delete the temporary folder."""
@@ -24,72 +38,547 @@ def exit_and_clean_up(temp_folder):
     sys.exit(exc_value)
 
 
-def run_cmds(commands, retry=0, catchExcept=False, stdout=None):
-    """Run commands and write out the log, combining STDOUT & STDERR."""
+class OutputPump(threading.Thread):
+    """Log the lines written by a subprocess to a pipe as they arrive."""
+
+    def __init__(
+        self,
+        pipe,
+        label,
+        tee=None,
+        tee_lock=None,
+        max_line_length=10000,
+        max_lines_per_second=None,
+    ):
+        threading.Thread.__init__(self, daemon=True)
+        self.pipe = pipe
+        self.label = label
+        self.tee = tee
+        self.tee_lock = tee_lock
+        self.max_line_length = max_line_length
+        self.max_lines_per_second = max_lines_per_second
+        self.n_lines = 0
+        self.n_suppressed = 0
+
+    def run(self):
+        logging.info("Standard {} of subprocess:".format(self.label))
+        window_start = time.time()
+        window_lines = 0
+
+        while True:
+            # Never hold more than one (truncated) line in memory
+            line = self.pipe.readline(self.max_line_length)
+            if len(line) == 0:
+                break
+            if self.tee is not None:
+                self.write_tee(line)
+
+            # Skip over (but still copy to the tee) the rest of a very long line
+            truncated = False
+            if not line.endswith(b"\n") and len(line) >= self.max_line_length:
+                rest = self.pipe.readline(self.max_line_length)
+                while len(rest) > 0:
+                    truncated = True
+                    if self.tee is not None:
+                        self.write_tee(rest)
+                    if rest.endswith(b"\n"):
+                        break
+                    rest = self.pipe.readline(self.max_line_length)
+
+            self.n_lines += 1
+
+            # Optionally, limit the number of lines logged per second
+            if self.max_lines_per_second is not None:
+                if time.time() - window_start >= 1:
+                    if self.n_suppressed > 0:
+                        logging.info("({:,} lines not logged)".format(self.n_suppressed))
+                        self.n_suppressed = 0
+                    window_start = time.time()
+                    window_lines = 0
+                window_lines += 1
+                if window_lines > self.max_lines_per_second:
+                    self.n_suppressed += 1
+                    continue
+
+            line = line.decode("latin-1").rstrip("\n")
+            if truncated:
+                line = line + " [truncated]"
+            logging.info(line)
+
+        if self.n_suppressed > 0:
+            logging.info("({:,} lines not logged)".format(self.n_suppressed))
+        self.pipe.close()
+
+    def write_tee(self, data):
+        with self.tee_lock:
+            self.tee.write(data)
+
+
+def run_cmds(
+    commands,
+    retry=0,
+    catchExcept=False,
+    stdout=None,
+    tee=None,
+    max_line_length=10000,
+    max_lines_per_second=None,
+    timeout=None,
+):
+    """Run commands and write out the log, combining STDOUT & STDERR.
+
+    Output is logged line by line while the command runs, so memory use
+    doesn't depend on how much the command writes. Lines longer than
+    `max_line_length` are truncated in the log, `max_lines_per_second`
+    limits how much is logged, and everything can be copied to `tee`.
+    The command is killed if it runs for more than `timeout` seconds.
+    """
     logging.info("Commands:")
     logging.info(' '.join(commands))
-    if stdout is None:
-        p = subprocess.Popen(commands,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT)
-        stdout, stderr = p.communicate()
-    else:
-        with open(stdout, "wt") as fo:
+
+    started_at = time.time()
+    tee_handle = open(tee, "ab") if tee is not None else None
+    tee_lock = threading.Lock()
+    stdout_handle = open(stdout, "wt") if stdout is not None else None
+    try:
+        if stdout is None:
+            p = subprocess.Popen(commands,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT)
+            pipes = [(p.stdout, "output")]
+        else:
             p = subprocess.Popen(commands,
                                  stderr=subprocess.PIPE,
-                                 stdout=fo)
-            stdout, stderr = p.communicate()
-        stdout = False
-    exitcode = p.wait()
-    if stdout:
-        logging.info("Standard output of subprocess:")
-        for line in stdout.decode("latin-1").split('\n'):
-            logging.info(line.encode("utf-8"))
-    if stderr:
-        logging.info("Standard error of subprocess:")
-        for line in stderr.decode("latin-1").split('\n'):
-            logging.info(line.encode("utf-8"))
+                                 stdout=stdout_handle)
+            pipes = [(p.stderr, "error")]
+
+        pumps = [
+            OutputPump(
+                pipe,
+                label,
+                tee=tee_handle,
+                tee_lock=tee_lock,
+                max_line_length=max_line_length,
+                max_lines_per_second=max_lines_per_second,
+            )
+            for pipe, label in pipes
+        ]
+        for pump in pumps:
+            pump.start()
+
+        # Optionally, kill the command once it has run for too long
+        exitcode, rusage = _wait_with_rusage(p, timeout=timeout)
+        for pump in pumps:
+            pump.join()
+    finally:
+        if stdout_handle is not None:
+            stdout_handle.close()
+        if tee_handle is not None:
+            tee_handle.close()
+
+    # Record the resources used by the command
+    record = {
+        "command": [str(x) for x in commands],
+        "exit_code": exitcode,
+        "started_at": started_at,
+        "wall_seconds": time.time() - started_at,
+        "user_cpu_seconds": None,
+        "system_cpu_seconds": None,
+        "peak_rss_bytes": None,
+    }
+    if rusage is not None:
+        record["user_cpu_seconds"] = rusage.ru_utime
+        record["system_cpu_seconds"] = rusage.ru_stime
+        # Linux reports the peak RSS in KB, macOS in bytes
+        record["peak_rss_bytes"] = rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    command_telemetry.append(record)
+    logging.info("Resources used: {}".format(json.dumps(record)))
 
     # Check the exit code
     if exitcode != 0 and retry > 0:
         msg = "Exit code {}, retrying {} more times".format(exitcode, retry)
         logging.info(msg)
-        run_cmds(commands, retry=retry - 1)
+        return run_cmds(
+            commands,
+            retry=retry - 1,
+            catchExcept=catchExcept,
+            stdout=stdout,
+            tee=tee,
+            max_line_length=max_line_length,
+            max_lines_per_second=max_lines_per_second,
+            timeout=timeout,
+        )
     elif exitcode != 0 and catchExcept:
         msg = "Exit code was {}, but we will continue anyway"
         logging.info(msg.format(exitcode))
     else:
         assert exitcode == 0, "Exit code {}".format(exitcode)
+    return exitcode
+
+
+def _wait_with_rusage(p, timeout=None):
+    """Wait for a subprocess, returning its exit code and resource usage.
+
+    The subprocess is killed if it runs for more than `timeout` seconds.
+    This is done from the waiting thread, so that a process which has
+    already been reaped (and whose PID may have been reused) is never killed.
+    """
+    if not hasattr(os, "wait4"):
+        try:
+            return p.wait(timeout=timeout), None
+        except subprocess.TimeoutExpired:
+            logging.info("Killing the command after {:,} seconds".format(timeout))
+            p.kill()
+            return p.wait(), None
+
+    # Poll until the subprocess exits or runs out of time
+    pid = 0
+    if timeout is not None:
+        deadline = time.time() + timeout
+        while True:
+            pid, status, rusage = os.wait4(p.pid, os.WNOHANG)
+            if pid != 0 or time.time() >= deadline:
+                break
+            time.sleep(min(0.1, max(0, deadline - time.time())))
+        if pid == 0:
+            logging.info("Killing the command after {:,} seconds".format(timeout))
+            p.kill()
+    if pid == 0:
+        _, status, rusage = os.wait4(p.pid, 0)
+    # Let the Popen object know that the process has already been reaped
+    if os.WIFSIGNALED(status):
+        p.returncode = -os.WTERMSIG(status)
+    else:
+        p.returncode = os.WEXITSTATUS(status)
+    return p.returncode, rusage
+
+
+def cgroup_memory_peak():
+    """Highest memory use (in bytes) of this container, or None if not available."""
+    for fp in [
+        "/sys/fs/cgroup/memory.peak",
+        "/sys/fs/cgroup/memory/memory.max_usage_in_bytes",
+    ]:
+        if os.path.exists(fp):
+            return int(open(fp).read())
+    return None
+
+
+def telemetry_record(sample_cgroup=True):
+    """Summary of the resources used by each command run so far."""
+    record = {
+        "hostname": socket.gethostname(),
+        "aws_batch_job_id": os.environ.get("AWS_BATCH_JOB_ID"),
+        "container_cpus": container_cpu_count(),
+        "commands": list(command_telemetry),
+    }
+    if sample_cgroup:
+        record["cgroup_memory_peak_bytes"] = cgroup_memory_peak()
+    return record
+
+
+def write_telemetry(s3_path, sample_cgroup=True):
+    """Upload the resources used by each command (e.g. next to the outputs) as JSON.
+
+    The commands which were written are then forgotten, so that the
+    records don't build up in a long-running process.
+    """
+    record = telemetry_record(sample_cgroup=sample_cgroup)
+    write_s3_json(record, s3_path)
+    # Commands may have finished in other threads in the meantime
+    del command_telemetry[:len(record["commands"])]
+
+
+def container_cpu_count(cgroup_root="/sys/fs/cgroup", metadata_uri=None):
+    """Number of CPUs allocated to this container.
+
+    Uses a CPU quota if one is set, or else the vCPUs reserved for the
+    container in the ECS task metadata (which AWS Batch provides). CPU
+    shares are not used, as the default (1,024, or a cgroup v2 weight of
+    100) can't be told apart from a reservation.
+    """
+    n_cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+
+    # A hard limit set with a CPU quota (cgroup v2, then v1)
+    quota = None
+    if os.path.exists(os.path.join(cgroup_root, "cpu.max")):
+        limit, period = open(os.path.join(cgroup_root, "cpu.max")).read().split()
+        if limit != "max":
+            quota = float(limit) / float(period)
+    elif os.path.exists(os.path.join(cgroup_root, "cpu", "cpu.cfs_quota_us")):
+        limit = float(open(os.path.join(cgroup_root, "cpu", "cpu.cfs_quota_us")).read())
+        period = float(open(os.path.join(cgroup_root, "cpu", "cpu.cfs_period_us")).read())
+        if limit > 0:
+            quota = limit / period
+
+    # Otherwise, the vCPUs reserved for the job
+    if quota is None:
+        quota = metadata_cpu_count(metadata_uri)
+
+    if quota is not None:
+        n_cpus = min(n_cpus, max(1, int(round(quota))))
+    return n_cpus
+
+
+def metadata_cpu_count(metadata_uri=None):
+    """vCPUs reserved for this container in the ECS task metadata (v4), if available."""
+    if metadata_uri is None:
+        metadata_uri = os.environ.get("ECS_CONTAINER_METADATA_URI_V4")
+    if metadata_uri is None:
+        return None
+
+    from urllib.request import urlopen
+    try:
+        # The container's limit is given in CPU units (1,024 per vCPU)
+        container = json.loads(urlopen(metadata_uri, timeout=1).read().decode("utf-8"))
+        if container.get("Limits", {}).get("CPU", 0) > 0:
+            return container["Limits"]["CPU"] / 1024.
+
+        # Fargate gives the limit for the whole task, in vCPUs
+        task = json.loads(urlopen(metadata_uri + "/task", timeout=1).read().decode("utf-8"))
+        if task.get("Limits", {}).get("CPU", 0) > 0:
+            return float(task["Limits"]["CPU"])
+    except (OSError, ValueError):
+        logging.info("Could not read the task metadata from {}".format(metadata_uri))
+    return None
+
+
+def run_cmds_parallel(
+    commands_list,
+    weights=None,
+    n_cpus=None,
+    retry=0,
+    catchExcept=False,
+    **kwargs
+):
+    """Run a list of independent commands at the same time, returning their exit codes.
+
+    Each command uses `weights[i]` CPUs (1 by default), and commands are
+    started (largest first) whenever enough of the container's CPUs are
+    free. Each command is retried like run_cmds, and unless `catchExcept`
+    is set an AssertionError is raised after all have finished if any
+    of them failed. An exception raised while running any command (e.g.
+    for a missing executable) is raised again once all have finished.
+    Other arguments (e.g. `stdout`) are passed to run_cmds.
+    """
+    if weights is None:
+        weights = [1] * len(commands_list)
+    assert len(weights) == len(commands_list)
+    if n_cpus is None:
+        n_cpus = container_cpu_count()
+    logging.info("Running {:,} commands on {} CPUs".format(len(commands_list), n_cpus))
+
+    # Keep track of the number of CPUs which are free
+    free = [n_cpus]
+    cpus_changed = threading.Condition()
+    exitcodes = [None] * len(commands_list)
+
+    def run_one(ix, weight):
+        try:
+            exitcodes[ix] = run_cmds(
+                commands_list[ix],
+                retry=retry,
+                catchExcept=True,
+                **kwargs
+            )
+        finally:
+            with cpus_changed:
+                free[0] += weight
+                cpus_changed.notify_all()
+
+    # Commands are started in at most one thread per CPU
+    futures = {}
+    with ThreadPoolExecutor(max_workers=max(1, int(n_cpus))) as pool:
+        for ix in sorted(range(len(commands_list)), key=lambda ix: -weights[ix]):
+            # A command can't ask for more than the whole container
+            weight = min(weights[ix], n_cpus)
+            with cpus_changed:
+                cpus_changed.wait_for(lambda: free[0] >= weight)
+                free[0] -= weight
+            futures[ix] = pool.submit(run_one, ix, weight)
+
+    # A command which couldn't be run at all (e.g. a missing executable) is an error
+    errors = [
+        (ix, future.exception())
+        for ix, future in sorted(futures.items())
+        if future.exception() is not None
+    ]
+    if len(errors) > 0:
+        for ix, error in errors:
+            logging.info("Could not run {}: {!r}".format(" ".join(commands_list[ix]), error))
+        raise errors[0][1]
+
+    failed = [
+        (" ".join(commands_list[ix]), exitcode)
+        for ix, exitcode in enumerate(exitcodes)
+        if exitcode != 0
+    ]
+    if len(failed) > 0:
+        msg = "{:,} commands failed: {}".format(len(failed), failed)
+        if catchExcept:
+            logging.info(msg + ", but we will continue anyway")
+        else:
+            raise AssertionError(msg)
+    return exitcodes
 
 
 def s3_path_exists(s3_path):
     """Check if a path exists on S3."""
-    s3 = boto3.resource('s3')
     assert s3_path.startswith("s3://")
+    return _s3_head_exists(s3_path)[s3_path]
+
+
+def s3_paths_exist(s3_paths, list_threshold=10, n_threads=16):
+    """Check whether a set of paths exist on S3, returning a dict of path -> bool.
+
+    Paths are grouped by folder. Folders with fewer than `list_threshold`
+    paths to check are checked with one HeadObject per path (in parallel),
+    and the others with a single listing of the folder.
+    """
+    # Group the paths by bucket and folder
+    groups = defaultdict(list)
+    for s3_path in s3_paths:
+        assert s3_path.startswith("s3://")
+        bucket, key = s3_path[5:].split("/", 1)
+        groups[(bucket, key.rsplit("/", 1)[0] if "/" in key else "")].append(s3_path)
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        futures = []
+        for (bucket, folder), group in groups.items():
+            if len(group) < list_threshold:
+                futures.extend([
+                    pool.submit(_s3_head_exists, s3_path)
+                    for s3_path in group
+                ])
+            else:
+                futures.append(pool.submit(_s3_folder_exists, bucket, folder, group))
+        for future in futures:
+            results.update(future.result())
+    return results
+
+
+def _s3_head_exists(s3_path):
+    """Check a single path with HeadObject."""
     bucket, key = s3_path[5:].split("/", 1)
-    bucket = s3.Bucket(bucket)
-    objs = list(bucket.objects.filter(Prefix=key))
-    if len(objs) > 0 and objs[0].key == key:
-        return True
-    else:
-        return False
+    try:
+        get_client('s3').head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ["404", "NoSuchKey", "NotFound"]:
+            return {s3_path: False}
+        raise
+    return {s3_path: True}
+
+
+def _s3_folder_exists(bucket, folder, s3_paths):
+    """Check a set of paths in the same folder with a single listing."""
+    prefix = folder + "/" if len(folder) > 0 else ""
+    paginator = get_client('s3').get_paginator('list_objects_v2')
+    existing = set([])
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter="/"):
+        for obj in page.get('Contents', []):
+            existing.add("s3://{}/{}".format(bucket, obj['Key']))
+    return {s3_path: s3_path in existing for s3_path in s3_paths}
 
     
-def write_s3_json(dat, s3_path):
+def write_s3_json(dat, s3_path, compression=None):
     """Write some data in JSON format to S3."""
-    s3 = boto3.resource('s3')
-    dat_json = json.dumps(dat)
     assert s3_path.startswith("s3://")
-    bucket, key = s3_path[5:].split("/", 1)
-    object = s3.Object(bucket, key)
-    object.put(Body=dat_json)
+    # Large objects are streamed to S3 in parts rather than built up in memory
+    with open_s3_writer(s3_path, compression=compression) as fo:
+        json.dump(dat, fo)
 
-def s3_ls(s3_path):
-    """List the contents of a 'folder' on S3."""
+def s3_ls(s3_path, metadata=False, parallel=False, n_threads=16):
+    """List the contents of a 'folder' on S3, yielding keys relative to the folder.
+
+    With metadata=True, yield dicts with the relative Key, Size and ETag.
+    With parallel=True, the listing is split up by the sub-folders found
+    directly under the path and those are listed at the same time (so the
+    keys are not returned in order).
+    """
 
     assert s3_path.startswith("s3://")
     bucket, prefix = s3_path[5:].split("/", 1)
 
-    conn = boto3.client('s3')
-    for key in conn.list_objects(Bucket=bucket, Prefix=prefix)['Contents']:
-        yield key['Key'].replace(prefix, '')
+    if parallel:
+        objs = _s3_ls_parallel(bucket, prefix, n_threads)
+    else:
+        objs = _s3_ls_pages(bucket, prefix)
+
+    for obj in objs:
+        # Only remove the prefix from the start of the key
+        key = obj['Key'][len(prefix):]
+        if metadata:
+            yield {"Key": key, "Size": obj['Size'], "ETag": obj['ETag']}
+        else:
+            yield key
+
+
+def _s3_ls_pages(bucket, prefix, delimiter=None, common_prefixes=None):
+    """Yield every object under a prefix, one page at a time."""
+    kwargs = {"Bucket": bucket, "Prefix": prefix}
+    if delimiter is not None:
+        kwargs["Delimiter"] = delimiter
+    paginator = get_client('s3').get_paginator('list_objects_v2')
+    for page in paginator.paginate(**kwargs):
+        if common_prefixes is not None:
+            common_prefixes.extend([p['Prefix'] for p in page.get('CommonPrefixes', [])])
+        for obj in page.get('Contents', []):
+            yield obj
+
+
+def _s3_ls_parallel(bucket, prefix, n_threads, max_buffered=10000):
+    """Yield every object under a prefix, listing each sub-folder in parallel."""
+    # Objects directly under the prefix, and the sub-folders to list
+    sub_prefixes = []
+    for obj in _s3_ls_pages(bucket, prefix, delimiter="/", common_prefixes=sub_prefixes):
+        yield obj
+
+    if len(sub_prefixes) == 0:
+        return
+
+    # Pass the objects back through a bounded queue to keep memory constant
+    buffer = queue.Queue(maxsize=max_buffered)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def list_shard(sub_prefix):
+        try:
+            for obj in _s3_ls_pages(bucket, sub_prefix):
+                if stop.is_set():
+                    return
+                put(obj)
+        except Exception as e:
+            put(e)
+        finally:
+            put(done)
+
+    pool = ThreadPoolExecutor(max_workers=n_threads)
+    futures = []
+    try:
+        for sub_prefix in sub_prefixes:
+            futures.append(pool.submit(list_shard, sub_prefix))
+
+        n_remaining = len(sub_prefixes)
+        while n_remaining > 0:
+            item = buffer.get()
+            if item is done:
+                n_remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        # Let the threads exit if the caller stops reading early, without
+        # starting the shards which are still queued (as cancel_futures=True would)
+        stop.set()
+        for future in futures:
+            future.cancel()
+        pool.shutdown(wait=False)
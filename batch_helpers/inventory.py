@@ -0,0 +1,256 @@
+"""Answer S3 existence checks from an S3 Inventory report instead of listing.
+
+A snapshot is only trusted to say that an object exists: objects missing
+from it (e.g. created since) are always checked live. An object deleted
+after the snapshot was taken is still reported to exist, unless a listing
+of its folder shows that the folder has changed since (see prefix_changed),
+or an S3 event reports the deletion.
+"""
+import io
+import os
+import csv
+import gzip
+import json
+import logging
+import datetime
+from urllib.parse import unquote_plus
+from batch_helpers.aws import get_client
+
+# Saved indexes can only be used with the hash they were made with
+HASH_NAME = "pandas-siphash-1"
+
+
+def import_numpy():
+    """numpy is only needed (and only loaded) when an inventory is used."""
+    try:
+        import numpy as np
+    except ImportError:
+        raise Exception("numpy is needed to use S3 inventories (pip install aws-batch-helpers[inventory])")
+    return np
+
+
+def hash_keys(keys):
+    """Compact 64-bit hash of each of a list of S3 keys, computed in one pass."""
+    np = import_numpy()
+    # Only load pandas when an inventory is used
+    from pandas.util import hash_array
+    return hash_array(np.array(keys, dtype=object), categorize=False)
+
+
+def modified_time(last_modified):
+    """Epoch seconds of a LastModified value, which may be a datetime, an ISO 8601 string or a number."""
+    if isinstance(last_modified, (int, float)):
+        return float(last_modified)
+    if isinstance(last_modified, str):
+        last_modified = datetime.datetime.fromisoformat(last_modified.replace("Z", "+00:00"))
+    # S3 reports times in UTC
+    if last_modified.tzinfo is None:
+        last_modified = last_modified.replace(tzinfo=datetime.timezone.utc)
+    return last_modified.timestamp()
+
+
+class InventoryIndex:
+    """Sorted array of hashed object keys from one S3 Inventory snapshot."""
+
+    def __init__(self, bucket, hashes, snapshot_time):
+        self.bucket = bucket
+        self.hashes = hashes
+        # Objects created after this time (in seconds) are not in the index
+        self.snapshot_time = snapshot_time
+
+        # Folders which have changed since the snapshot, and are not trusted
+        self.changed_prefixes = set()
+
+    def contains(self, bucket, key):
+        """True if the object was present when the inventory was taken (and its folder hasn't changed)."""
+        if bucket != self.bucket or len(self.hashes) == 0:
+            return False
+        if (key.rsplit("/", 1)[0] if "/" in key else "") in self.changed_prefixes:
+            return False
+        h = hash_keys([key])[0]
+        ix = import_numpy().searchsorted(self.hashes, h)
+        return bool(ix < len(self.hashes) and self.hashes[ix] == h)
+
+    def prefix_changed(self, bucket, prefix, objects, missing_key=None):
+        """Check a fresh listing of a folder against the snapshot.
+
+        The folder has changed if any object was written since the snapshot,
+        or if `missing_key` (a key which is not in the listing) is in the
+        snapshot. From then on the snapshot is not trusted for that folder.
+        `objects` are as returned by ListObjectsV2 (with LastModified).
+        """
+        if bucket != self.bucket:
+            return False
+        prefix = prefix.rstrip("/")
+        if prefix in self.changed_prefixes:
+            return True
+        changed = missing_key is not None and self.contains(bucket, missing_key)
+        for obj in objects:
+            last_modified = obj.get("LastModified")
+            if last_modified is not None and modified_time(last_modified) > self.snapshot_time:
+                changed = True
+                break
+        if changed:
+            logging.info("s3://{}/{} has changed since the inventory was taken".format(bucket, prefix))
+            self.changed_prefixes.add(prefix)
+        return changed
+
+    def __len__(self):
+        return len(self.hashes)
+
+    @classmethod
+    def from_manifest(cls, manifest_path, prefixes=None):
+        """Read an inventory manifest.json (local or s3://) and all of its data files."""
+        logging.info("Reading S3 inventory from " + manifest_path)
+        manifest = json.loads(read_file(manifest_path).decode("utf-8"))
+
+        bucket = manifest["sourceBucket"]
+        file_format = manifest["fileFormat"]
+        assert file_format in ["CSV", "Parquet"], \
+            "Inventory format not supported: {}".format(file_format)
+
+        if prefixes is not None:
+            prefixes = tuple(prefixes)
+
+        hashes = []
+        for data_file in manifest["files"]:
+            data_path = locate_data_file(
+                manifest_path, manifest["destinationBucket"], data_file["key"]
+            )
+            if file_format == "CSV":
+                keys = read_csv_keys(data_path, manifest["fileSchema"])
+            else:
+                keys = read_parquet_keys(data_path)
+
+            keys = [
+                key for key in keys
+                if prefixes is None or key.startswith(prefixes)
+            ]
+            if len(keys) > 0:
+                hashes.append(hash_keys(keys))
+
+        np = import_numpy()
+        if len(hashes) > 0:
+            hashes = np.unique(np.concatenate(hashes))
+        else:
+            hashes = np.array([], dtype=np.uint64)
+        logging.info("Indexed {:,} objects in s3://{}".format(len(hashes), bucket))
+
+        return cls(
+            bucket,
+            hashes,
+            int(manifest["creationTimestamp"]) / 1000.
+        )
+
+    def save(self, fp):
+        """Write the index to disk so that it can be memory-mapped later."""
+        with open(fp, "wb") as fo:
+            import_numpy().save(fo, self.hashes)
+        with open(fp + ".json", "wt") as fo:
+            json.dump({
+                "bucket": self.bucket,
+                "snapshot_time": self.snapshot_time,
+                "hash": HASH_NAME
+            }, fo)
+
+    @classmethod
+    def load(cls, fp):
+        """Memory-map an index written by save()."""
+        meta = json.load(open(fp + ".json", "rt"))
+        assert meta.get("hash") == HASH_NAME, \
+            "{} was saved by an older version, and must be made again from the manifest".format(fp)
+        return cls(
+            meta["bucket"],
+            import_numpy().load(fp, mmap_mode="r"),
+            meta["snapshot_time"]
+        )
+
+
+def load_inventory(path, prefixes=None):
+    """Load an index from a saved .npy file or from an inventory manifest."""
+    if path.endswith(".npy"):
+        return InventoryIndex.load(path)
+    return InventoryIndex.from_manifest(path, prefixes=prefixes)
+
+
+def open_file(path):
+    """Open a local file or stream an S3 object, in binary mode."""
+    if path.startswith("s3://"):
+        bucket, key = path[5:].split("/", 1)
+        return get_client("s3").get_object(Bucket=bucket, Key=key)["Body"]
+    return open(path, "rb")
+
+
+def read_file(path):
+    """Read the bytes of a local file or an S3 object."""
+    f = open_file(path)
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def locate_data_file(manifest_path, destination_bucket, key):
+    """Find a data file next to the manifest, on S3 or in a local copy of the report."""
+    if manifest_path.startswith("s3://"):
+        # The destination is formatted as arn:aws:s3:::bucket
+        return "s3://{}/{}".format(destination_bucket.split(":")[-1], key)
+
+    # Local copies usually keep the data/ folder next to the dated manifest folder
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    file_name = key.rsplit("/", 1)[-1]
+    for candidate in [
+        os.path.join(manifest_dir, file_name),
+        os.path.join(manifest_dir, "data", file_name),
+        os.path.join(os.path.dirname(manifest_dir), "data", file_name),
+    ]:
+        if os.path.exists(candidate):
+            return candidate
+    raise Exception("Inventory data file not found: {}".format(file_name))
+
+
+def read_csv_keys(path, file_schema):
+    """Yield the (URL-decoded) keys of current objects from a gzipped CSV inventory file.
+
+    Inventories of versioned buckets also list old versions and delete
+    markers, which are skipped.
+    """
+    columns = [c.strip() for c in file_schema.split(",")]
+    key_ix = columns.index("Key")
+    latest_ix = columns.index("IsLatest") if "IsLatest" in columns else None
+    marker_ix = columns.index("IsDeleteMarker") if "IsDeleteMarker" in columns else None
+
+    raw = open_file(path)
+    try:
+        with gzip.GzipFile(fileobj=raw) as f:
+            for row in csv.reader(io.TextIOWrapper(f, encoding="utf-8")):
+                if latest_ix is not None and row[latest_ix].lower() == "false":
+                    continue
+                if marker_ix is not None and row[marker_ix].lower() == "true":
+                    continue
+                yield unquote_plus(row[key_ix])
+    finally:
+        raw.close()
+
+
+def read_parquet_keys(path):
+    """Return the keys of current objects from a Parquet inventory file (requires pyarrow)."""
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise Exception("pyarrow is needed to read Parquet inventory files")
+
+    f = pq.ParquetFile(io.BytesIO(read_file(path)))
+    names = f.schema_arrow.names
+    columns = [c for c in ["key", "is_latest", "is_delete_marker"] if c in names]
+    table = f.read(columns=columns).to_pydict()
+
+    # Skip old versions and delete markers
+    n_rows = len(table["key"])
+    is_latest = table.get("is_latest", [True] * n_rows)
+    is_delete_marker = table.get("is_delete_marker", [False] * n_rows)
+    return [
+        key
+        for key, latest, marker in zip(table["key"], is_latest, is_delete_marker)
+        if latest is not False and marker is not True
+    ]
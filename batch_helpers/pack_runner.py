@@ -0,0 +1,100 @@
+"""Run each sample in the manifest of a packed job (`samples_per_job`), inside the container.
+
+Usage: python3 -m batch_helpers.pack_runner s3://bucket/path/manifest.json [--parallel N]
+
+Samples whose outputs all exist already (e.g. when a failed pack is
+retried by Batch) are skipped, and each sample's command is killed if it
+runs for longer than the manifest's `timeout` (in seconds). The exit code is non-zero if any sample's
+command failed or did not write all of its outputs, so that the outputs
+of the other samples are kept and only the failed samples are resubmitted.
+"""
+import sys
+import json
+import logging
+import argparse
+from batch_helpers.aws import get_client
+from batch_helpers.helpers import run_cmds_parallel, s3_paths_exist
+
+
+def read_manifest(path):
+    """Load a manifest from S3 or a local file."""
+    if path.startswith("s3://"):
+        bucket, key = path[5:].split("/", 1)
+        r = get_client("s3").get_object(Bucket=bucket, Key=key)
+        return json.loads(r["Body"].read().decode("utf-8"))
+    return json.load(open(path, "rt"))
+
+
+def run_manifest(manifest, parallel=None, retry=0):
+    """Run the command for each sample which is missing outputs, returning the samples which failed."""
+    samples = manifest["samples"]
+    if parallel is None:
+        parallel = manifest.get("parallel", 1)
+
+    exists = s3_paths_exist([fp for s in samples for fp in s["outputs"]])
+    to_run = [
+        s for s in samples
+        if not all([exists[fp] for fp in s["outputs"]])
+    ]
+    logging.info("Running {:,} of {:,} samples ({:,} at a time)".format(
+        len(to_run), len(samples), parallel
+    ))
+    if len(to_run) == 0:
+        return []
+
+    exitcodes = run_cmds_parallel(
+        [s["command"] for s in to_run],
+        n_cpus=parallel,
+        retry=retry,
+        catchExcept=True,
+        timeout=manifest.get("timeout")
+    )
+
+    # A sample has only finished once all of its outputs exist
+    exists = s3_paths_exist([fp for s in to_run for fp in s["outputs"]])
+    failed = []
+    for s, exitcode in zip(to_run, exitcodes):
+        missing = [fp for fp in s["outputs"] if not exists[fp]]
+        if exitcode != 0 or len(missing) > 0:
+            logging.info("Sample {} failed (exit code {}, {:,} outputs missing)".format(
+                s["sample"], exitcode, len(missing)
+            ))
+            failed.append(s["sample"])
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""
+    Run each of the samples in a packed job's manifest.
+    """)
+
+    parser.add_argument("manifest",
+                        type=str,
+                        help="""Path to the manifest (JSON) on S3 or local""")
+    parser.add_argument("--parallel",
+                        type=int,
+                        default=None,
+                        help="""Number of samples to run at a time (default: from the manifest)""")
+    parser.add_argument("--retry",
+                        type=int,
+                        default=0,
+                        help="""Number of times to retry each sample's command""")
+
+    args = parser.parse_args(sys.argv[1:])
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)-8s [Packed job] %(message)s'
+    )
+
+    manifest = read_manifest(args.manifest)
+    failed = run_manifest(manifest, parallel=args.parallel, retry=args.retry)
+    if len(failed) > 0:
+        sys.exit("{:,} of {:,} samples failed: {}".format(
+            len(failed), len(manifest["samples"]), ", ".join(failed)
+        ))
+    logging.info("All {:,} samples finished".format(len(manifest["samples"])))
+
+
+if __name__ == "__main__":
+    main()
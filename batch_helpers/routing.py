@@ -0,0 +1,121 @@
+"""Spread job submissions across several eligible job queues."""
+import time
+import statistics
+import threading
+from collections import defaultdict
+from batch_helpers.aws import get_client
+
+# Jobs waiting in a queue, including those submitted but not yet RUNNABLE
+QUEUED_STATUSES = ["RUNNABLE", "PENDING", "SUBMITTED"]
+
+
+def queue_list(queues):
+    """A job queue, or a list of them, as a list."""
+    if isinstance(queues, str):
+        return [queues]
+    assert len(queues) > 0, "Must specify at least one job queue"
+    return list(queues)
+
+
+class QueueRouter:
+    """Choose the least busy of a set of job queues for each job.
+
+    Each queue is scored by its depth (the number of SUBMITTED, PENDING and
+    RUNNABLE jobs) plus `latency_weight` jobs for every minute that recently
+    started jobs waited between being created and starting, and the job is
+    sent to the queue with the lowest score. The depth and start latency of
+    each queue are looked up at most once every `ttl` seconds. In between,
+    each job routed to a queue is added to its depth, so that a burst of
+    submissions is spread across the queues rather than all sent to the one
+    which was least busy at the last lookup. Jobs routed just before a
+    lookup are counted by it, as Batch lists them as SUBMITTED or PENDING
+    until they are RUNNABLE.
+    """
+
+    def __init__(self, ttl=60, latency_weight=1.0, latency_sample=100, max_depth=2000):
+        self.ttl = ttl
+        self.latency_weight = latency_weight
+        # Number of RUNNING jobs used to estimate the start latency
+        self.latency_sample = latency_sample
+        # Stop counting the jobs in a queue after this many, as it is busy either way
+        self.max_depth = max_depth
+
+        # Keyed by queue: (time looked up, queued jobs, start latency in seconds)
+        self.lookups = {}
+        # Jobs routed to each queue since it was last looked up, and in total
+        self.pending = defaultdict(int)
+        self.n_routed = defaultdict(int)
+
+        self.lock = threading.Lock()
+        self.client = get_client("batch")
+
+    def choose(self, queues):
+        """The queue to submit the next job to, from a queue or list of eligible queues."""
+        queues = queue_list(queues)
+        with self.lock:
+            if len(queues) == 1:
+                queue = queues[0]
+            else:
+                # Ties go to the queue listed first
+                queue = min(queues, key=self.score)
+            self.pending[queue] += 1
+            self.n_routed[queue] += 1
+        return queue
+
+    def score(self, queue):
+        queued, latency = self.lookup(queue)
+        return queued + self.pending[queue] + self.latency_weight * latency / 60.
+
+    def lookup(self, queue):
+        """The (queued jobs, start latency) of a queue, if looked up within the TTL."""
+        cached = self.lookups.get(queue)
+        if cached is None or time.time() - cached[0] > self.ttl:
+            cached = (time.time(), self.count_queued(queue), self.start_latency(queue))
+            self.lookups[queue] = cached
+            self.pending[queue] = 0
+        return cached[1], cached[2]
+
+    def count_queued(self, queue):
+        """Number of jobs waiting in a queue, counting at most max_depth."""
+        n = 0
+        for status in QUEUED_STATUSES:
+            kwargs = {"jobQueue": queue, "jobStatus": status, "maxResults": 1000}
+            while n < self.max_depth:
+                r = self.client.list_jobs(**kwargs)
+                n += len(r["jobSummaryList"])
+                if r.get("nextToken") is None:
+                    break
+                kwargs["nextToken"] = r["nextToken"]
+        return min(n, self.max_depth)
+
+    def start_latency(self, queue):
+        """Median seconds between creation and starting for a sample of RUNNING jobs.
+
+        Jobs which waited on dependencies count that time as well, so this
+        is only useful for comparing queues running similar workflows.
+        """
+        r = self.client.list_jobs(
+            jobQueue=queue,
+            jobStatus="RUNNING",
+            maxResults=self.latency_sample
+        )
+        waits = [
+            (j["startedAt"] - j["createdAt"]) / 1000.
+            for j in r["jobSummaryList"]
+            if j.get("startedAt") is not None and j.get("createdAt") is not None
+        ]
+        if len(waits) == 0:
+            return 0
+        return statistics.median(waits)
+
+    def stats(self):
+        """Last known depth and start latency of each queue, and the jobs routed to it."""
+        with self.lock:
+            return {
+                queue: {
+                    "queued": queued,
+                    "start_latency": round(latency, 1),
+                    "routed": self.n_routed[queue],
+                }
+                for queue, (_, queued, latency) in self.lookups.items()
+            }
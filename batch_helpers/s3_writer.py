@@ -0,0 +1,163 @@
+"""Stream data to S3 with a multipart upload, compressing it on the fly."""
+import zlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from batch_helpers.aws import get_client
+
+# S3 requires every part except the last to be at least 5MB
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class S3Writer:
+    """File-like object which uploads to S3 in parts as data is written.
+
+    At most `max_pending` parts are held in memory at once, so memory use
+    is about part_size * max_pending no matter how much is written.
+    """
+
+    def __init__(
+        self,
+        s3_path,
+        compression=None,
+        part_size=16 * 1024 * 1024,
+        n_threads=4,
+        max_pending=None,
+    ):
+        assert s3_path.startswith("s3://")
+        self.bucket, self.key = s3_path[5:].split("/", 1)
+        self.client = get_client("s3")
+
+        assert part_size >= MIN_PART_SIZE, "Parts must be at least 5MB"
+        self.part_size = part_size
+
+        # Set up the compression
+        assert compression in [None, "gzip", "zstd"], \
+            "Compression not supported: {}".format(compression)
+        if compression == "gzip":
+            # wbits=31 writes a gzip header and trailer
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        elif compression == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise Exception("zstandard is needed for zstd compression")
+            self.compressor = zstandard.ZstdCompressor().compressobj()
+        else:
+            self.compressor = None
+
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.futures = []
+        self.pool = ThreadPoolExecutor(max_workers=n_threads)
+        self.pending = threading.BoundedSemaphore(
+            max_pending if max_pending is not None else 2 * n_threads
+        )
+        self.closed = False
+
+    def write(self, data):
+        """Add str or bytes to the object."""
+        assert not self.closed, "Writer is closed"
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        n_bytes = len(data)
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.buffer.extend(data)
+
+        while len(self.buffer) >= self.part_size:
+            self.upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return n_bytes
+
+    def writelines(self, lines):
+        """Add each item of an iterable of str or bytes."""
+        for line in lines:
+            self.write(line)
+
+    def upload_part(self, data):
+        """Upload a single part in the background."""
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key
+            )["UploadId"]
+
+        # Wait for an earlier part to finish if too many are in memory
+        self.pending.acquire()
+        part_number = len(self.futures) + 1
+        self.futures.append(
+            self.pool.submit(self._upload_part, part_number, data)
+        )
+
+    def _upload_part(self, part_number, data):
+        try:
+            r = self.client.upload_part(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                PartNumber=part_number,
+                Body=data
+            )
+            return {"PartNumber": part_number, "ETag": r["ETag"]}
+        finally:
+            self.pending.release()
+
+    def close(self):
+        """Finish the upload."""
+        if self.closed:
+            return
+        self.closed = True
+
+        if self.compressor is not None:
+            self.buffer.extend(self.compressor.flush())
+
+        try:
+            # Small objects are written with a single request
+            if self.upload_id is None:
+                self.client.put_object(
+                    Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer)
+                )
+                return
+
+            if len(self.buffer) > 0:
+                self.upload_part(bytes(self.buffer))
+            self.buffer = bytearray()
+
+            parts = [future.result() for future in self.futures]
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": parts}
+            )
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self.pool.shutdown(wait=True)
+
+    def abort(self):
+        """Cancel the upload, removing any parts already uploaded."""
+        self.closed = True
+        # Let any parts in progress finish before removing them
+        self.pool.shutdown(wait=True)
+        if self.upload_id is not None:
+            logging.info("Aborting upload to s3://{}/{}".format(self.bucket, self.key))
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+            )
+            self.upload_id = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+def open_s3_writer(s3_path, compression=None, **kwargs):
+    """Open an S3 object for streaming writes, e.g. `with open_s3_writer(path) as f:`."""
+    return S3Writer(s3_path, compression=compression, **kwargs)
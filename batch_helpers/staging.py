@@ -0,0 +1,218 @@
+"""Host-local cache of S3 inputs, shared by all of the containers on a host.
+
+Objects are stored under the cache directory keyed by their ETag, size and
+file name, so an object used by several tasks on the same host is only downloaded
+once. Containers coordinate with file locks: code using a staged file holds
+a shared lock on the entry, so that any number of containers can read it at
+once while it is kept from being evicted, and a download holds an exclusive
+lock on a separate file so that only one container fetches each object.
+"""
+import os
+import fcntl
+import shutil
+import hashlib
+import logging
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from batch_helpers.aws import get_client
+
+# Environment variable pointing to the (host-mounted) cache directory
+CACHE_DIR_ENV = "BATCH_HELPERS_CACHE_DIR"
+
+
+def stage_s3_input(s3_path, cache_dir=None, **kwargs):
+    """Download an S3 object into the shared cache (if needed) and return its local path.
+
+    The file is no longer protected once this returns, so another container
+    enforcing `max_cache_bytes` may evict it while it is still being read.
+    Use `with staged_s3_input(...)` unless the cache is never evicted.
+    """
+    with staged_s3_input(s3_path, cache_dir=cache_dir, **kwargs) as local_path:
+        return local_path
+
+
+@contextmanager
+def staged_s3_input(
+    s3_path,
+    cache_dir=None,
+    max_cache_bytes=None,
+    part_size=64 * 1024 * 1024,
+    n_threads=8,
+    max_attempts=5,
+):
+    """Stage an S3 object, keeping it from being evicted until the block exits."""
+    assert s3_path.startswith("s3://")
+    bucket, key = s3_path[5:].split("/", 1)
+
+    if cache_dir is None:
+        cache_dir = os.environ.get(CACHE_DIR_ENV)
+    assert cache_dir is not None, \
+        "Specify cache_dir or set ${}".format(CACHE_DIR_ENV)
+
+    # If the object is overwritten while it is downloaded, start again with the new version
+    for _ in range(max_attempts):
+        lock, head, entry, local_path = lock_entry(cache_dir, bucket, key)
+        try:
+            fetch(s3_path, bucket, key, head, entry, local_path, part_size, n_threads)
+        except ObjectChanged:
+            lock.close()
+            logging.info("{} changed while it was downloaded, retrying".format(s3_path))
+            continue
+        except BaseException:
+            lock.close()
+            raise
+        break
+    else:
+        raise Exception("{} kept changing while it was downloaded".format(s3_path))
+
+    with lock:
+        # Mark the entry as recently used
+        os.utime(os.path.join(entry, ".complete"))
+
+        if max_cache_bytes is not None:
+            evict(cache_dir, max_cache_bytes)
+
+        yield local_path
+
+
+class ObjectChanged(Exception):
+    """The object no longer has the ETag it had when the download started."""
+
+
+def lock_entry(cache_dir, bucket, key):
+    """Find the entry for the current version of an object, and take a shared lock on it.
+
+    The shared lock is held while the file is in use, which any number of
+    containers can hold at once, and which stops it from being evicted.
+    Returns the open lock file, the HeadObject response, the entry directory
+    and the path of the file in the entry.
+    """
+    # The entry is keyed by the content (ETag and size) rather than the
+    # full path, keeping the file name so that tools see the same extension
+    head = get_client("s3").head_object(Bucket=bucket, Key=key)
+    file_name = key.rsplit("/", 1)[-1]
+    entry = os.path.join(cache_dir, hashlib.sha256(
+        "{}-{}-{}".format(head["ETag"], head["ContentLength"], file_name).encode("utf-8")
+    ).hexdigest())
+    lock_path = os.path.join(entry, ".lock")
+
+    while True:
+        os.makedirs(entry, exist_ok=True)
+        try:
+            lock = open(lock_path, "a")
+        except FileNotFoundError:
+            continue
+        fcntl.flock(lock, fcntl.LOCK_SH)
+
+        # The entry may have been evicted (and its lock file removed) while waiting
+        try:
+            if os.stat(lock_path).st_ino == os.fstat(lock.fileno()).st_ino:
+                return lock, head, entry, os.path.join(entry, file_name)
+        except FileNotFoundError:
+            pass
+        lock.close()
+
+
+def fetch(s3_path, bucket, key, head, entry, local_path, part_size, n_threads):
+    """Download the object into its entry, unless another container already has."""
+    complete = os.path.join(entry, ".complete")
+    if os.path.exists(complete):
+        logging.info("Using cached copy of {}".format(s3_path))
+        return
+
+    # Only one container downloads the object, the others wait for it
+    with open(os.path.join(entry, ".download.lock"), "a") as download_lock:
+        fcntl.flock(download_lock, fcntl.LOCK_EX)
+        if os.path.exists(complete):
+            logging.info("Using cached copy of {}".format(s3_path))
+            return
+        logging.info("Staging {} in {}".format(s3_path, entry))
+        download(bucket, key, head["ETag"], head["ContentLength"], local_path, part_size, n_threads)
+        open(complete, "w").close()
+
+
+def download(bucket, key, etag, size, local_path, part_size, n_threads):
+    """Download an object, using parallel ranged GETs for large objects.
+
+    Every GET must match the ETag, so that the parts all come from the same
+    version; ObjectChanged is raised if the object has been overwritten.
+    """
+    tmp_path = local_path + ".tmp"
+    client = get_client("s3")
+
+    def get_object(**kwargs):
+        try:
+            return client.get_object(Bucket=bucket, Key=key, IfMatch=etag, **kwargs)["Body"]
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ["PreconditionFailed", "412"]:
+                raise ObjectChanged(etag)
+            raise
+
+    try:
+        if size <= part_size:
+            with open(tmp_path, "wb") as fo:
+                shutil.copyfileobj(get_object(), fo)
+        else:
+            with open(tmp_path, "wb") as fo:
+                fo.truncate(size)
+
+            def get_range(start):
+                end = min(start + part_size, size) - 1
+                body = get_object(Range="bytes={}-{}".format(start, end))
+                fd = os.open(tmp_path, os.O_WRONLY)
+                try:
+                    offset = start
+                    for chunk in body.iter_chunks(1024 * 1024):
+                        os.pwrite(fd, chunk, offset)
+                        offset += len(chunk)
+                finally:
+                    os.close(fd)
+
+            with ThreadPoolExecutor(max_workers=n_threads) as pool:
+                list(pool.map(get_range, range(0, size, part_size)))
+    except BaseException:
+        # Never leave part of an object behind to be mistaken for the whole
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    os.rename(tmp_path, local_path)
+
+
+def evict(cache_dir, max_cache_bytes):
+    """Remove the least recently used entries until the cache fits in max_cache_bytes."""
+    # Only one container evicts at a time
+    with open(os.path.join(cache_dir, ".evict.lock"), "a") as evict_lock:
+        fcntl.flock(evict_lock, fcntl.LOCK_EX)
+        _evict(cache_dir, max_cache_bytes)
+
+
+def _evict(cache_dir, max_cache_bytes):
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        marker = os.path.join(entry, ".complete")
+        if not os.path.exists(marker):
+            continue
+        size = sum([
+            os.path.getsize(os.path.join(entry, fn))
+            for fn in os.listdir(entry)
+        ])
+        entries.append((os.path.getmtime(marker), size, entry))
+
+    total = sum([size for _, size, _ in entries])
+    for _, size, entry in sorted(entries):
+        if total <= max_cache_bytes:
+            break
+        with open(os.path.join(entry, ".lock"), "a") as lock:
+            # Skip entries which are being downloaded or used
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                continue
+            logging.info("Evicting {} from the cache".format(entry))
+            # The lock files go too; containers waiting on them find that the
+            # lock file has been removed and start the entry again
+            shutil.rmtree(entry, ignore_errors=True)
+        total -= size
@@ -0,0 +1,70 @@
+"""Print small tables of counts without importing pandas or tabulate."""
+
+
+def format_table(rows, headers, align_right=False):
+    """Format a list of rows as text, in the same layout as tabulate's "simple" format.
+
+    Numbers are aligned to the right, as is everything after the first
+    column if align_right.
+    """
+    rows = [[_format_value(v) for v in row] for row in rows]
+    headers = [str(h) for h in headers]
+
+    numeric = [
+        (align_right and ix > 0) or
+        (all([isinstance(row[ix], _Number) for row in rows]) and len(rows) > 0)
+        for ix in range(len(headers))
+    ]
+    widths = [
+        max([len(headers[ix])] + [len(row[ix]) for row in rows])
+        for ix in range(len(headers))
+    ]
+
+    def format_row(values):
+        return "  ".join([
+            v.rjust(w) if is_numeric else v.ljust(w)
+            for v, w, is_numeric in zip(values, widths, numeric)
+        ]).rstrip()
+
+    lines = [format_row(headers), "  ".join(["-" * w for w in widths])]
+    lines.extend([format_row(row) for row in rows])
+    return "\n".join(lines)
+
+
+def count_table(counts, index_header="", sort_by=None, sort_index=False):
+    """Format nested counts ({row: {column: n}}) as a table, filling gaps with 0.
+
+    Columns are in the order they first appear. Rows are sorted by their
+    name if sort_index, or in descending order of the column sort_by.
+    """
+    columns = []
+    for row_counts in counts.values():
+        for column in row_counts:
+            if column not in columns:
+                columns.append(column)
+
+    names = list(counts.keys())
+    if sort_index:
+        names = sorted(names)
+    if sort_by is not None and sort_by in columns:
+        names = sorted(names, key=lambda name: -counts[name].get(sort_by, 0))
+
+    return format_table(
+        [
+            [name] + [counts[name].get(column, 0) for column in columns]
+            for name in names
+        ],
+        [index_header] + columns
+    )
+
+
+class _Number(str):
+    """A formatted number, which is aligned to the right."""
+
+
+def _format_value(v):
+    if isinstance(v, bool) or not isinstance(v, (int, float)):
+        return str(v)
+    if isinstance(v, float) and v.is_integer():
+        v = int(v)
+    return _Number(v)
@@ -0,0 +1,160 @@
+"""Cancel or terminate many Batch jobs at once, with one API call per job."""
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from batch_helpers.aws import get_client
+from batch_project.profiling import span
+from batch_project.refresh import DESCRIBE_PAGE, TERMINAL_STATUSES
+
+# Jobs which have not been placed on an instance yet are cancelled...
+CANCEL_STATUSES = ["SUBMITTED", "PENDING", "RUNNABLE"]
+# ...while those which have are terminated
+TERMINATE_STATUSES = ["STARTING", "RUNNING"]
+
+
+class RateLimiter:
+    """Allow at most `per_second` calls per second, shared between threads."""
+
+    def __init__(self, per_second):
+        assert per_second is None or per_second > 0, "Rate must be positive"
+        self.interval = 1. / per_second if per_second is not None else 0
+        self.next_call = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if self.interval == 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait_until = max(self.next_call, now)
+            self.next_call = wait_until + self.interval
+        if wait_until > now:
+            time.sleep(wait_until - now)
+
+
+class BulkCanceller:
+    """Cancel or terminate jobs in a rate-limited thread pool.
+
+    Each job is sent to CancelJob or TerminateJob depending on its last
+    known status, and jobs which have finished or were already handled are
+    skipped. Cancelled jobs are described afterwards, so that any which
+    started in the meantime (and which CancelJob leaves running) are
+    terminated.
+    """
+
+    def __init__(self, reason, n_threads=8, max_per_second=20, progress_every=1000):
+        self.reason = reason
+        self.n_threads = n_threads
+        self.limiter = RateLimiter(max_per_second)
+        self.progress_every = progress_every
+        self.client = get_client("batch")
+
+        # Job IDs which have been cancelled or terminated, and their new status
+        self.handled = set()
+        self.stopped = {}
+        # Job IDs and the error raised when they could not be stopped
+        self.errors = {}
+
+    def call(self, operation, job_id):
+        self.limiter.wait()
+        with span("Batch calls"):
+            if operation == "cancel":
+                self.client.cancel_job(jobId=job_id, reason=self.reason)
+            else:
+                self.client.terminate_job(jobId=job_id, reason=self.reason)
+        return job_id
+
+    def run(self, jobs):
+        """Stop each of the (job ID, status) pairs, returning {job ID: "CANCELED"} for those stopped.
+
+        If interrupted, the jobs stopped so far are still in self.stopped.
+        """
+        # Keep the last status seen for each job, and skip those which cannot be stopped
+        statuses = {}
+        for job_id, status in jobs:
+            statuses[job_id] = status
+        to_cancel = []
+        to_terminate = []
+        for job_id, status in statuses.items():
+            if job_id in self.handled or status in TERMINAL_STATUSES:
+                continue
+            elif status in CANCEL_STATUSES:
+                to_cancel.append(job_id)
+            else:
+                # TerminateJob stops a job in any status
+                to_terminate.append(job_id)
+
+        self.submit(
+            [("cancel", job_id) for job_id in to_cancel] +
+            [("terminate", job_id) for job_id in to_terminate]
+        )
+
+        # Terminate any jobs which started before they could be cancelled
+        started = self.find_started([job_id for job_id in to_cancel if job_id in self.handled])
+        if len(started) > 0:
+            print("Terminating {:,} jobs which started before they were cancelled".format(
+                len(started)
+            ))
+            self.submit([("terminate", job_id) for job_id in started])
+
+        if len(self.errors) > 0:
+            print("Could not stop {:,} jobs, e.g. {}: {}".format(
+                len(self.errors), *list(self.errors.items())[0]
+            ))
+        return self.stopped
+
+    def submit(self, calls):
+        """Make each (operation, job ID) call, printing progress as they finish."""
+        if len(calls) == 0:
+            return
+
+        start = time.time()
+        n_done = 0
+        with ThreadPoolExecutor(max_workers=self.n_threads) as pool:
+            futures = {
+                pool.submit(self.call, operation, job_id): job_id
+                for operation, job_id in calls
+            }
+            try:
+                for future in as_completed(futures):
+                    job_id = futures[future]
+                    n_done += 1
+                    try:
+                        future.result()
+                    except Exception as e:
+                        self.errors[job_id] = e
+                    else:
+                        self.handled.add(job_id)
+                        self.errors.pop(job_id, None)
+                        self.stopped[job_id] = "CANCELED"
+                    if n_done % self.progress_every == 0 or n_done == len(calls):
+                        print("Stopped {:,} / {:,} jobs ({:,.1f} per second)".format(
+                            n_done, len(calls), n_done / max(time.time() - start, 1e-6)
+                        ))
+            except KeyboardInterrupt:
+                # Don't start any more calls
+                for future in futures:
+                    future.cancel()
+                print("Interrupted after stopping {:,} jobs".format(len(self.stopped)))
+                raise
+
+    def find_started(self, job_ids):
+        """Jobs in job_ids which are now STARTING or RUNNING."""
+        started = []
+        for ix in range(0, len(job_ids), DESCRIBE_PAGE):
+            with span("Batch calls"):
+                r = self.client.describe_jobs(jobs=job_ids[ix:ix + DESCRIBE_PAGE])
+            started.extend([
+                j["jobId"] for j in r["jobs"]
+                if j["status"] in TERMINATE_STATUSES
+            ])
+        return started
+
+
+def cancel_jobs(jobs, reason, n_threads=8, max_per_second=20):
+    """Stop a list of (job ID, status) pairs, returning {job ID: "CANCELED"} for those stopped."""
+    return BulkCanceller(
+        reason,
+        n_threads=n_threads,
+        max_per_second=max_per_second
+    ).run(jobs)
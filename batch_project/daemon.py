@@ -0,0 +1,313 @@
+"""Local daemon keeping project status up to date, served to the CLI over a Unix socket.
+
+The daemon shares one set of AWS clients, S3 folder listings and job events
+between every query, and refreshes the workflows and queues which have been
+asked about in the background, so that `batch_project status`,
+`batch_dashboard` and `batch_queue_status` can answer straight away.
+
+Requests and responses are single lines of JSON, e.g.
+{"cmd": "status", "workflow": "/path/to/workflow.json"}.
+"""
+import os
+import json
+import time
+import socket
+import threading
+import socketserver
+from collections import defaultdict
+from batch_project.lib import get_workflow_status, valid_workflow
+from batch_project.lib import find_workflow_files, QueueWatch
+
+# Environment variable with the path of the socket
+SOCKET_ENV = "BATCH_PROJECT_SOCKET"
+
+
+def default_socket_path():
+    return os.environ.get(
+        SOCKET_ENV,
+        os.path.join(os.path.expanduser("~"), ".batch_project", "daemon.sock")
+    )
+
+
+def daemon_request(request, socket_path=None, timeout=600):
+    """Send a request to the daemon, returning its result (or None if no daemon is running)."""
+    if socket_path is None:
+        socket_path = default_socket_path()
+    if not os.path.exists(socket_path):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        # Give up quickly if the daemon is not there
+        sock.settimeout(1)
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            return None
+
+        # A new workflow may need to be checked before the daemon can answer
+        sock.settimeout(timeout)
+        sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        with sock.makefile("rb") as f:
+            line = f.readline()
+    finally:
+        sock.close()
+
+    if len(line) == 0:
+        return None
+    response = json.loads(line.decode("utf-8"))
+    if not response["ok"]:
+        raise Exception("Status daemon: {}".format(response["error"]))
+    return response["result"]
+
+
+class StatusDaemon:
+    """Cached status of workflows and queues, refreshed in the background."""
+
+    def __init__(
+        self,
+        socket_path=None,
+        refresh_interval=60,
+        stopped_seconds=600,
+        full_listing_interval=600,
+        s3_contents=None,
+        job_events=None,
+    ):
+        self.socket_path = socket_path if socket_path is not None else default_socket_path()
+
+        # Cached results are served until they are older than this (in seconds)
+        self.refresh_interval = refresh_interval
+
+        # Seconds of stop times kept for each queue (unless a client asks
+        # for more), from which the finishing rate is worked out
+        self.stopped_seconds = stopped_seconds
+        # Seconds between listing every finished job in a queue
+        self.full_listing_interval = full_listing_interval
+
+        # Shared by every workflow
+        self.s3_contents = s3_contents
+        self.job_events = job_events
+
+        # Keyed by path: {"mtime", "updated", "completed", "counts"}
+        self.workflows = {}
+        # Keyed by (queue, statuses): {"updated", "counts", "stopped"}
+        self.queues = {}
+        # Keyed by (queue, statuses): the QueueWatch and seconds of stop times kept
+        self.queue_watches = {}
+        self.queue_stopped_seconds = {}
+
+        # Guards the cached workflows and queues
+        self.lock = threading.Lock()
+        # Each workflow (or queue) is refreshed by one thread at a time,
+        # while different workflows can be refreshed at the same time
+        self.refresh_locks = defaultdict(threading.RLock)
+        self.stopped = threading.Event()
+
+    # Queries
+
+    def handle(self, request):
+        """Answer a single request."""
+        if request["cmd"] == "status":
+            return self.workflow_status(
+                os.path.abspath(request["workflow"]),
+                force_check=request.get("force_check", False)
+            )
+        elif request["cmd"] == "dashboard":
+            return self.dashboard(request["root"])
+        elif request["cmd"] == "queue_status":
+            return self.queue_status(
+                request["queue"],
+                request["job_status"],
+                stopped_seconds=request.get("stopped_seconds")
+            )
+        elif request["cmd"] == "ping":
+            with self.lock:
+                return {
+                    "workflows": len(self.workflows),
+                    "queues": len(self.queues),
+                }
+        raise Exception("Unknown command: {}".format(request["cmd"]))
+
+    def workflow_status(self, fp, force_check=False):
+        """Status counts for a workflow, from the cache if they are recent."""
+        with self.refresh_lock(fp):
+            with self.lock:
+                cached = self.workflows.get(fp)
+            if not force_check and cached is not None and \
+                    cached["mtime"] == os.path.getmtime(fp) and \
+                    time.time() - cached["updated"] < self.refresh_interval:
+                return cached["counts"]
+            return self.refresh_workflow(fp, force_check=force_check)
+
+    def refresh_lock(self, key):
+        """Lock held while a workflow (by path) or queue (by key) is refreshed."""
+        with self.lock:
+            return self.refresh_locks[key]
+
+    def refresh_workflow(self, fp, force_check=False):
+        with self.refresh_lock(fp):
+            counts = dict(get_workflow_status(
+                fp,
+                force_check=force_check,
+                s3_contents=self.s3_contents,
+                job_events=self.job_events
+            ))
+            config = json.load(open(fp, "rt"))
+            with self.lock:
+                self.workflows[fp] = {
+                    "mtime": os.path.getmtime(fp),
+                    "updated": time.time(),
+                    "completed": config["status"] == "COMPLETED",
+                    "counts": counts,
+                }
+            return counts
+
+    def dashboard(self, root):
+        """Status of every project under a folder, as used by batch_dashboard."""
+        projects = {}
+        n_completed = 0
+        for fp in find_workflow_files(root):
+            with self.lock:
+                cached = self.workflows.get(fp)
+            if cached is None or cached["mtime"] != os.path.getmtime(fp):
+                try:
+                    config = json.load(open(fp, "rt"))
+                except ValueError:
+                    raise Exception("Cannot open {}".format(fp))
+                if not valid_workflow(config, verbose=False):
+                    continue
+                if config["status"] == "COMPLETED":
+                    with self.lock:
+                        self.workflows[fp] = {
+                            "mtime": os.path.getmtime(fp),
+                            "updated": time.time(),
+                            "completed": True,
+                            "counts": {"COMPLETED": len(config["jobs"])},
+                        }
+                    n_completed += 1
+                    continue
+            elif cached["completed"]:
+                n_completed += 1
+                continue
+            projects[fp] = self.workflow_status(fp)
+        return {"projects": projects, "completed": n_completed}
+
+    def queue_status(self, queue, job_status, stopped_seconds=None):
+        """Number of jobs in a queue by status, when they were listed and when the finished jobs stopped.
+
+        Stop times are kept for at least `stopped_seconds`, if given.
+        """
+        key = (queue, tuple(job_status))
+        with self.refresh_lock(key):
+            with self.lock:
+                cached = self.queues.get(key)
+                # Listed again straight away if more stop times are needed
+                kept = self.queue_stopped_seconds.get(key, self.stopped_seconds)
+                if stopped_seconds is not None and stopped_seconds > kept:
+                    self.queue_stopped_seconds[key] = stopped_seconds
+                    cached = None
+            if cached is None or time.time() - cached["updated"] >= self.refresh_interval:
+                cached = self.refresh_queue(key)
+            return cached
+
+    def refresh_queue(self, key):
+        with self.refresh_lock(key):
+            with self.lock:
+                if key not in self.queue_watches:
+                    self.queue_watches[key] = QueueWatch(
+                        key[0], list(key[1]), full_interval=self.full_listing_interval
+                    )
+                watch = self.queue_watches[key]
+                stopped_seconds = self.queue_stopped_seconds.get(key, self.stopped_seconds)
+
+            # Jobs stopping while the queue is listed are counted from the next refresh
+            updated = time.time()
+            counts, stopped = watch.refresh(stopped_after=updated - stopped_seconds)
+            cached = {"updated": updated, "counts": dict(counts), "stopped": stopped}
+            with self.lock:
+                self.queues[key] = cached
+            return cached
+
+    # Background refresh
+
+    def refresh_all(self):
+        """Refresh every unfinished workflow and every queue asked about."""
+        with self.lock:
+            workflows = list(self.workflows.items())
+            queues = list(self.queues.keys())
+        for fp, cached in workflows:
+            if cached["completed"]:
+                continue
+            if not os.path.exists(fp):
+                with self.lock:
+                    self.workflows.pop(fp, None)
+                    self.refresh_locks.pop(fp, None)
+                continue
+            try:
+                self.refresh_workflow(fp)
+            except Exception as e:
+                print("Could not refresh {}: {}".format(fp, e))
+        for key in queues:
+            try:
+                self.refresh_queue(key)
+            except Exception as e:
+                print("Could not refresh {}: {}".format(key[0], e))
+
+    def poll(self):
+        while not self.stopped.wait(self.refresh_interval):
+            self.refresh_all()
+
+    # Serving
+
+    def serve_forever(self):
+        """Listen on the socket until interrupted."""
+        # Another daemon may already be running
+        if daemon_request({"cmd": "ping"}, socket_path=self.socket_path) is not None:
+            raise Exception("A status daemon is already listening on {}".format(self.socket_path))
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        # Only the current user can connect to the socket
+        folder = os.path.dirname(self.socket_path)
+        if len(folder) > 0 and not os.path.exists(folder):
+            os.makedirs(folder, mode=0o700)
+        old_umask = os.umask(0o077)
+        try:
+            server = _Server(self.socket_path, _Handler)
+        finally:
+            os.umask(old_umask)
+        server.daemon = self
+
+        poller = threading.Thread(target=self.poll, daemon=True)
+        poller.start()
+
+        print("Serving status on {} (refreshing every {:,} seconds)".format(
+            self.socket_path, self.refresh_interval
+        ))
+        try:
+            server.serve_forever()
+        finally:
+            self.stopped.set()
+            server.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline()
+        if len(line) == 0:
+            return
+        try:
+            response = {
+                "ok": True,
+                "result": self.server.daemon.handle(json.loads(line.decode("utf-8"))),
+            }
+        except Exception as e:
+            response = {"ok": False, "error": str(e)}
+        self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
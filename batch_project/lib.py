@@ -2,10 +2,25 @@
 import os
 import json
 import re
-import boto3
+import time
+import fcntl
 import argparse
-import pandas as pd
+from contextlib import contextmanager
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from batch_helpers.analytics import job_times, jobs_frame, timing_report
+from batch_helpers.aws import get_client
+from batch_helpers.cache import FolderCache
+from batch_helpers.events import EventConsumer, job_status_moved_on
+from batch_helpers.existence_store import open_existence_store
+from batch_helpers.routing import QueueRouter, queue_list
+from batch_project.cancel import BulkCanceller
+from batch_project.logs import LogHarvester, stream_is_final
+from batch_project.packing import MAX_DEPENDENCIES, manifest_path, sample_command
+from batch_project.packing import write_manifest, pack_container_overrides
+from batch_project.profiling import span
+from batch_project.refresh import StatusRefresh, ACTIVE_STATUSES, TERMINAL_STATUSES
+from batch_project.refresh import DESCRIBE_PAGE, LIST_PAGE
 
 
 def valid_workflow(config, verbose=True):
@@ -26,14 +41,21 @@ def valid_workflow(config, verbose=True):
         "job_definition": str,
         "outputs": list,
         "description": str,
-        "queue": str,
+        "queue": (str, list),
         "parameters": dict,
         "containerOverrides": dict,
         "analyses": list,
         "samples": list,
-        "timeout": int
+        "timeout": int,
+        "samples_per_job": int,
+        "parallel": int,
+        "manifest_folder": str,
+        "pack_runner": list
     }
-    optional = ["parameters", "containerOverrides", "analyses", "samples", "timeout"]
+    optional = [
+        "parameters", "containerOverrides", "analyses", "samples", "timeout",
+        "samples_per_job", "parallel", "manifest_folder", "pack_runner"
+    ]
 
     for analysis in config["analyses"]:        
         for k, v in analysis.items():
@@ -48,6 +70,16 @@ def valid_workflow(config, verbose=True):
             if not isinstance(v, analysis_spec[k]):
                 print(msg)
                 return False
+        # A list of queues must name at least one queue
+        if isinstance(analysis.get("queue"), list):
+            if len(analysis["queue"]) == 0 or \
+                    not all([isinstance(q, str) for q in analysis["queue"]]):
+                print("\n\nQueue must be a name or a list of names\n\n")
+                return False
+        # Packed jobs must hold at least one sample, run at least one at a time
+        if analysis.get("samples_per_job", 1) < 1 or analysis.get("parallel", 1) < 1:
+            print("\n\nsamples_per_job and parallel must be at least 1\n\n")
+            return False
         # Outputs must be S3 paths
         for output in analysis["outputs"]:
             if output.startswith("s3://") is False:
@@ -66,11 +98,61 @@ def valid_workflow(config, verbose=True):
     return True
 
 
-def submit_workflow(workflow_fp):
+@contextmanager
+def workflow_lock(fp, blocking=True):
+    """Hold an exclusive lock on a workflow while it is changed.
+
+    Yields False (without the lock) if the lock is taken and blocking is False.
+    """
+    with open(fp + ".lock", "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield False
+            return
+        yield True
+
+
+def write_workflow(fp, config):
+    """Replace a workflow file, so that readers never see it half written."""
+    with span("write JSON"):
+        with open(fp + ".tmp", "wt") as f:
+            json.dump(config, f, indent=4)
+        os.replace(fp + ".tmp", fp)
+
+
+def save_workflow_status(fp, config, loaded_mtime):
+    """Save the status of a workflow, unless it has been changed since it was read.
+
+    The status is only a record of what was found in Batch and S3, so it
+    is skipped rather than overwrite jobs added by submit, resubmit or cancel.
+    """
+    with workflow_lock(fp, blocking=False) as locked:
+        if not locked or os.stat(fp).st_mtime_ns != loaded_mtime:
+            print("{}: Changed by another command, not saving the status".format(fp))
+            return False
+        write_workflow(fp, config)
+        return True
+
+
+def job_queue(config, job):
+    """The queue a job was submitted to."""
+    if "queue" in job:
+        return job["queue"]
+    # Jobs submitted before the queue was recorded used the analysis' (only) queue
+    return queue_list(config["analyses"][job["analysis_ix"]]["queue"])[0]
+
+
+def submit_workflow(workflow_fp, s3_contents=None):
     """Submit a set of jobs."""
+    with workflow_lock(workflow_fp):
+        _submit_workflow(workflow_fp, s3_contents=s3_contents)
 
-    config = json.load(open(workflow_fp, "rt"))
-    assert valid_workflow(config)
+
+def _submit_workflow(workflow_fp, s3_contents=None):
+    with span("load JSON"):
+        config = json.load(open(workflow_fp, "rt"))
+        assert valid_workflow(config)
 
     if config.get('status') in ["SUBMITTED", "COMPLETED", "CANCELED"]:
         print("Project has already been submitted, exiting.")
@@ -81,99 +163,230 @@ def submit_workflow(workflow_fp):
         return
 
     # Keep track of the contents of different S3 folders
-    s3_contents = S3FolderContents()
+    if s3_contents is None:
+        s3_contents = S3FolderContents()
 
     # Set up the list of jobs
     config["jobs"] = []
-
-    # Set up the connection to Batch with boto
-    client = boto3.client('batch')
-
     for sample_info in config["samples"]:
         if "job_ids" not in sample_info:
             sample_info["job_ids"] = []
 
-        # Set the last job_id for sequential jobs
-        last_job_id = []
-        for analysis_ix, analysis_config in enumerate(config["analyses"]):
+    # Set up the connection to Batch with boto
+    client = get_client('batch')
+
+    # Analyses may list more than one queue, in which case each job
+    # goes to whichever is least busy
+    router = QueueRouter()
+
+    # Find the samples which need to be run for each analysis, with their outputs
+    to_run = []
+    completed = []
+    for analysis_ix, analysis_config in enumerate(config["analyses"]):
+        to_run.append([])
+        completed.append([])
+        for sample_ix, sample_info in enumerate(config["samples"]):
             # Fill in the values for the output paths
-            sample_outputs = [
-                output_template.format(
-                    **sample_info,
-                    **config
-                )
-                for output_template in analysis_config["outputs"]
-            ]
+            with span("render templates"):
+                sample_outputs = [
+                    output_template.format(
+                        **sample_info,
+                        **config
+                    )
+                    for output_template in analysis_config["outputs"]
+                ]
             # Check to see if the outputs exist
-            if all([
-                s3_contents.exists(fp)
-                for fp in sample_outputs
-            ]):
-                config["jobs"].append({
-                    "outputs": sample_outputs,
-                    "sample": sample_info["_sample"],
-                    "job_definition": analysis_config["job_definition"],
-                    "job_status": "COMPLETED",
-                    "analysis_ix": analysis_ix
-                })
-                sample_info["job_ids"].append(None)
+            with span("S3 checks"):
+                outputs_exist = all([
+                    s3_contents.exists(fp)
+                    for fp in sample_outputs
+                ])
+            if outputs_exist:
+                completed[analysis_ix].append((sample_ix, sample_outputs))
             else:
-                # Set up the job and submit it
+                to_run[analysis_ix].append((sample_ix, sample_outputs))
 
-                # Use the parameters from the input file to submit the jobs
-                job_name = "{}_{}_{}".format(
-                    config["workflow_name"],
-                    sample_info["_sample"],
-                    analysis_config["job_definition"]
-                )
-                job_name = job_name.replace(".", "_").replace(":", "_")
+    # Make sure every job can be submitted before submitting any
+    check_dependencies(config, to_run)
+
+    # Set the last job_id for each sample, to chain sequential jobs
+    last_job_id = {}
+
+    for analysis_ix, analysis_config in enumerate(config["analyses"]):
+        for sample_ix, sample_outputs in completed[analysis_ix]:
+            config["jobs"].append({
+                "outputs": sample_outputs,
+                "sample": config["samples"][sample_ix]["_sample"],
+                "job_definition": analysis_config["job_definition"],
+                "job_status": "COMPLETED",
+                "analysis_ix": analysis_ix
+            })
+            config["samples"][sample_ix]["job_ids"].append(None)
+
+        # Set up the jobs and submit them
+        for sample_ix, job in submit_analysis_jobs(
+            client, router, config, analysis_ix, to_run[analysis_ix], last_job_id
+        ):
+            config["jobs"].append(job)
+            config["samples"][sample_ix]["job_ids"].append(job["jobId"])
+
+    # Set the project status to "SUBMITTED"
+    config["status"] = "SUBMITTED"
 
-                parameters = {
+    # Write the config to a file
+    write_workflow(workflow_fp, config)
+
+
+def pack_samples(analysis_config, to_run):
+    """Split the samples to run for an analysis into the groups run by each job."""
+    samples_per_job = analysis_config.get("samples_per_job", 1)
+    return [
+        to_run[pack_start:pack_start + samples_per_job]
+        for pack_start in range(0, len(to_run), samples_per_job)
+    ]
+
+
+def check_dependencies(config, to_run):
+    """Make sure that no job would depend on more jobs than Batch allows.
+
+    `to_run` lists the (sample index, outputs) to run for each analysis, and
+    the jobs are planned as submit_analysis_jobs would submit them, so that
+    nothing is submitted for a workflow which can't be submitted in full.
+    """
+    last_job = {}
+    for analysis_ix, analysis_config in enumerate(config["analyses"]):
+        for pack_ix, pack in enumerate(pack_samples(analysis_config, to_run[analysis_ix])):
+            depends_on = set([
+                last_job[sample_ix]
+                for sample_ix, _ in pack
+                if sample_ix in last_job
+            ])
+            assert len(depends_on) <= MAX_DEPENDENCIES, \
+                "A job for {} would depend on {:,} jobs (at most {} are allowed), use the same samples_per_job for consecutive analyses".format(
+                    analysis_config["job_definition"], len(depends_on), MAX_DEPENDENCIES)
+            for sample_ix, _ in pack:
+                last_job[sample_ix] = (analysis_ix, pack_ix)
+
+
+def submit_analysis_jobs(client, router, config, analysis_ix, to_run, last_job_id):
+    """Submit the jobs for one analysis, returning a (sample index, job) pair for each sample.
+
+    `to_run` is a list of (sample index, outputs). Each sample's job depends
+    on the last job submitted for that sample (in `last_job_id`, which is
+    updated). With `samples_per_job`, the samples are packed into jobs
+    which each run the analysis for several samples, and every sample in a
+    pack records the same jobId. Use check_dependencies first, as each job
+    may depend on at most MAX_DEPENDENCIES others.
+    """
+    analysis_config = config["analyses"][analysis_ix]
+    samples_per_job = analysis_config.get("samples_per_job", 1)
+
+    submitted = []
+    for pack in pack_samples(analysis_config, to_run):
+        # Use the parameters from the input file to submit the jobs
+        with span("render templates"):
+            first_sample = config["samples"][pack[0][0]]
+            job_name = "{}_{}_{}".format(
+                config["workflow_name"],
+                first_sample["_sample"],
+                analysis_config["job_definition"]
+            )
+            if samples_per_job > 1:
+                job_name = "{}_x{}".format(job_name, len(pack))
+            job_name = job_name.replace(".", "_").replace(":", "_")
+
+            sample_parameters = [
+                {
                     k: v.format(
-                        **sample_info,
+                        **config["samples"][sample_ix],
                         **config
                     )
-                    for k, v in analysis_config["parameters"].items()
+                    for k, v in analysis_config.get("parameters", {}).items()
                 }
+                for sample_ix, _ in pack
+            ]
 
-                r = client.submit_job(
-                    jobName=job_name,
-                    jobQueue=analysis_config["queue"],
-                    jobDefinition=analysis_config["job_definition"],
-                    parameters=parameters,
-                    containerOverrides=analysis_config.get("containerOverrides", {}),
-                    dependsOn=last_job_id,
-                    timeout={"attemptDurationSeconds": analysis_config.get("timeout", 21600)}
-                )
-
-                # Set the last job id to chain sequential tasks
-                last_job_id = [
+        # Wait for the last job for each of the samples
+        depends_on = []
+        for sample_ix, _ in pack:
+            for dependency in last_job_id.get(sample_ix, []):
+                if dependency not in depends_on:
+                    depends_on.append(dependency)
+
+        timeout = analysis_config.get("timeout", 21600)
+        if samples_per_job == 1:
+            parameters = sample_parameters[0]
+            container_overrides = analysis_config.get("containerOverrides", {})
+            manifest_fp = None
+        else:
+            # Write out the command and outputs for each sample, to be run in the container
+            parallel = analysis_config.get("parallel", 1)
+            manifest_fp = manifest_path(analysis_config, job_name, pack[0][1])
+            manifest = {
+                "job_definition": analysis_config["job_definition"],
+                "parallel": parallel,
+                "timeout": timeout,
+                "samples": [
                     {
-                        "jobId": r["jobId"],
-                        "type": "SEQUENTIAL"
+                        "sample": config["samples"][sample_ix]["_sample"],
+                        "command": sample_command(analysis_config, params),
+                        "outputs": outputs,
                     }
-                ]
+                    for (sample_ix, outputs), params in zip(pack, sample_parameters)
+                ],
+            }
+            with span("S3 writes"):
+                write_manifest(manifest_fp, manifest)
+            parameters = {}
+            container_overrides = pack_container_overrides(analysis_config, manifest_fp)
+            # The runner kills any sample which takes longer than the
+            # timeout, and the job is allowed time for every sample, run
+            # `parallel` at a time
+            timeout = timeout * ((len(pack) + parallel - 1) // parallel)
+
+        with span("Batch calls"):
+            queue = router.choose(analysis_config["queue"])
+            r = client.submit_job(
+                jobName=job_name,
+                jobQueue=queue,
+                jobDefinition=analysis_config["job_definition"],
+                parameters=parameters,
+                containerOverrides=container_overrides,
+                dependsOn=depends_on,
+                timeout={"attemptDurationSeconds": timeout}
+            )
 
-                # Save the response, which includes the jobName and jobId (as a dict)
-                config["jobs"].append({
-                    "jobName": r["jobName"],
+        for sample_ix, outputs in pack:
+            # Set the last job id to chain sequential tasks
+            last_job_id[sample_ix] = [
+                {
                     "jobId": r["jobId"],
-                    "outputs": sample_outputs,
-                    "sample": sample_info["_sample"],
-                    "job_definition": analysis_config["job_definition"],
-                    "job_status": "SUBMITTED",
-                    "analysis_ix": analysis_ix
-                })
-                sample_info["job_ids"].append(r["jobId"])
+                    "type": "SEQUENTIAL"
+                }
+            ]
 
-                print("Submitted {}: {}".format(job_name, r['jobId']))
+            # Save the response, which includes the jobName and jobId (as a dict)
+            job = {
+                "jobName": r["jobName"],
+                "jobId": r["jobId"],
+                "outputs": outputs,
+                "sample": config["samples"][sample_ix]["_sample"],
+                "job_definition": analysis_config["job_definition"],
+                "job_status": "SUBMITTED",
+                "analysis_ix": analysis_ix,
+                "queue": queue,
+                "depends_on": [d["jobId"] for d in depends_on]
+            }
+            if manifest_fp is not None:
+                job["manifest"] = manifest_fp
+            submitted.append((sample_ix, job))
 
-    # Set the project status to "SUBMITTED"
-    config["status"] = "SUBMITTED"
+        if samples_per_job == 1:
+            print("Submitted {}: {}".format(job_name, r['jobId']))
+        else:
+            print("Submitted {} ({:,} samples): {}".format(job_name, len(pack), r['jobId']))
 
-    # Write the config to a file
-    with open(workflow_fp, "wt") as f:
-        json.dump(config, f, indent=4)
+    return submitted
 
 
 def resubmit_failed_jobs(workflow_fp):
@@ -182,92 +395,66 @@ def resubmit_failed_jobs(workflow_fp):
     # Check the status of the jobs
     get_workflow_status(workflow_fp)
 
+    with workflow_lock(workflow_fp):
+        _resubmit_failed_jobs(workflow_fp)
+
+
+def _resubmit_failed_jobs(workflow_fp):
     config = json.load(open(workflow_fp, "rt"))
     assert valid_workflow(config)
 
     assert "jobs" in config, "'jobs' not found in config, exiting."
 
     # Set up the connection to Batch with boto
-    client = boto3.client('batch')
+    client = get_client('batch')
+
+    # Send each job to the least busy of the queues for its analysis
+    router = QueueRouter()
 
-    # Index the jobs by their ID
+    # Index the jobs by their sample and analysis (jobs packed together share an ID)
     jobs = {
-        j["jobId"]: j
+        (j["sample"], j["analysis_ix"]): j
         for j in config["jobs"]
-        if "jobId" in j
     }
 
-    n_resubmitted = 0
-    
-    for sample_info in config["samples"]:
-        last_job_id = []
-        for analysis_ix, job_id in enumerate(sample_info["job_ids"]):
-            if job_id is None:
-                continue
-            assert job_id in jobs
-            if jobs[job_id]["job_status"] not in ["FAILED", "CANCELED"]:
+    # Samples whose job for each analysis failed
+    to_run = []
+    for analysis_ix, analysis_config in enumerate(config["analyses"]):
+        to_run.append([])
+        for sample_ix, sample_info in enumerate(config["samples"]):
+            if sample_info["job_ids"][analysis_ix] is None:
                 continue
+            job = jobs[(sample_info["_sample"], analysis_ix)]
+            assert job["jobId"] == sample_info["job_ids"][analysis_ix]
+            if job["job_status"] in ["FAILED", "CANCELED"]:
+                to_run[analysis_ix].append((sample_ix, job["outputs"]))
 
-            analysis_config = config["analyses"][analysis_ix]
-
-            parameters = {
-                k: v.format(
-                    **sample_info,
-                    **config
-                )
-                for k, v in analysis_config["parameters"].items()
-            }
-
-            r = client.submit_job(
-                jobName=jobs[job_id]["jobName"],
-                jobQueue=analysis_config["queue"],
-                jobDefinition=analysis_config["job_definition"],
-                parameters=parameters,
-                containerOverrides=analysis_config.get(
-                    "containerOverrides", {}),
-                dependsOn=last_job_id,
-                timeout={"attemptDurationSeconds": analysis_config.get(
-                    "timeout", 21600)}
-            )
-
-            # Set the last job id to chain sequential tasks
-            last_job_id = [
-                {
-                    "jobId": r["jobId"],
-                    "type": "SEQUENTIAL"
-                }
-            ]
-            print("Resubmitted " + r["jobId"])
+    # Make sure every job can be submitted before submitting any
+    check_dependencies(config, to_run)
 
-            # Save the response, which includes the jobName and jobId (as a dict)
-            jobs[job_id] = {
-                "jobName": r["jobName"],
-                "jobId": r["jobId"],
-                "outputs": jobs[job_id]["outputs"],
-                "sample": sample_info["_sample"],
-                "job_definition": analysis_config["job_definition"],
-                "job_status": "SUBMITTED",
-                "analysis_ix": analysis_ix
-            }
-            sample_info["job_ids"][analysis_ix] = r["jobId"]
+    # Chain the resubmitted jobs for each sample, as they were first submitted
+    last_job_id = {}
+    n_resubmitted = 0
 
+    for analysis_ix, analysis_config in enumerate(config["analyses"]):
+        for sample_ix, job in submit_analysis_jobs(
+            client, router, config, analysis_ix, to_run[analysis_ix], last_job_id
+        ):
+            jobs[(job["sample"], analysis_ix)] = job
+            config["samples"][sample_ix]["job_ids"][analysis_ix] = job["jobId"]
             n_resubmitted += 1
 
     print("Resubmitted {:,} failed jobs".format(n_resubmitted))
 
     config["jobs"] = list(jobs.values())
 
-    with open(workflow_fp, "wt") as f:
-        json.dump(config, f, indent=4)
+    write_workflow(workflow_fp, config)
 
 
-def cancel_workflow_jobs(workflow_fp, status=None):
+def cancel_workflow_jobs(workflow_fp, status=None, n_threads=8, max_per_second=20):
     """Cancel all of the currently pending jobs."""
     get_workflow_status(workflow_fp)
 
-    config = json.load(open(workflow_fp, "rt"))
-    assert "jobs" in config, "No jobs found in config file"
-
     # Prompt the user for confirmation
     response = input("Are you sure you want to cancel these jobs? (Y/N): ")
     assert response == "Y", "Do not cancel without confirmation"
@@ -275,27 +462,33 @@ def cancel_workflow_jobs(workflow_fp, status=None):
     # Get a message to submit as justfication for the failure
     cancel_msg = input("What message should describe these cancellations?\n")
 
-    # Set up the connection to Batch with boto
-    client = boto3.client('batch')
-
-    # Cancel jobs
-    for j in config["jobs"]:
-        if "jobId" not in j:
-            continue
-        if status is None or status == j["job_status"]:
-            if j["job_status"] not in ["SUCCEEDED", "FAILED", "CANCELED"]:
-                print("Cancelling {}".format(j["jobId"]))
-                client.cancel_job(jobId=j["jobId"], reason=cancel_msg)
-                client.terminate_job(jobId=j["jobId"], reason=cancel_msg)
-                j["job_status"] = "CANCELED"
-
-    config["status"] = "CANCELED"
+    with workflow_lock(workflow_fp):
+        config = json.load(open(workflow_fp, "rt"))
+        assert "jobs" in config, "No jobs found in config file"
 
-    with open(workflow_fp, "wt") as f:
-        json.dump(config, f, indent=4)
-
-
-def save_workflow_logs(fp):
+        # Cancel or terminate each job, depending on its status
+        canceller = BulkCanceller(
+            cancel_msg,
+            n_threads=n_threads,
+            max_per_second=max_per_second
+        )
+        try:
+            canceller.run([
+                (j["jobId"], j["job_status"])
+                for j in config["jobs"]
+                if "jobId" in j and (status is None or status == j["job_status"])
+            ])
+            config["status"] = "CANCELED"
+        finally:
+            # Record the jobs which were stopped, even if interrupted
+            for j in config["jobs"]:
+                if j.get("jobId") in canceller.stopped:
+                    j["job_status"] = "CANCELED"
+
+            write_workflow(workflow_fp, config)
+
+
+def save_workflow_logs(fp, compress=False, n_threads=16):
     """Save all of the logs to their own local file."""
     config = json.load(open(fp, "rt"))
     folder = config["project_name"]
@@ -306,18 +499,19 @@ def save_workflow_logs(fp):
 
     assert "jobs" in config, "No jobs found in config file"
 
-    # Get the list of IDs
-    id_list = [j["jobId"] for j in config["jobs"] if "jobId" in j]
+    # Get the list of IDs (once for each packed job)
+    id_list = list(dict.fromkeys([j["jobId"] for j in config["jobs"] if "jobId" in j]))
 
     # Set up the connection to Batch with boto
-    client = boto3.client('batch')
+    client = get_client('batch')
 
     # Keep track of the jobs with logs
-    job_log_ids = {}  # key is log_id, value is job_name+job_id
+    job_log_ids = {}  # key is log_id, value is (job_name+job_id, final)
 
     # Check the status of each job in batches of 100
     while len(id_list) > 0:
-        status = client.describe_jobs(jobs=id_list[:min(len(id_list), 100)])
+        with span("Batch calls"):
+            status = client.describe_jobs(jobs=id_list[:min(len(id_list), 100)])
         if len(id_list) < 100:
             id_list = []
         else:
@@ -332,25 +526,27 @@ def save_workflow_logs(fp):
                     j['jobName'],
                     j['jobId']
                 )
-                job_log_ids[j['container']['logStreamName']] = fp
+                job_log_ids[j['container']['logStreamName']] = (
+                    fp, stream_is_final(j)
+                )
 
-    # Now get all of the logs
-    client = boto3.client('logs')
-    for log_id, fp in job_log_ids.items():
-        try:
-            response = client.get_log_events(logGroupName='/aws/batch/job', logStreamName=log_id)
-        except:
-            continue
-        print("Writing to " + fp)
-        with open(fp, 'wt') as fo:
-            for event in response['events']:
-                fo.write(event['message'] + '\n')
+    # Now get all of the logs, starting from where the last run left off
+    harvester = LogHarvester(
+        os.path.join(folder, "logs", "_log_tokens.json"),
+        n_threads=n_threads,
+        compress=compress,
+    )
+    with span("download logs"):
+        n_events = harvester.harvest(job_log_ids)
+    print("Downloaded {:,} new log events".format(n_events))
 
 
-def get_workflow_status(fp, force_check=False):
+def get_workflow_status(fp, force_check=False, s3_contents=None, job_events=None):
     """Monitor the status of a set of jobs."""
-    config = json.load(open(fp, "rt"))
-    assert valid_workflow(config)
+    with span("load JSON"):
+        loaded_mtime = os.stat(fp).st_mtime_ns
+        config = json.load(open(fp, "rt"))
+        assert valid_workflow(config)
 
     assert "jobs" in config, "No jobs in workflow file"
 
@@ -359,44 +555,90 @@ def get_workflow_status(fp, force_check=False):
             return {"COMPLETED": len(config["jobs"])}
 
     # Set up a connection to S3 to check for output files
-    s3_contents = S3FolderContents()
-
-    # Mark jobs as SUCCEEDED if the outputs exist
-    for j in config["jobs"]:
-        if j["job_status"] == "SUCCEEDED":
-            continue
-        if all([
-            s3_contents.exists(fp)
-            for fp in j["outputs"]
-        ]):
-            j["job_status"] = "SUCCEEDED"
-    # Get the list of IDs
-    id_list = [
-        j["jobId"] for j in config["jobs"]
-        if j["job_status"] != "SUCCEEDED"
-    ]
-
-    # Set up the connection to Batch with boto
-    client = boto3.client('batch')
-
-    # Count up the number of jobs by status
-    new_job_status = {}
-
-    # Check the status of each job in batches of 100
-    while len(id_list) > 0:
-        status = client.describe_jobs(jobs=id_list[:min(len(id_list), 100)])
-        if len(id_list) < 100:
-            id_list = []
+    if s3_contents is None:
+        s3_contents = S3FolderContents()
+
+    # With job events, only ask Batch about every job occasionally to catch
+    # lost events, or when the events could not all be read
+    refresh_batch = True
+    if job_events is not None:
+        job_events.track([
+            j["jobId"] for j in config["jobs"]
+            if "jobId" in j and j["job_status"] not in TERMINAL_STATUSES
+        ])
+        job_events.poll()
+        if job_events.drained and \
+                time.time() - config.get("reconciled_at", 0) < job_events.reconcile_interval:
+            refresh_batch = False
         else:
-            id_list = id_list[100:]
+            config["reconciled_at"] = time.time()
+
+    # Start fetching the status of the jobs which may still change, either
+    # by describing them or by listing their queues (whichever takes fewer
+    # calls). Jobs which have finished are only checked again with force_check.
+    # Samples packed into the same job are only checked once
+    refresh = None
+    if refresh_batch:
+        refresh = StatusRefresh(
+            list(dict(
+                (j["jobId"], (j["jobId"], job_queue(config, j), j["job_status"]))
+                for j in config["jobs"]
+                if "jobId" in j and j["job_status"] != "SUCCEEDED" and (
+                    force_check or j["job_status"] not in TERMINAL_STATUSES
+                )
+            ).values()),
+            queue_counts=config.get("queue_counts")
+        )
+
+    # Meanwhile, mark jobs as SUCCEEDED if the outputs exist
+    with span("S3 checks"):
+        for j in config["jobs"]:
+            if j["job_status"] == "SUCCEEDED":
+                continue
+            if all([
+                s3_contents.exists(fp)
+                for fp in j["outputs"]
+            ]):
+                j["job_status"] = "SUCCEEDED"
 
-        for j in status['jobs']:
-            new_job_status[j["jobId"]] = j['status']
-    
-    # Add back to the list of jobs
-    for j in config["jobs"]:
-        if j.get("jobId") in new_job_status:
-            j["job_status"] = new_job_status[j["jobId"]]
+    # Apply any status changes reported by Batch events
+    if job_events is not None:
+        for j in config["jobs"]:
+            if j["job_status"] in ["SUCCEEDED", "FAILED"]:
+                continue
+            if j.get("jobId") not in job_events.status:
+                continue
+            times = job_events.times[j["jobId"]]
+            if job_status_moved_on(
+                j["job_status"], j.get("attempts"), job_events.status[j["jobId"]], times.get("attempts")
+            ):
+                j["job_status"] = job_events.status[j["jobId"]]
+                # Keep the timestamps, for `batch_project analytics`
+                j.update(times)
+
+    # Add back the status reported by Batch, except for jobs with all outputs
+    # (a packed job is still checked until every one of its samples has them)
+    if refresh is not None:
+        with span("Batch calls"):
+            new_job_status, queue_counts, new_job_times = refresh.result(skip=set([
+                j["jobId"] for j in config["jobs"]
+                if "jobId" in j and j["job_status"] == "SUCCEEDED"
+            ]) - set([
+                j["jobId"] for j in config["jobs"]
+                if "jobId" in j and j["job_status"] != "SUCCEEDED"
+            ]))
+
+        # The size of each queue is used to plan the next refresh
+        config.setdefault("queue_counts", {}).update(queue_counts)
+
+        for j in config["jobs"]:
+            # Keep the timestamps, for `batch_project analytics`
+            if j.get("jobId") in new_job_times:
+                j.update(new_job_times[j["jobId"]])
+            if j["job_status"] == "SUCCEEDED":
+                continue
+            if j.get("jobId") in new_job_status:
+                j["job_status"] = new_job_status[j["jobId"]]
 
     # Count the job statuses
     status_counts = defaultdict(int)
@@ -409,14 +651,288 @@ def get_workflow_status(fp, force_check=False):
         print("{}: Project is COMPLETED!".format(fp))
         config["status"] = "COMPLETED"
 
-    # Save the config
-    with open(fp, "wt") as f:
-        json.dump(config, f, indent=4)
+    # Save the config, unless another command has changed it in the meantime
+    save_workflow_status(fp, config, loaded_mtime)
 
     # Return the status status_counts
     return status_counts
     
 
+def workflow_analytics(workflow_fp, freq="1h", csv_fp=None):
+    """Print the queue wait, runtime and throughput of a project's jobs."""
+    get_workflow_status(workflow_fp)
+    loaded_mtime = os.stat(workflow_fp).st_mtime_ns
+    config = json.load(open(workflow_fp, "rt"))
+    assert "jobs" in config, "No jobs found in config file"
+
+    # Jobs found to be finished from their outputs may not have been
+    # described since they stopped, so fetch any missing timestamps
+    id_list = list(dict.fromkeys([
+        j["jobId"] for j in config["jobs"]
+        if "jobId" in j and j["job_status"] in TERMINAL_STATUSES and "stoppedAt" not in j
+    ]))
+    if len(id_list) > 0:
+        client = get_client('batch')
+        fetched = {}
+        for ix in range(0, len(id_list), 100):
+            with span("Batch calls"):
+                r = client.describe_jobs(jobs=id_list[ix:ix + 100])
+            for job_details in r["jobs"]:
+                fetched[job_details["jobId"]] = job_times(job_details)
+        for j in config["jobs"]:
+            if j.get("jobId") in fetched:
+                j.update(fetched[j["jobId"]])
+        save_workflow_status(workflow_fp, config, loaded_mtime)
+
+    jobs = [
+        {
+            "jobId": j["jobId"],
+            "job_definition": j["job_definition"],
+            "queue": job_queue(config, j),
+            "status": j["job_status"],
+            "attempts": j.get("attempts"),
+            "depends_on": j.get("depends_on", []),
+            "createdAt": j.get("createdAt"),
+            "startedAt": j.get("startedAt"),
+            "stoppedAt": j.get("stoppedAt"),
+        }
+        for j in config["jobs"]
+        if "jobId" in j
+    ]
+    if len(jobs) == 0:
+        print("No jobs have been submitted")
+        return
+
+    print(timing_report(jobs, freq=freq))
+    if csv_fp is not None:
+        jobs_frame(jobs).to_csv(csv_fp)
+        print("Wrote the details of each job to {}".format(csv_fp))
+
+
+def find_workflow_files(root):
+    """Yield the path of every workflow JSON under a folder."""
+    for folder, subdirs, files in os.walk(root):
+        for file in files:
+            if file[0] == '_':
+                continue
+            if file.endswith(".json"):
+                yield os.path.join(folder, file)
+
+
+def count_queue_jobs(queue_name, job_status, stopped_after=None):
+    """Count the jobs in a queue with each of a list of statuses, and when the finished jobs stopped."""
+    counts, stopped = list_queues([queue_name], job_status, stopped_after=stopped_after)
+    return counts[queue_name], stopped[queue_name]
+
+
+def count_queues(queue_names, job_status, n_threads=8):
+    """Count the jobs in each queue by status ({queue: {status: n}}), listing in parallel."""
+    return list_queues(queue_names, job_status, n_threads=n_threads)[0]
+
+
+def list_queues(queue_names, job_status, n_threads=8, stopped_after=None):
+    """Count the jobs in each queue by status, listing in parallel.
+
+    Also returns when the SUCCEEDED and FAILED jobs which stopped after
+    `stopped_after` (epoch seconds) stopped, as {queue: [[stoppedAt, n], ...]}
+    (stoppedAt in milliseconds, as reported by Batch).
+    """
+    to_count = [
+        (queue_name, js)
+        for queue_name in queue_names
+        for js in job_status
+    ]
+    with span("Batch calls"), ThreadPoolExecutor(max_workers=n_threads) as pool:
+        counts = list(pool.map(lambda x: count_jobs(*x, stopped_after=stopped_after), to_count))
+
+    status_counts = {queue_name: {} for queue_name in queue_names}
+    stopped = {queue_name: defaultdict(int) for queue_name in queue_names}
+    for (queue_name, js), (n, job_stopped) in zip(to_count, counts):
+        status_counts[queue_name][js] = n
+        for stopped_at, n_stopped in job_stopped.items():
+            stopped[queue_name][stopped_at] += n_stopped
+    return status_counts, {
+        queue_name: sorted([[stopped_at, n] for stopped_at, n in stopped[queue_name].items()])
+        for queue_name in queue_names
+    }
+
+
+def count_jobs(queue_name, job_status, stopped_after=None):
+    """Number of jobs in a queue with a single status, and how many stopped at each time after `stopped_after`."""
+    n = 0
+    stopped = defaultdict(int)
+    for j in list_job_summaries(queue_name, job_status):
+        n += 1
+        # Only the finished jobs have stopped, and only the recent ones are kept
+        if stopped_after is not None and job_status in ["SUCCEEDED", "FAILED"]:
+            if j.get("stoppedAt") is not None and j["stoppedAt"] / 1000. > stopped_after:
+                stopped[j["stoppedAt"]] += 1
+    return n, dict(stopped)
+
+
+def list_job_summaries(queue_name, job_status=None, filters=None):
+    """Yield the summary of each job in a queue with a status (or, with `filters`, any status)."""
+    client = get_client("batch")
+    kwargs = {"jobQueue": queue_name, "maxResults": LIST_PAGE}
+    # Batch ignores the status when filters are given
+    if filters is not None:
+        kwargs["filters"] = filters
+    else:
+        kwargs["jobStatus"] = job_status
+    while True:
+        r = client.list_jobs(**kwargs)
+        for j in r["jobSummaryList"]:
+            yield j
+        if r.get("nextToken") is None:
+            break
+        kwargs["nextToken"] = r["nextToken"]
+
+
+class QueueWatch:
+    """Jobs in a queue by status, listed again and again without paging through every finished job.
+
+    The SUCCEEDED and FAILED jobs are only listed in full every
+    `full_interval` seconds. In between, the jobs which have finished since
+    are the jobs created after the full listing (listed with the
+    AFTER_CREATED_AT filter) which have finished, and the jobs which were
+    active at the full listing and have since left the active statuses
+    (checked with DescribeJobs). Jobs which Batch has expired are only
+    dropped from the counts by the next full listing.
+    """
+
+    def __init__(self, queue_name, job_status, full_interval=600):
+        self.queue_name = queue_name
+        self.job_status = list(job_status)
+        self.full_interval = full_interval
+
+        # When the last full listing started (epoch milliseconds), the
+        # finished jobs it counted, and when those stopped after
+        # `full_stopped_after` stopped
+        self.full_at = None
+        self.full_counts = {}
+        self.full_stopped = {}
+        self.full_stopped_after = None
+
+        # Jobs created before the full listing which were still active,
+        # and those which have finished since, as {jobId: (status, stoppedAt)}
+        self.active = set()
+        self.finished = {}
+
+    def refresh(self, stopped_after=None, n_threads=8):
+        """List the queue again.
+
+        Returns the number of jobs by status, and when the finished jobs
+        which stopped after `stopped_after` stopped (as for count_queue_jobs).
+        """
+        updated = time.time()
+        finished_status = [js for js in self.job_status if js in ["SUCCEEDED", "FAILED"]]
+        if len(finished_status) == 0:
+            return count_queue_jobs(self.queue_name, self.job_status)
+
+        with span("Batch calls"), ThreadPoolExecutor(max_workers=n_threads) as pool:
+            # Every active job is listed, to see which have finished
+            active = dict(zip(ACTIVE_STATUSES, pool.map(
+                lambda js: [
+                    (j["jobId"], j["createdAt"])
+                    for j in list_job_summaries(self.queue_name, js)
+                ],
+                ACTIVE_STATUSES
+            )))
+            if self.needs_full_listing(updated, stopped_after):
+                self.list_finished(updated, active, finished_status, stopped_after, pool)
+                recent = []
+            else:
+                self.check_active(active)
+                recent = self.list_created_since()
+
+        # The finished jobs from the full listing, and those finished since
+        counts = {js: len(active[js]) for js in self.job_status if js in active}
+        counts.update(self.full_counts)
+        stopped = defaultdict(int)
+        for stopped_at, n in self.full_stopped.items():
+            if stopped_after is not None and stopped_at / 1000. > stopped_after:
+                stopped[stopped_at] += n
+        for status, stopped_at in list(self.finished.values()) + recent:
+            if status not in counts:
+                continue
+            counts[status] += 1
+            if stopped_after is not None and stopped_at is not None and \
+                    stopped_at / 1000. > stopped_after:
+                stopped[stopped_at] += 1
+        return counts, sorted([[stopped_at, n] for stopped_at, n in stopped.items()])
+
+    def needs_full_listing(self, updated, stopped_after):
+        """Whether every finished job should be listed again."""
+        if self.full_at is None or updated - self.full_at / 1000. >= self.full_interval:
+            return True
+        # Older stop times are needed than the full listing kept
+        if stopped_after is None:
+            return False
+        return self.full_stopped_after is None or stopped_after < self.full_stopped_after
+
+    def list_finished(self, updated, active, finished_status, stopped_after, pool):
+        """List every finished job, starting the counts again."""
+        self.full_at = int(updated * 1000)
+        self.full_stopped_after = stopped_after
+        # Jobs created since are found by listing the jobs created after the full listing
+        self.active = set([
+            job_id
+            for jobs in active.values()
+            for job_id, created_at in jobs
+            if created_at <= self.full_at
+        ])
+        self.finished = {}
+
+        def list_status(js):
+            n = 0
+            stopped = defaultdict(int)
+            counted = []
+            for j in list_job_summaries(self.queue_name, js):
+                n += 1
+                if j["jobId"] in self.active:
+                    counted.append(j["jobId"])
+                if stopped_after is not None and j.get("stoppedAt") is not None and \
+                        j["stoppedAt"] / 1000. > stopped_after:
+                    stopped[j["stoppedAt"]] += 1
+            return n, stopped, counted
+
+        self.full_counts = {}
+        self.full_stopped = defaultdict(int)
+        for js, (n, stopped, counted) in zip(finished_status, pool.map(list_status, finished_status)):
+            self.full_counts[js] = n
+            for stopped_at, n_stopped in stopped.items():
+                self.full_stopped[stopped_at] += n_stopped
+            # Jobs which finished while the queue was listed have been counted already
+            self.active.difference_update(counted)
+        self.full_stopped = dict(self.full_stopped)
+
+    def check_active(self, active):
+        """Describe the jobs which have left the active statuses since the full listing."""
+        still_active = set([job_id for jobs in active.values() for job_id, _ in jobs])
+        left = [job_id for job_id in self.active if job_id not in still_active]
+        client = get_client("batch")
+        for ix in range(0, len(left), DESCRIBE_PAGE):
+            for j in client.describe_jobs(jobs=left[ix:ix + DESCRIBE_PAGE])["jobs"]:
+                # Jobs changing status while the queue was listed may have been missed
+                if j["status"] in ACTIVE_STATUSES:
+                    still_active.add(j["jobId"])
+                else:
+                    self.finished[j["jobId"]] = (j["status"], j.get("stoppedAt"))
+        # Jobs which could not be described (e.g. expired) are forgotten too
+        self.active = self.active & still_active
+
+    def list_created_since(self):
+        """Finished jobs created since the full listing, as [(status, stoppedAt)]."""
+        return [
+            (j["status"], j.get("stoppedAt"))
+            for j in list_job_summaries(
+                self.queue_name,
+                filters=[{"name": "AFTER_CREATED_AT", "values": [str(self.full_at)]}]
+            )
+            if j["status"] in ["SUCCEEDED", "FAILED"] and j["createdAt"] > self.full_at
+        ]
+
+
 def import_project_from_metadata(
     project_name,
     metadata_fp,
@@ -424,6 +940,8 @@ def import_project_from_metadata(
     sample_col="sample"
 ):
     """Make a project folder from a metadata CSV."""
+    import pandas as pd
+
     # Load in a metadata table
     msg = "{} does not exist"
     assert os.path.exists(metadata_fp), msg.format(metadata_fp)
@@ -463,66 +981,147 @@ def import_project_from_metadata(
 
 class S3FolderContents:
     """Check whether files exist on S3, caching folder contents."""
-    def __init__(self):
-        self.client = boto3.client('s3')
-
-        self.file_cache = set([])
-        self.folder_cache = defaultdict(set)
+    def __init__(
+        self,
+        max_folders=10000,
+        ttl=300,
+        cache_db=None,
+        cache_max_age=None,
+        inventory=None,
+        event_queue=None,
+        sweep_ttl=3600
+    ):
+        # When new objects are reported by S3 events, folders only need
+        # to be listed again as an occasional safety sweep
+        if event_queue is not None:
+            ttl = max(ttl, sweep_ttl)
+
+        # Folders are listed again for files which were missing from a
+        # listing older than the TTL (files which were found are kept)
+        self.cache = FolderCache(max_folders=max_folders, ttl=ttl)
+
+        # Optionally, trust objects confirmed by previous runs
+        self.store = open_existence_store(cache_db, max_age=cache_max_age)
+
+        # Optionally, trust objects listed in S3 Inventory snapshots
+        self.inventory = inventory if inventory is not None else []
+
+        # Objects reported as deleted since the snapshots were taken
+        self.removed = set()
+
+        # Optionally, apply S3 object notifications from a queue
+        self.events = None
+        if event_queue is not None:
+            self.events = EventConsumer(event_queue, [self])
 
     def exists(self, fp):
         """Check whether a single file exists in S3."""
-        if fp in self.file_cache:
-            return True
-
         assert fp.startswith("s3://"), "Not an S3 path"
         assert fp.endswith("/") is False, "File, should be a folder"
 
         bucket = fp[5:].split("/", 1)[0]
         folder = "/".join(fp[5:].split("/")[1:-1])
+        s3_folder, name = fp.rsplit("/", 1)
 
-        # We've checked this folder, and it's not there
-        if folder in self.folder_cache[bucket]:
-            return False
+        # Catch up on any objects created since the last check
+        if self.events is not None:
+            self.events.poll()
 
-        # Otherwise, list the contents of the folder
-        for existing_fp in self.aws_s3_ls(bucket, folder):
-            self.file_cache.add(
-                "s3://{}/{}/{}".format(bucket, folder, existing_fp))
-        self.folder_cache[bucket].add(folder)
+        # Objects confirmed recently by a previous run don't need to be listed
+        if self.store is not None and self.store.exists(s3_folder, name):
+            return True
+
+        # Objects in the inventory snapshot don't need to be listed either,
+        # so only outputs created (or deleted) since the snapshot are checked live
+        key = fp[5:].split("/", 1)[1]
+        if fp not in self.removed and any([index.contains(bucket, key) for index in self.inventory]):
+            return True
+
+        # List the contents of the folder unless the file was found in an
+        # earlier listing, or was missing from a recent one
+        found = self.cache.contains((bucket, folder), name)
+        if found is None:
+            objs = self.list_folder(bucket, folder)
+            if self.store is not None:
+                self.store.record_folder(s3_folder, objs)
+            contents = frozenset([d["Key"].split('/')[-1] for d in objs])
+            self.cache.put((bucket, folder), contents)
+            found = name in contents
+
+            # Stop trusting the inventory for the folder if it has changed since
+            for index in self.inventory:
+                index.prefix_changed(bucket, folder, objs, missing_key=None if found else key)
+
+        return found
+
+    def object_created(self, fp):
+        """Record an object reported by an S3 event.
+
+        Returns False (leaving the event in the queue) if the object's folder
+        hasn't been listed and there is no store to remember it in.
+        """
+        bucket = fp[5:].split("/", 1)[0]
+        folder = "/".join(fp[5:].split("/")[1:-1])
+        s3_folder, name = fp.rsplit("/", 1)
+        self.removed.discard(fp)
+        applied = self.cache.add((bucket, folder), name)
+        if self.store is not None:
+            self.store.record_object(s3_folder, name)
+            applied = True
+        return applied
+
+    def object_removed(self, fp):
+        """Forget an object reported as deleted by an S3 event."""
+        bucket = fp[5:].split("/", 1)[0]
+        folder = "/".join(fp[5:].split("/")[1:-1])
+        s3_folder, name = fp.rsplit("/", 1)
+        applied = self.cache.discard((bucket, folder), name)
+        if self.store is not None:
+            self.store.forget_object(s3_folder, name)
+            applied = True
+        # Don't trust the inventory for this object any more
+        key = fp[5:].split("/", 1)[1]
+        if any([index.contains(bucket, key) for index in self.inventory]):
+            self.removed.add(fp)
+            applied = True
+        return applied
 
-        return fp in self.file_cache
-        
     def aws_s3_ls(self, bucket, prefix):
-        """List the contents of an S3 bucket."""
+        """List the files directly inside a folder in an S3 bucket."""
+        return [d["Key"].split('/')[-1] for d in self.list_folder(bucket, prefix)]
+
+    def list_folder(self, bucket, prefix):
+        """List the objects (with ETag and LastModified) directly inside a folder."""
 
         print("Getting contents of s3://{}/{}".format(bucket, prefix))
 
-        # Connect to S3
-        client = boto3.client('s3')
+        client = get_client('s3')
+
+        # Only list the files in this folder, not in any subfolders
+        if len(prefix) > 0:
+            prefix = prefix + "/"
 
         # Get all of the objects from S3
         tot_objs = []
         # Retrieve in batches of 1,000
-        objs = client.list_objects_v2(Bucket=bucket, Prefix=prefix)
+        objs = client.list_objects_v2(Bucket=bucket, Prefix=prefix, Delimiter="/")
 
         continue_flag = True
         while continue_flag:
             continue_flag = False
 
-            if 'Contents' not in objs:
-                break
-
-            # Add this batch to the list
-            tot_objs.extend(objs['Contents'])
+            # Pages may hold only subfolders, so keep going even without files
+            tot_objs.extend(objs.get('Contents', []))
 
             # Check to see if there are more to fetch
             if objs['IsTruncated']:
                 continue_flag = True
                 token = objs['NextContinuationToken']
                 objs = client.list_objects_v2(Bucket=bucket,
-                                            Prefix=prefix,
-                                            ContinuationToken=token)
-        return [d["Key"].split('/')[-1] for d in tot_objs]
+                                              Prefix=prefix,
+                                              Delimiter="/",
+                                              ContinuationToken=token)
+        return tot_objs
 
 
 def create_workflow_from_template(project_name, template_fp):
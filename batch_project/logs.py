@@ -0,0 +1,152 @@
+"""Download CloudWatch logs for Batch jobs, resuming from previous runs."""
+import os
+import gzip
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from batch_helpers.aws import get_client
+
+
+class LogHarvester:
+    """Fetch complete log streams in parallel, saving a forward token per stream.
+
+    The size of each local file is saved along with the token, so that
+    events written after the last saved token (e.g. by a run which failed
+    partway through a stream) are removed before they are fetched again.
+    """
+
+    def __init__(
+        self,
+        state_fp,
+        log_group="/aws/batch/job",
+        n_threads=16,
+        compress=False,
+    ):
+        self.client = get_client("logs")
+        self.log_group = log_group
+        self.n_threads = n_threads
+        self.compress = compress
+
+        # Keep track of how far each stream has been read, keyed by stream name
+        self.state_fp = state_fp
+        self.state = {}
+        if os.path.exists(state_fp):
+            self.state = json.load(open(state_fp, "rt"))
+        self.lock = threading.Lock()
+
+    def harvest(self, streams):
+        """Download new events for a dict of stream name -> (local path, final)."""
+        n_events = 0
+        try:
+            with ThreadPoolExecutor(max_workers=self.n_threads) as pool:
+                futures = {
+                    pool.submit(self.fetch_stream, log_stream, fp, final): log_stream
+                    for log_stream, (fp, final) in streams.items()
+                    if not self.is_complete(log_stream)
+                }
+                for future in as_completed(futures):
+                    try:
+                        n_events += future.result()
+                    except Exception as e:
+                        print("Could not fetch {}: {}".format(futures[future], e))
+        finally:
+            # Save the tokens even if the harvest was interrupted
+            self.save_state()
+        return n_events
+
+    def is_complete(self, log_stream):
+        """Whether a finished stream has been downloaded in full, and is still on disk."""
+        prev = self.state.get(log_stream, {})
+        if not prev.get("final"):
+            return False
+        # Streams without any events have no local file
+        return prev.get("size") == 0 or os.path.exists(prev["path"])
+
+    def fetch_stream(self, log_stream, fp, final=False):
+        """Append all events not yet downloaded from a single stream."""
+        if self.compress:
+            fp = fp + ".gz"
+
+        with self.lock:
+            prev = self.state.get(log_stream, {})
+        token = prev.get("token")
+
+        # The file name includes the job status, so move the previous file over
+        if token is not None and prev.get("path") != fp:
+            if prev.get("path") is not None and os.path.exists(prev["path"]) \
+                    and prev["path"].endswith(".gz") == self.compress:
+                os.rename(prev["path"], fp)
+            else:
+                token = None
+
+        # Start over if the local copy has been removed
+        if token is not None and os.path.exists(fp) is False:
+            token = None
+
+        # Remove anything written after the saved token, which will be fetched again
+        if token is not None and prev.get("size") is not None:
+            size = os.path.getsize(fp)
+            if size < prev["size"]:
+                token = None
+            elif size > prev["size"]:
+                print("Removing events written to {} after the last saved token".format(fp))
+                with open(fp, "r+b") as f:
+                    f.truncate(prev["size"])
+
+        kwargs = {
+            "logGroupName": self.log_group,
+            "logStreamName": log_stream,
+            "startFromHead": True,
+        }
+        if token is not None:
+            kwargs["nextToken"] = token
+
+        opener = gzip.open if self.compress else open
+        fo = None
+        n_events = 0
+        try:
+            # Keep reading until the forward token stops changing
+            while True:
+                r = self.client.get_log_events(**kwargs)
+
+                if len(r["events"]) > 0:
+                    if fo is None:
+                        print("Writing to " + fp)
+                        fo = opener(fp, "at" if token is not None else "wt")
+                    for event in r["events"]:
+                        fo.write(event["message"] + "\n")
+                    n_events += len(r["events"])
+
+                if r["nextForwardToken"] == kwargs.get("nextToken"):
+                    break
+                kwargs["nextToken"] = r["nextForwardToken"]
+        finally:
+            if fo is not None:
+                fo.close()
+
+        with self.lock:
+            self.state[log_stream] = {
+                "token": kwargs.get("nextToken"),
+                "path": fp,
+                "size": os.path.getsize(fp) if os.path.exists(fp) else 0,
+                "final": final,
+            }
+        return n_events
+
+    def save_state(self):
+        """Write the stream tokens to disk."""
+        with self.lock:
+            tmp_fp = self.state_fp + ".tmp"
+            with open(tmp_fp, "wt") as fo:
+                json.dump(self.state, fo)
+            os.replace(tmp_fp, self.state_fp)
+
+
+def stream_is_final(job, settle_seconds=600):
+    """Check whether a job stopped long enough ago that its log is complete."""
+    if job["status"] not in ["SUCCEEDED", "FAILED"]:
+        return False
+    if "stoppedAt" not in job:
+        return False
+    return time.time() - job["stoppedAt"] / 1000. > settle_seconds
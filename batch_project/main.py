@@ -4,17 +4,127 @@
 import os
 import sys
 import json
-import boto3
+import time
 import argparse
-import pandas as pd
-from tabulate import tabulate
-from collections import defaultdict
+from batch_helpers.aws import get_client
+from batch_helpers.api_metrics import api_metrics
+from batch_helpers.events import JobStatusTracker
+from batch_helpers.tables import count_table, format_table
 from batch_project.lib import submit_workflow, get_workflow_status
-from batch_project.lib import cancel_workflow_jobs, save_workflow_logs
+from batch_project.lib import cancel_workflow_jobs, save_workflow_logs, workflow_analytics
 from batch_project.lib import resubmit_failed_jobs, import_project_from_metadata
 from batch_project.lib import create_workflow_from_template, valid_workflow
+from batch_project.lib import S3FolderContents, find_workflow_files, list_queues, QueueWatch
+from batch_project.cancel import cancel_jobs
+from batch_project.daemon import StatusDaemon, daemon_request
+from batch_project.profiling import profiled, span, add_profiling_args
 
 
+def add_s3_cache_args(parser):
+    """Options for remembering S3 outputs across runs."""
+    parser.add_argument("--s3-cache",
+                        type=str,
+                        default=None,
+                        help="""SQLite file of S3 outputs already found (default: $BATCH_S3_CACHE_DB)""")
+    parser.add_argument("--s3-cache-max-age",
+                        type=float,
+                        default=None,
+                        help="""Seconds before a remembered output is checked again (default: 7 days)""")
+    parser.add_argument("--s3-inventory",
+                        type=str,
+                        action="append",
+                        default=[],
+                        help="""S3 Inventory manifest.json (local or s3://) or saved .npy index, may be repeated""")
+    parser.add_argument("--s3-events",
+                        type=str,
+                        default=None,
+                        help="""URL of an SQS queue receiving S3 object notifications""")
+
+
+def add_job_event_args(parser):
+    """Options for following job status through Batch events."""
+    parser.add_argument("--job-events",
+                        type=str,
+                        default=None,
+                        help="""URL of an SQS queue receiving Batch job state change events""")
+    parser.add_argument("--job-reconcile-interval",
+                        type=float,
+                        default=600,
+                        help="""With --job-events, seconds between checking every job with Batch""")
+
+
+def add_api_metrics_args(parser):
+    """Option for exporting the AWS API calls made by a command."""
+    parser.add_argument("--api-metrics",
+                        type=str,
+                        default=None,
+                        help="""Write the AWS API call counts and latencies to this file
+                        (Prometheus textfile if it ends in .prom, otherwise JSON)""")
+
+
+def export_api_metrics(args):
+    """Save the AWS API call metrics, if requested."""
+    if args.api_metrics is not None:
+        api_metrics.export(args.api_metrics)
+
+
+def add_daemon_args(parser):
+    """Option for skipping the status daemon."""
+    parser.add_argument("--no-daemon",
+                        action="store_true",
+                        help="""Check directly, even if a status daemon (batch_project daemon) is running""")
+
+
+def use_daemon(args):
+    """Whether to ask the status daemon, which can't apply the options for checking directly."""
+    if args.no_daemon:
+        return False
+    return all([
+        getattr(args, k, None) in [None, []]
+        for k in ["s3_cache", "s3_inventory", "s3_events", "job_events", "api_metrics"]
+    ])
+
+
+def add_cancel_args(parser):
+    """Options for how quickly jobs are cancelled."""
+    parser.add_argument("--threads",
+                        type=int,
+                        default=8,
+                        help="""Number of jobs to cancel at the same time""")
+    parser.add_argument("--max-per-second",
+                        type=float,
+                        default=20,
+                        help="""Most cancel/terminate calls to make per second""")
+
+
+def job_events_from_args(args):
+    """Set up the job status tracker from the command line options."""
+    if args.job_events is None:
+        return None
+    return JobStatusTracker(
+        args.job_events,
+        reconcile_interval=args.job_reconcile_interval
+    )
+
+
+def s3_contents_from_args(args, ttl=300):
+    """Set up the S3 existence checks from the command line options."""
+    inventory = []
+    if len(args.s3_inventory) > 0:
+        # Only load numpy when an inventory is used
+        from batch_helpers.inventory import load_inventory
+        inventory = [load_inventory(path) for path in args.s3_inventory]
+
+    return S3FolderContents(
+        cache_db=args.s3_cache,
+        cache_max_age=args.s3_cache_max_age,
+        inventory=inventory,
+        event_queue=args.s3_events,
+        ttl=ttl
+    )
+
+
+@profiled
 def clear_queue():
     parser = argparse.ArgumentParser(description="""
     Cancel or terminate all of the jobs in a queue.
@@ -26,6 +136,8 @@ def clear_queue():
     parser.add_argument("--status",
                         type=str,
                         help="""Subset to jobs with a certain status""")
+    add_cancel_args(parser)
+    add_profiling_args(parser)
 
     # No arguments were passed in
     if len(sys.argv) < 2:
@@ -35,7 +147,7 @@ def clear_queue():
     args = parser.parse_args()
 
     # Connect to AWS Batch
-    client = boto3.client("batch")
+    client = get_client("batch")
 
     jobs = []
 
@@ -49,17 +161,21 @@ def clear_queue():
         # Make into a list
         job_status = [job_status]
     for js in job_status:
-        r = client.list_jobs(
-            jobQueue=args.queue_name,
-            jobStatus=js
-        )
-        jobs.extend(r["jobSummaryList"])
-        while r.get("nextToken") is not None:
+        with span("Batch calls"):
             r = client.list_jobs(
                 jobQueue=args.queue_name,
                 jobStatus=js,
-                nextToken=r["nextToken"]
+                maxResults=1000
             )
+        jobs.extend(r["jobSummaryList"])
+        while r.get("nextToken") is not None:
+            with span("Batch calls"):
+                r = client.list_jobs(
+                    jobQueue=args.queue_name,
+                    jobStatus=js,
+                    maxResults=1000,
+                    nextToken=r["nextToken"]
+                )
             jobs.extend(r["jobSummaryList"])
 
     # Subset to jobs with a given status
@@ -80,24 +196,46 @@ def clear_queue():
     # Get a message to submit as justfication for the failure
     cancel_msg = input("What message should describe these cancellations?\n")
 
-    for j in jobs:
-        if j["status"] not in ["SUCCEEDED", "FAILED", "CANCELED"]:
-            print("Cancelling {}".format(j["jobId"]))
-            client.cancel_job(jobId=j["jobId"], reason=cancel_msg)
-            client.terminate_job(jobId=j["jobId"], reason=cancel_msg)
+    cancel_jobs(
+        [(j["jobId"], j["status"]) for j in jobs],
+        cancel_msg,
+        n_threads=args.threads,
+        max_per_second=args.max_per_second
+    )
 
 
+@profiled
 def queue_status():
     parser = argparse.ArgumentParser(description="""
-    List the status of all of the jobs in a queue.
+    List the status of all of the jobs in one or more queues.
     """)
 
     parser.add_argument("queue_name",
                         type=str,
-                        help="""Name of job queue""")
+                        nargs="+",
+                        help="""Name of job queue(s)""")
     parser.add_argument("--status",
                         type=str,
-                        help="""Job status to check""")
+                        action="append",
+                        help="""Job status to check, may be repeated""")
+    parser.add_argument("--watch",
+                        action="store_true",
+                        help="""Keep refreshing, showing the change since the last refresh""")
+    parser.add_argument("--interval",
+                        type=float,
+                        default=30,
+                        help="""With --watch, seconds between refreshes""")
+    parser.add_argument("--threads",
+                        type=int,
+                        default=8,
+                        help="""Number of statuses to list at once""")
+    parser.add_argument("--full-listing-interval",
+                        type=float,
+                        default=600,
+                        help="""With --watch, seconds between listing every SUCCEEDED and
+                        FAILED job (in between, only the jobs which finished since are checked)""")
+    add_daemon_args(parser)
+    add_profiling_args(parser)
 
     # No arguments were passed in
     if len(sys.argv) < 2:
@@ -106,72 +244,200 @@ def queue_status():
 
     args = parser.parse_args()
 
-    # Connect to AWS Batch
-    client = boto3.client("batch")
-
-    jobs = []
-
     if args.status is None:
         job_status = ["SUBMITTED", "PENDING", "RUNNABLE", "STARTING", "RUNNING", "SUCCEEDED"]
     else:
         job_status = args.status
-        assert job_status in ["SUBMITTED", "PENDING",
-                              "RUNNABLE", "STARTING", "RUNNING", "SUCCEEDED"]
-        # Make into a list
-        job_status = [job_status]
-    for js in job_status:
-        r = client.list_jobs(
-            jobQueue=args.queue_name,
-            jobStatus=js
+        for js in job_status:
+            assert js in ["SUBMITTED", "PENDING", "RUNNABLE",
+                          "STARTING", "RUNNING", "SUCCEEDED", "FAILED"]
+
+    if not args.watch:
+        status = get_queue_counts(args, job_status)
+        print(count_table({
+            js: {
+                queue_name: status[queue_name]["counts"].get(js, 0)
+                for queue_name in args.queue_name
+            }
+            for js in job_status
+        }))
+        return
+
+    # The listing last shown for each queue
+    prev = {}
+    watches = {
+        queue_name: QueueWatch(queue_name, job_status, full_interval=args.full_listing_interval)
+        for queue_name in args.queue_name
+    }
+    while True:
+        # Stop times are only needed since the oldest listing shown
+        stopped_after = min(
+            [p["updated"] for p in prev.values()],
+            default=time.time() - args.interval
         )
-        jobs.extend(r["jobSummaryList"])
-        while r.get("nextToken") is not None:
-            r = client.list_jobs(
-                jobQueue=args.queue_name,
-                jobStatus=js,
-                nextToken=r["nextToken"]
+        status = get_queue_counts(args, job_status, stopped_after=stopped_after, watches=watches)
+
+        # The daemon serves the same listing until its next refresh
+        fresh = [
+            queue_name for queue_name in args.queue_name
+            if queue_name not in prev or status[queue_name]["updated"] > prev[queue_name]["updated"]
+        ]
+        if len(fresh) == 0:
+            time.sleep(args.interval)
+            continue
+
+        rows = []
+        for js in job_status:
+            row = [js]
+            for queue_name in args.queue_name:
+                n = status[queue_name]["counts"].get(js, 0)
+                if queue_name not in fresh:
+                    row.append("{:,} (cached)".format(n))
+                elif queue_name not in prev:
+                    row.append("{:,}".format(n))
+                else:
+                    row.append("{:,} ({:+,})".format(n, n - prev[queue_name]["counts"].get(js, 0)))
+            rows.append(row)
+
+        # Jobs finishing per minute, from the jobs which stopped since the last listing
+        if "SUCCEEDED" in job_status or "FAILED" in job_status:
+            row = ["finished / min"]
+            for queue_name in args.queue_name:
+                if queue_name not in fresh:
+                    row.append("(cached)")
+                    continue
+                updated = status[queue_name]["updated"]
+                if queue_name in prev:
+                    since = prev[queue_name]["updated"]
+                else:
+                    since = updated - args.interval
+                n_finished = sum([
+                    n for stopped_at, n in status[queue_name]["stopped"]
+                    if since < stopped_at / 1000. <= updated
+                ])
+                row.append("{:,.1f}".format(n_finished * 60 / (updated - since)))
+            rows.append(row)
+
+        # Redraw the table in place on a terminal
+        if sys.stdout.isatty():
+            print("\033[2J\033[H", end="")
+        print(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(
+            min([status[queue_name]["updated"] for queue_name in args.queue_name])
+        )))
+        print(format_table(rows, [""] + args.queue_name, align_right=True) + "\n")
+        sys.stdout.flush()
+
+        for queue_name in fresh:
+            prev[queue_name] = status[queue_name]
+        time.sleep(args.interval)
+
+
+def get_queue_counts(args, job_status, stopped_after=None, watches=None):
+    """Jobs in each queue by status, from the status daemon if one is running.
+
+    Returns {queue: {"updated", "counts", "stopped"}}, where `stopped` lists
+    when the finished jobs which stopped after `stopped_after` stopped.
+    Queues are listed again with `watches` ({queue: QueueWatch}) if given.
+    """
+    if use_daemon(args):
+        request = {"cmd": "queue_status", "job_status": job_status}
+        # The daemon keeps stop times for at least as long as asked
+        if stopped_after is not None:
+            request["stopped_seconds"] = time.time() - stopped_after
+        status = {
+            queue_name: daemon_request(dict(request, queue=queue_name))
+            for queue_name in args.queue_name
+        }
+        if all([s is not None for s in status.values()]):
+            return status
+
+    # Jobs stopping while the queues are listed are counted from the next listing
+    if watches is not None:
+        status = {}
+        for queue_name in args.queue_name:
+            updated = time.time()
+            counts, stopped = watches[queue_name].refresh(
+                stopped_after=stopped_after, n_threads=args.threads
             )
-            jobs.extend(r["jobSummaryList"])
-
-    status_counts = defaultdict(int)
-    for j in jobs:
-        status_counts[j["status"]] += 1
-    print(pd.DataFrame({args.queue_name: status_counts}))
+            status[queue_name] = {"updated": updated, "counts": counts, "stopped": stopped}
+        return status
 
+    updated = time.time()
+    counts, stopped = list_queues(
+        args.queue_name, job_status, n_threads=args.threads, stopped_after=stopped_after
+    )
+    return {
+        queue_name: {
+            "updated": updated,
+            "counts": counts[queue_name],
+            "stopped": stopped[queue_name]
+        }
+        for queue_name in args.queue_name
+    }
+
+
+def dashboard_status(args):
+    """Status of every project in the current directory, and the number completed."""
+    # Share the S3 folder listings and job events across all of the projects
+    s3_contents = s3_contents_from_args(args)
+    job_events = job_events_from_args(args)
 
-def dashboard():
-    """Print a summary of all projects."""
     # Walk through all of the projects in the currect directory
     dat = {}  # Key by path
 
     n_completed = 0
-    for root, subdirs, files in os.walk(os.getcwd()):
-        for file in files:
-            if file[0] == '_':
-                continue
-            if file.endswith(".json"):
-                fp = os.path.join(root, file)
-                try:
-                    config = json.load(open(fp, "rt"))
-                except ValueError:
-                    raise Exception("Cannot open {}".format(fp))
-                if valid_workflow(config, verbose=False):
-                    if config["status"] == "COMPLETED":
-                        n_completed += 1
-                    else:
-                        dat[fp] = get_workflow_status(fp)
+    for fp in find_workflow_files(os.getcwd()):
+        try:
+            with span("load JSON"):
+                config = json.load(open(fp, "rt"))
+        except ValueError:
+            raise Exception("Cannot open {}".format(fp))
+        if valid_workflow(config, verbose=False):
+            if config["status"] == "COMPLETED":
+                n_completed += 1
+            else:
+                dat[fp] = get_workflow_status(
+                    fp,
+                    s3_contents=s3_contents,
+                    job_events=job_events
+                )
+    return dat, n_completed
+
+
+@profiled
+def dashboard():
+    """Print a summary of all projects."""
+    parser = argparse.ArgumentParser(description="""
+    Print a summary of all projects in the current directory.
+    """)
+    add_s3_cache_args(parser)
+    add_job_event_args(parser)
+    add_api_metrics_args(parser)
+    add_daemon_args(parser)
+    add_profiling_args(parser)
+    args = parser.parse_args()
+
+    # Use the status daemon, if one is running
+    r = None
+    if use_daemon(args):
+        r = daemon_request({"cmd": "dashboard", "root": os.getcwd()})
+    if r is not None:
+        dat, n_completed = r["projects"], r["completed"]
+    else:
+        dat, n_completed = dashboard_status(args)
+
+    export_api_metrics(args)
 
     if len(dat) == 0:
         print("All projects are completed ({:,})".format(n_completed))
         return
 
-    df = pd.DataFrame(dat).fillna(0).T
-    df = df.reset_index().sort_values(by="index").set_index("index")
-    print(tabulate(df, headers="keys"))
+    print(count_table(dat, index_header="index", sort_index=True))
 
     print("\nCompleted projects: {}".format(n_completed))
 
 
+@profiled
 def main():
     """Main function invoked by the user."""
 
@@ -182,7 +448,8 @@ def main():
     parser.add_argument("cmd",
                         type=str,
                         help="""Command to run:
-                        import, create, submit, status, cancel, logs, or resubmit""")
+                        import, create, submit, status, cancel, logs, resubmit, analytics, or daemon""")
+    add_profiling_args(parser)
 
     # No arguments were passed in
     if len(sys.argv) < 2:
@@ -193,7 +460,7 @@ def main():
 
     valid_cmds = [
         "submit", "status", "cancel", "logs",
-        "resubmit", "import", "create"
+        "resubmit", "import", "create", "analytics", "daemon"
     ]
     msg = "Please specify a command: {}".format(", ".join(valid_cmds))
     assert args.cmd in valid_cmds, msg
@@ -212,6 +479,10 @@ def main():
         import_project()
     elif args.cmd == "create":
         create()
+    elif args.cmd == "analytics":
+        analytics()
+    elif args.cmd == "daemon":
+        daemon()
 
 
 def submit():
@@ -223,10 +494,14 @@ def submit():
                         type=str,
                         help="""Path to JSON with workflow for project""")
 
+    add_s3_cache_args(parser)
+    add_api_metrics_args(parser)
+
     args = parser.parse_args(sys.argv[2:])
 
     # Submit the entire set of jobs in the workflow for analysis
-    submit_workflow(args.workflow)
+    submit_workflow(args.workflow, s3_contents=s3_contents_from_args(args))
+    export_api_metrics(args)
 
 
 def status():
@@ -238,14 +513,29 @@ def status():
                         type=str,
                         help="""Path to JSON with workflow for project""")
 
+    add_s3_cache_args(parser)
+    add_job_event_args(parser)
+    add_api_metrics_args(parser)
+    add_daemon_args(parser)
+
     args = parser.parse_args(sys.argv[2:])
 
-    print(
-        json.dumps(
-            get_workflow_status(args.workflow),
-            indent=4
+    # Use the status daemon, if one is running
+    status_counts = None
+    if use_daemon(args):
+        status_counts = daemon_request({
+            "cmd": "status",
+            "workflow": os.path.abspath(args.workflow)
+        })
+    if status_counts is None:
+        status_counts = get_workflow_status(
+            args.workflow,
+            s3_contents=s3_contents_from_args(args),
+            job_events=job_events_from_args(args)
         )
-    )
+
+    print(json.dumps(status_counts, indent=4))
+    export_api_metrics(args)
 
 def cancel():
     parser = argparse.ArgumentParser(description="""
@@ -260,10 +550,16 @@ def cancel():
                         type=str,
                         default=None,
                         help="""If specified, only cancel jobs with this status (e.g. RUNNABLE)""")
+    add_cancel_args(parser)
 
     args = parser.parse_args(sys.argv[2:])
 
-    cancel_workflow_jobs(args.workflow, status=args.status)
+    cancel_workflow_jobs(
+        args.workflow,
+        status=args.status,
+        n_threads=args.threads,
+        max_per_second=args.max_per_second
+    )
 
 
 
@@ -276,9 +572,46 @@ def logs():
                         type=str,
                         help="""Path to JSON with workflow for project""")
 
+    parser.add_argument("--gzip",
+                        action="store_true",
+                        help="""Compress the log files""")
+
+    parser.add_argument("--threads",
+                        type=int,
+                        default=16,
+                        help="""Number of log streams to download at once""")
+
+    args = parser.parse_args(sys.argv[2:])
+
+    save_workflow_logs(
+        args.workflow,
+        compress=args.gzip,
+        n_threads=args.threads
+    )
+
+
+def analytics():
+    parser = argparse.ArgumentParser(description="""
+    Report the queue wait, runtime and throughput of the jobs for a project
+    """)
+
+    parser.add_argument("workflow",
+                        type=str,
+                        help="""Path to JSON with workflow for project""")
+
+    parser.add_argument("--freq",
+                        type=str,
+                        default="1h",
+                        help="""Interval for counting the jobs finished over time (e.g. 15min, 1h, 1d)""")
+
+    parser.add_argument("--csv",
+                        type=str,
+                        default=None,
+                        help="""Also write the timing of each job to this CSV""")
+
     args = parser.parse_args(sys.argv[2:])
 
-    save_workflow_logs(args.workflow)
+    workflow_analytics(args.workflow, freq=args.freq, csv_fp=args.csv)
 
 
 def resubmit():
@@ -351,3 +684,46 @@ def create():
         args.template
     )
 
+
+def daemon():
+    parser = argparse.ArgumentParser(description="""
+    Keep the status of projects and queues up to date in the background,
+    answering status, batch_dashboard and batch_queue_status straight away
+    """)
+
+    parser.add_argument("--socket",
+                        type=str,
+                        default=None,
+                        help="""Path of the Unix socket (default: $BATCH_PROJECT_SOCKET or ~/.batch_project/daemon.sock)""")
+
+    parser.add_argument("--refresh-interval",
+                        type=float,
+                        default=60,
+                        help="""Seconds between refreshing each project and queue""")
+
+    parser.add_argument("--stopped-seconds",
+                        type=float,
+                        default=600,
+                        help="""Seconds of stop times kept for each queue, from which
+                        the finishing rate is worked out (longer if a client asks)""")
+
+    parser.add_argument("--full-listing-interval",
+                        type=float,
+                        default=600,
+                        help="""Seconds between listing every SUCCEEDED and FAILED job
+                        in a queue (in between, only the jobs which finished since are checked)""")
+
+    add_s3_cache_args(parser)
+    add_job_event_args(parser)
+
+    args = parser.parse_args(sys.argv[2:])
+
+    StatusDaemon(
+        socket_path=args.socket,
+        refresh_interval=args.refresh_interval,
+        stopped_seconds=args.stopped_seconds,
+        full_listing_interval=args.full_listing_interval,
+        # Folders are listed again on the same schedule as the refresh
+        s3_contents=s3_contents_from_args(args, ttl=args.refresh_interval),
+        job_events=job_events_from_args(args)
+    ).serve_forever()
@@ -0,0 +1,102 @@
+"""Pack the jobs for several samples into a single Batch job.
+
+An analysis with `samples_per_job` > 1 is submitted as one job per group
+of samples. The job definition's command is rendered for each sample (as
+Batch would, replacing Ref::<parameter>), and the commands and outputs
+are written to a manifest in S3. The packed job then runs
+batch_helpers.pack_runner on the manifest, which runs the command for
+each sample (`parallel` at a time) and skips samples whose outputs exist.
+"""
+import json
+from batch_helpers.aws import get_client
+
+# Command which runs a manifest inside the container
+DEFAULT_PACK_RUNNER = ["python3", "-m", "batch_helpers.pack_runner"]
+
+# Most jobs which a single job can depend on
+MAX_DEPENDENCIES = 20
+
+# Job definitions looked up so far, keyed by name (with or without the revision)
+_job_definitions = {}
+
+
+def get_job_definition(job_definition):
+    """Details of a job definition, using the latest active revision if none is given."""
+    if job_definition not in _job_definitions:
+        client = get_client("batch")
+        # Definitions are given as name:revision (or an ARN), or just by name
+        if ":" in job_definition:
+            kwargs = {"jobDefinitions": [job_definition]}
+        else:
+            kwargs = {"jobDefinitionName": job_definition, "status": "ACTIVE"}
+        matching = []
+        while True:
+            r = client.describe_job_definitions(**kwargs)
+            matching.extend([
+                jd for jd in r["jobDefinitions"]
+                if jd.get("status", "ACTIVE") == "ACTIVE"
+            ])
+            if r.get("nextToken") is None:
+                break
+            kwargs["nextToken"] = r["nextToken"]
+        assert len(matching) > 0, "Job definition not found: {}".format(job_definition)
+        _job_definitions[job_definition] = max(matching, key=lambda jd: jd["revision"])
+    return _job_definitions[job_definition]
+
+
+def render_command(command, parameters):
+    """Replace each Ref::<name> in a command with the value of the parameter."""
+    # Longer names first, so that Ref::input_2 isn't replaced as Ref::input
+    names = sorted(parameters.keys(), key=lambda k: -len(k))
+    rendered = []
+    for arg in command:
+        arg = str(arg)
+        for name in names:
+            arg = arg.replace("Ref::" + name, str(parameters[name]))
+        rendered.append(arg)
+    return rendered
+
+
+def sample_command(analysis_config, parameters):
+    """The command the job definition would run for one sample with these parameters."""
+    jd = get_job_definition(analysis_config["job_definition"])
+    command = analysis_config.get("containerOverrides", {}).get(
+        "command", jd["containerProperties"].get("command", [])
+    )
+    assert len(command) > 0, \
+        "Job definition {} has no command to run for each sample".format(
+            analysis_config["job_definition"])
+
+    # Parameters given for the sample take precedence over the defaults
+    all_parameters = dict(jd.get("parameters", {}))
+    all_parameters.update(parameters)
+    return render_command(command, all_parameters)
+
+
+def manifest_path(analysis_config, job_name, outputs):
+    """Where to write the manifest for a packed job.
+
+    By default this is a _batch_manifests folder next to the first output
+    of the first sample.
+    """
+    folder = analysis_config.get("manifest_folder")
+    if folder is None:
+        folder = outputs[0].rsplit("/", 1)[0] + "/_batch_manifests"
+    return "{}/{}.json".format(folder.rstrip("/"), job_name)
+
+
+def write_manifest(s3_path, manifest):
+    assert s3_path.startswith("s3://"), "Manifests must be written to S3"
+    bucket, key = s3_path[5:].split("/", 1)
+    get_client("s3").put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=json.dumps(manifest, indent=4).encode("utf-8")
+    )
+
+
+def pack_container_overrides(analysis_config, manifest_fp):
+    """Overrides for a packed job, running the manifest in place of the usual command."""
+    overrides = dict(analysis_config.get("containerOverrides", {}))
+    overrides["command"] = analysis_config.get("pack_runner", DEFAULT_PACK_RUNNER) + [manifest_fp]
+    return overrides
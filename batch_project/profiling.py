@@ -0,0 +1,150 @@
+"""Optional profiling of the command line tools (--profile and --trace-memory)."""
+import sys
+import time
+import argparse
+import functools
+import threading
+from collections import defaultdict
+from batch_helpers.api_metrics import api_metrics
+
+# Total time and number of times each phase was run, when enabled
+phase_seconds = defaultdict(float)
+phase_count = defaultdict(int)
+_phase_lock = threading.Lock()
+_enabled = False
+
+# Phases run in worker threads overlap, so they are totalled separately
+THREAD_SUFFIX = " (threads)"
+
+
+class _Span:
+    """Add the time spent inside the block to a phase."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.perf_counter() - self.start
+        name = self.name
+        if threading.current_thread() is not threading.main_thread():
+            name += THREAD_SUFFIX
+        with _phase_lock:
+            phase_seconds[name] += elapsed
+            phase_count[name] += 1
+
+
+class _NoSpan:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_no_span = _NoSpan()
+
+
+def span(name):
+    """Time a phase of a command, e.g. `with span("S3 checks"):`, if profiling is enabled."""
+    if not _enabled:
+        return _no_span
+    return _Span(name)
+
+
+def add_profiling_args(parser):
+    """Options for profiling a command (accepted anywhere on the command line)."""
+    parser.add_argument("--profile",
+                        type=str,
+                        default=None,
+                        help="""Write a cProfile (pstats) file to this path, and print
+                        the time spent in each phase of the command""")
+    parser.add_argument("--trace-memory",
+                        type=str,
+                        default=None,
+                        help="""Write a tracemalloc snapshot to this path, and print
+                        the lines which allocated the most memory""")
+
+
+def pop_profiling_args():
+    """Remove the profiling options from sys.argv, returning their values."""
+    parser = argparse.ArgumentParser(add_help=False)
+    add_profiling_args(parser)
+    args, remaining = parser.parse_known_args(sys.argv[1:])
+    sys.argv = sys.argv[:1] + remaining
+    return args
+
+
+def profiled(f):
+    """Run an entry point with the profiling requested on the command line."""
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        options = pop_profiling_args()
+        if options.profile is None and options.trace_memory is None:
+            return f(*args, **kwargs)
+
+        # The profilers are only imported when they are used
+        import cProfile
+        import tracemalloc
+
+        global _enabled
+        _enabled = True
+        phase_seconds.clear()
+        phase_count.clear()
+        if options.trace_memory is not None:
+            tracemalloc.start()
+        profiler = cProfile.Profile() if options.profile is not None else None
+
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            elapsed = time.perf_counter() - start
+            report(elapsed, profiler, options)
+            _enabled = False
+    return wrapper
+
+
+def report(elapsed, profiler, options):
+    """Write out the profiles and print a summary to stderr."""
+    import pstats
+    import tracemalloc
+    out = sys.stderr
+
+    print("\nTime by phase (total {:.3f}s):".format(elapsed), file=out)
+    with _phase_lock:
+        phases = sorted(phase_seconds.items(), key=lambda x: -x[1])
+    for name, seconds in phases:
+        print("  {:<30}{:>10.3f}s{:>12,} times".format(
+            name, seconds, phase_count[name]
+        ), file=out)
+    if any([name.endswith(THREAD_SUFFIX) for name, _ in phases]):
+        print("  Phases marked{} are summed over the worker threads, so may add up to more than the total".format(
+            THREAD_SUFFIX
+        ), file=out)
+
+    summary = api_metrics.summary()
+    if len(summary) > 0:
+        print("\nAWS API calls:\n" + summary, file=out)
+
+    if profiler is not None:
+        profiler.dump_stats(options.profile)
+        print("\nWrote profile to {}, slowest functions:".format(options.profile), file=out)
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(20)
+
+    if options.trace_memory is not None:
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        snapshot.dump(options.trace_memory)
+        print("\nWrote memory snapshot to {} (peak {:,.1f} MB), largest allocations:".format(
+            options.trace_memory, peak / 1024 / 1024
+        ), file=out)
+        for stat in snapshot.statistics("lineno")[:20]:
+            print("  {}".format(stat), file=out)
@@ -0,0 +1,147 @@
+"""Refresh the status of a workflow's jobs with as few Batch API calls as possible."""
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from batch_helpers.aws import get_client
+from batch_helpers.analytics import job_times
+
+# Statuses which a job can still move on from
+ACTIVE_STATUSES = ["SUBMITTED", "PENDING", "RUNNABLE", "STARTING", "RUNNING"]
+
+# Statuses which never change (CANCELED and COMPLETED are only used locally)
+TERMINAL_STATUSES = ["SUCCEEDED", "FAILED", "CANCELED", "COMPLETED"]
+
+# Jobs returned per call
+DESCRIBE_PAGE = 100
+LIST_PAGE = 1000
+
+
+def n_pages(n, page_size):
+    """Number of calls needed to fetch n items (at least one)."""
+    return max(1, (n + page_size - 1) // page_size)
+
+
+def plan_status_refresh(jobs, queue_counts=None):
+    """Decide, for each queue, whether to describe the jobs or to list the queue.
+
+    `jobs` is a list of (job ID, queue, last known status). Listing a queue
+    pages through every job with an active status, including those from
+    other workflows, so `queue_counts` ({queue: {status: n}}, as seen the
+    last time the queue was listed) is used to estimate its size. Jobs
+    which have left the active lists are then described, and the number of
+    those is estimated as the jobs which were last seen STARTING or RUNNING.
+
+    Returns (job IDs to describe, {queue: job IDs to find by listing}).
+    """
+    if queue_counts is None:
+        queue_counts = {}
+
+    by_queue = defaultdict(list)
+    for job_id, queue, status in jobs:
+        by_queue[queue].append((job_id, status))
+
+    to_describe = []
+    to_list = {}
+    for queue, queue_jobs in by_queue.items():
+        describe_cost = n_pages(len(queue_jobs), DESCRIBE_PAGE)
+
+        # Jobs in each status, counting other workflows seen in the queue before
+        counts = defaultdict(int)
+        for _, status in queue_jobs:
+            counts[status] += 1
+        list_cost = sum([
+            n_pages(max(counts[status], queue_counts.get(queue, {}).get(status, 0)), LIST_PAGE)
+            for status in ACTIVE_STATUSES
+        ])
+        n_finishing = counts["STARTING"] + counts["RUNNING"]
+        if n_finishing > 0:
+            list_cost += n_pages(n_finishing, DESCRIBE_PAGE)
+
+        if list_cost < describe_cost:
+            to_list[queue] = [job_id for job_id, _ in queue_jobs]
+        else:
+            to_describe.extend([job_id for job_id, _ in queue_jobs])
+
+    return to_describe, to_list
+
+
+class StatusRefresh:
+    """Fetch the status of a set of jobs from Batch in the background.
+
+    The calls start as soon as the object is created, so that other work
+    (e.g. checking for outputs in S3) can be done while they run.
+    """
+
+    def __init__(self, jobs, queue_counts=None, n_threads=8):
+        self.client = get_client("batch")
+        self.to_describe, self.to_list = plan_status_refresh(jobs, queue_counts)
+
+        self.pool = ThreadPoolExecutor(max_workers=n_threads)
+        self.describe_futures = self.start_describe(self.to_describe)
+        self.list_futures = [
+            (queue, status, self.pool.submit(self.list_queue, queue, status, set(job_ids)))
+            for queue, job_ids in self.to_list.items()
+            for status in ACTIVE_STATUSES
+        ]
+
+    def start_describe(self, job_ids):
+        return [
+            self.pool.submit(self.describe, job_ids[ix:ix + DESCRIBE_PAGE])
+            for ix in range(0, len(job_ids), DESCRIBE_PAGE)
+        ]
+
+    def describe(self, job_ids):
+        """Status and timestamps of up to 100 jobs."""
+        r = self.client.describe_jobs(jobs=job_ids)
+        return {j["jobId"]: (j["status"], job_times(j)) for j in r["jobs"]}
+
+    def list_queue(self, queue, status, job_ids):
+        """Count the jobs in a queue with a status, keeping only the jobs in job_ids."""
+        found = {}
+        n_jobs = 0
+        kwargs = {"jobQueue": queue, "jobStatus": status, "maxResults": LIST_PAGE}
+        while True:
+            r = self.client.list_jobs(**kwargs)
+            n_jobs += len(r["jobSummaryList"])
+            for j in r["jobSummaryList"]:
+                if j["jobId"] in job_ids:
+                    found[j["jobId"]] = (j["status"], job_times(j))
+            if r.get("nextToken") is None:
+                break
+            kwargs["nextToken"] = r["nextToken"]
+        return found, n_jobs
+
+    def result(self, skip=None):
+        """Wait for the calls to finish, returning ({job ID: status}, queue_counts, {job ID: times}).
+
+        The times are the timestamps (and number of attempts, for jobs which
+        were described) reported for each job.
+
+        Jobs in `skip` (e.g. those already known to have SUCCEEDED) are not
+        described if they turn out to have left a listed queue.
+        """
+        try:
+            found = {}
+            for future in self.describe_futures:
+                found.update(future.result())
+
+            queue_counts = defaultdict(dict)
+            for queue, status, future in self.list_futures:
+                listed, n_jobs = future.result()
+                found.update(listed)
+                queue_counts[queue][status] = n_jobs
+
+            # Jobs which are no longer active in a listed queue have finished
+            finished = [
+                job_id
+                for job_ids in self.to_list.values()
+                for job_id in job_ids
+                if job_id not in found and (skip is None or job_id not in skip)
+            ]
+            for future in self.start_describe(finished):
+                found.update(future.result())
+        finally:
+            self.pool.shutdown(wait=False)
+
+        statuses = {job_id: status for job_id, (status, _) in found.items()}
+        times = {job_id: times for job_id, (_, times) in found.items()}
+        return statuses, dict(queue_counts), times
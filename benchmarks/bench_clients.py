@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""Compare creating a new boto3 client per call against the shared client factory."""
+
+import sys
+import time
+import boto3
+import argparse
+from botocore.stub import Stubber
+from batch_helpers.aws import get_client, reset_clients
+
+
+def time_it(f, n):
+    """Return the mean time (in ms) of calling f() n times."""
+    start = time.perf_counter()
+    for _ in range(n):
+        f()
+    return 1000 * (time.perf_counter() - start) / n
+
+
+def stubbed_list(client, bucket):
+    """Make a single list_objects_v2 call without going over the network."""
+    with Stubber(client) as stubber:
+        stubber.add_response(
+            "list_objects_v2",
+            {"Contents": [], "IsTruncated": False},
+            {"Bucket": bucket, "Prefix": "prefix/"}
+        )
+        client.list_objects_v2(Bucket=bucket, Prefix="prefix/")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""
+    Benchmark client construction and per-call overhead.
+    """)
+
+    parser.add_argument("--n",
+                        type=int,
+                        default=50,
+                        help="""Number of repetitions""")
+    parser.add_argument("--bucket",
+                        type=str,
+                        default=None,
+                        help="""If specified, list this (real) bucket for the per-call test""")
+
+    args = parser.parse_args(sys.argv[1:])
+
+    # Startup: building a new client every time vs. reusing the shared one
+    reset_clients()
+    print("boto3.client('s3') per call:    {:.2f} ms".format(
+        time_it(lambda: boto3.client("s3"), args.n)))
+    print("get_client('s3') (first call):  {:.2f} ms".format(
+        time_it(lambda: get_client("s3"), 1)))
+    print("get_client('s3') (cached):      {:.4f} ms".format(
+        time_it(lambda: get_client("s3"), args.n)))
+
+    # Per-call: the old code built a client inside each folder listing
+    if args.bucket is None:
+        bucket = "example-bucket"
+        new_client = lambda: stubbed_list(boto3.client("s3"), bucket)
+        shared_client = lambda: stubbed_list(get_client("s3"), bucket)
+    else:
+        bucket = args.bucket
+        new_client = lambda: boto3.client("s3").list_objects_v2(
+            Bucket=bucket, MaxKeys=1)
+        shared_client = lambda: get_client("s3").list_objects_v2(
+            Bucket=bucket, MaxKeys=1)
+
+    print("list_objects_v2, new client:    {:.2f} ms".format(
+        time_it(new_client, args.n)))
+    print("list_objects_v2, shared client: {:.2f} ms".format(
+        time_it(shared_client, args.n)))
+
+
+if __name__ == "__main__":
+    main()
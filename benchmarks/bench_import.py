@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""Measure the startup time of the command line tools, and which heavy modules they load.
+
+Each command is run in a new Python process. With --check, exit with an
+error if a command loads pandas, boto3, tabulate or numpy, or if its
+startup takes longer than --max-ms, so that regressions can be caught in CI.
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+HEAVY_MODULES = ["pandas", "boto3", "botocore", "tabulate", "numpy"]
+
+# Code run for each command, which then reports the heavy modules it loaded
+COMMANDS = {
+    "python (baseline)": "pass",
+    "import batch_project.main": "import batch_project.main",
+    "import batch_helpers.batch_task_manager": "import batch_helpers.batch_task_manager",
+    "batch_project import --help": (
+        "import sys; sys.argv = ['batch_project', 'import', '--help']\n"
+        "from batch_project.main import main\n"
+        "try:\n"
+        "    main()\n"
+        "except SystemExit:\n"
+        "    pass"
+    ),
+    "batch_project status (COMPLETED)": (
+        "import sys; sys.argv = ['batch_project', 'status', {workflow!r}]\n"
+        "from batch_project.main import main\n"
+        "main()"
+    ),
+}
+
+REPORT = "\nprint(json.dumps([m for m in {heavy!r} if m in sys.modules]), file=sys.stderr)"
+
+
+def write_completed_workflow(fp):
+    """A workflow which has finished, so `status` can answer from the JSON alone."""
+    with open(fp, "wt") as fo:
+        json.dump({
+            "workflow_name": "bench",
+            "project_name": "bench",
+            "analyses": [],
+            "samples": [],
+            "jobs": [],
+            "status": "COMPLETED",
+        }, fo)
+
+
+def run_command(code, env):
+    """Run the code in a new interpreter, returning (milliseconds, heavy modules loaded)."""
+    timed = (
+        "import time\n_start = time.perf_counter()\n" + code +
+        "\n_elapsed = 1000 * (time.perf_counter() - _start)" +
+        "\nimport sys, json\nprint(json.dumps(_elapsed), file=sys.stderr)" +
+        REPORT.format(heavy=HEAVY_MODULES)
+    )
+    p = subprocess.run(
+        [sys.executable, "-c", timed],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    lines = p.stderr.strip().split("\n")
+    assert p.returncode == 0, p.stderr
+    return json.loads(lines[-2]), json.loads(lines[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""
+    Benchmark the startup time of the command line tools.
+    """)
+
+    parser.add_argument("--n",
+                        type=int,
+                        default=5,
+                        help="""Number of times to run each command""")
+    parser.add_argument("--max-ms",
+                        type=float,
+                        default=None,
+                        help="""With --check, the longest allowed startup (median, in ms)""")
+    parser.add_argument("--check",
+                        action="store_true",
+                        help="""Exit with an error if a command loads a heavy module or is too slow""")
+
+    args = parser.parse_args(sys.argv[1:])
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = root + os.pathsep + env.get("PYTHONPATH", "")
+    fd, workflow = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    write_completed_workflow(workflow)
+
+    failed = False
+    try:
+        print("{:<42}{:>12}   {}".format("command", "median (ms)", "heavy modules loaded"))
+        for name, code in COMMANDS.items():
+            times = []
+            for _ in range(args.n):
+                ms, heavy = run_command(code.format(workflow=workflow), env)
+                times.append(ms)
+            median = statistics.median(times)
+            print("{:<42}{:>12.1f}   {}".format(name, median, ", ".join(heavy)))
+
+            if name == "python (baseline)":
+                continue
+            if len(heavy) > 0 or (args.max_ms is not None and median > args.max_ms):
+                failed = True
+    finally:
+        os.remove(workflow)
+
+    if args.check and failed:
+        sys.exit("Startup regression: heavy modules loaded or startup slower than --max-ms")
+
+
+if __name__ == "__main__":
+    main()
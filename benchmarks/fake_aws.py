@@ -0,0 +1,449 @@
+"""In-process stand-in for AWS Batch, S3 and CloudWatch Logs, used for benchmarks.
+
+The fake answers the calls made by the real boto3 clients (created through
+batch_helpers.aws.get_client) from botocore's before-call event, the same
+way that botocore's Stubber does, so no network access or credentials are
+needed. Each call can be given a fixed latency, and calls above a given
+rate are throttled: they are sent on through the client's retry handling,
+which gets a real throttling error until the rate allows the call, so the
+backoff, the adaptive rate limiting and the retry metrics are all exercised
+(signing the throttled requests needs credentials, which can be fake).
+"""
+
+import io
+import time
+import uuid
+import hashlib
+import datetime
+import bisect
+import threading
+from collections import defaultdict
+from botocore.awsrequest import AWSResponse
+from botocore.response import StreamingBody
+from batch_helpers.aws import add_client_hook, remove_client_hook, reset_clients
+
+TERMINAL = ["SUCCEEDED", "FAILED"]
+
+# LastModified of objects which were not written while the fake was running
+OLD_OBJECT_TIME = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class RawBody:
+    """Stand-in for the urllib3 response read by botocore."""
+
+    def __init__(self, data):
+        self.data = io.BytesIO(data)
+
+    def stream(self, **kwargs):
+        yield self.data.read()
+
+    def read(self, *args, **kwargs):
+        return self.data.read(*args)
+
+    def close(self):
+        pass
+
+
+def throttling_response(protocol):
+    """A throttling error, as each kind of service sends it."""
+    if protocol == "rest-xml":
+        return AWSResponse(None, 503, {}, RawBody(
+            b"<Error><Code>SlowDown</Code><Message>Please reduce your request rate.</Message></Error>"
+        ))
+    return AWSResponse(None, 400, {"x-amzn-errortype": "ThrottlingException"}, RawBody(
+        b'{"__type": "ThrottlingException", "message": "Rate exceeded"}'
+    ))
+
+
+class FakeAWS:
+    """Simulated Batch, S3 and Logs services shared by every client."""
+
+    def __init__(self, latency=0, throttle_rps=None):
+        # Seconds added to every call
+        self.latency = latency
+        # Calls per second (per operation) above which calls are throttled
+        self.throttle_rps = throttle_rps
+
+        self.lock = threading.RLock()
+        self.calls = defaultdict(int)
+        self.throttles = defaultdict(int)
+        self.call_times = defaultdict(list)
+
+        # Batch state
+        self.job_definitions = {}
+        self.jobs = {}
+        self.jobs_by_queue = defaultdict(dict)
+
+        # S3 state, as bucket -> folder -> {name: size}
+        self.objects = defaultdict(lambda: defaultdict(dict))
+        self.sorted_names = {}
+        # Contents of objects written with PutObject
+        self.bodies = {}
+        # When each object was written, by (bucket, key)
+        self.modified = {}
+        # Multipart uploads in progress, as {UploadId: (bucket, key, {part number: body})}
+        self.uploads = {}
+
+    # Attaching to the clients
+
+    def install(self):
+        """Answer every call made by the package's shared clients."""
+        reset_clients()
+        add_client_hook(self.attach)
+        return self
+
+    def uninstall(self):
+        remove_client_hook(self.attach)
+        reset_clients()
+
+    def attach(self, service, client):
+        client.meta.events.register("before-parameter-build", self.save_params)
+        client.meta.events.register("before-call", self.respond)
+        client.meta.events.register("before-send", self.send_throttled)
+        client.meta.events.register("after-call", self.answer_throttled)
+
+    def save_params(self, params, context, **kwargs):
+        context["fake_aws_params"] = dict(params)
+
+    def respond(self, model, context, **kwargs):
+        operation = model.name
+        service = model.service_model.service_name
+        self.calls[operation] += 1
+
+        # Throttled calls go through the client's retries, see send_throttled
+        if self.simulate_network(operation):
+            context["fake_aws_operation"] = (service, operation, model.service_model.protocol)
+            return None
+
+        status, parsed = self.handle(service, operation, context["fake_aws_params"])
+        return AWSResponse(None, status, {}, None), parsed
+
+    def handle(self, service, operation, params):
+        """The HTTP status and parsed response of a call."""
+        handler = getattr(self, "{}_{}".format(service, operation).replace("-", "_"), None)
+        assert handler is not None, "{}.{} is not simulated".format(service, operation)
+
+        with self.lock:
+            r = handler(**params)
+
+        # Handlers return a tuple (code, status) to signal an error
+        if isinstance(r, tuple):
+            code, status = r
+            return status, {
+                "Error": {"Code": code, "Message": code},
+                "ResponseMetadata": {"HTTPStatusCode": status},
+            }
+        r["ResponseMetadata"] = {"HTTPStatusCode": 200}
+        return 200, r
+
+    def send_throttled(self, request, **kwargs):
+        """Answer each attempt at a throttled call, as the HTTP response would be.
+
+        The first attempt is always throttled, and the retries (made by the
+        client, with its backoff and rate limiting) are throttled for as long
+        as the operation is above the rate. The other attempts get an empty
+        response, which answer_throttled fills in once it has been parsed.
+        """
+        context = request.context
+        if "fake_aws_operation" not in context:
+            return None
+        service, operation, protocol = context["fake_aws_operation"]
+
+        if not context.get("fake_aws_attempted") or self.simulate_network(operation):
+            context["fake_aws_attempted"] = True
+            return throttling_response(protocol)
+
+        status, parsed = self.handle(service, operation, context["fake_aws_params"])
+        context["fake_aws_parsed"] = parsed
+        return AWSResponse(request.url, status, {}, RawBody(b"" if protocol == "rest-xml" else b"{}"))
+
+    def answer_throttled(self, parsed, context, **kwargs):
+        if "fake_aws_parsed" not in context:
+            return
+        # Keep the retry counts added by the client
+        metadata = parsed.get("ResponseMetadata", {})
+        parsed.clear()
+        parsed.update(context.pop("fake_aws_parsed"))
+        parsed["ResponseMetadata"] = dict(metadata, **parsed["ResponseMetadata"])
+
+    def simulate_network(self, operation):
+        """Add latency to an attempt, returning whether it is throttled."""
+        throttled = False
+        with self.lock:
+            if self.throttle_rps is not None:
+                now = time.time()
+                recent = self.call_times[operation]
+                while len(recent) > 0 and now - recent[0] > 1:
+                    recent.pop(0)
+                # Throttled attempts don't count towards the rate
+                if len(recent) >= self.throttle_rps:
+                    self.throttles[operation] += 1
+                    throttled = True
+                else:
+                    recent.append(now)
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return throttled
+
+    # Setting up and advancing the simulated state
+
+    def add_job_definition(self, name, revision=1, parameters=None, command=None):
+        self.job_definitions["{}:{}".format(name, revision)] = {
+            "jobDefinitionName": name,
+            "jobDefinitionArn": "arn:aws:batch:us-east-1:000000000000:job-definition/{}:{}".format(name, revision),
+            "revision": revision,
+            "status": "ACTIVE",
+            "type": "container",
+            "parameters": parameters if parameters is not None else {},
+            "containerProperties": {"command": command if command is not None else []},
+        }
+
+    def put_s3_object(self, s3_path, size=1):
+        bucket, key = s3_path[5:].split("/", 1)
+        folder, name = key.rsplit("/", 1) if "/" in key else ("", key)
+        with self.lock:
+            self.objects[bucket][folder][name] = size
+            self.modified[(bucket, key)] = datetime.datetime.now(datetime.timezone.utc)
+            self.sorted_names.pop((bucket, folder), None)
+
+    def submit_jobs(self, queue, n, status="RUNNABLE", at=None):
+        """Add n jobs to a queue (without counting the calls), returning their IDs."""
+        job_ids = []
+        for _ in range(n):
+            job_id = self.batch_SubmitJob(jobName="job", jobQueue=queue, jobDefinition="jd")["jobId"]
+            if status != "RUNNABLE":
+                self.set_job_status(job_id, status, at=at)
+            job_ids.append(job_id)
+        return job_ids
+
+    def set_job_status(self, job_id, status, outputs=None, at=None):
+        """Move a job to a new status (at a given epoch time, or now), writing its outputs if it SUCCEEDED."""
+        with self.lock:
+            job = self.jobs[job_id]
+            now = int((at if at is not None else time.time()) * 1000)
+            if status == "RUNNING":
+                job["startedAt"] = now
+            if status in TERMINAL:
+                job.setdefault("startedAt", now)
+                job["stoppedAt"] = now
+            job["status"] = status
+        if status == "SUCCEEDED" and outputs is not None:
+            for s3_path in outputs:
+                self.put_s3_object(s3_path)
+
+    # AWS Batch
+
+    def batch_SubmitJob(self, jobName, jobQueue, jobDefinition, **kwargs):
+        job_id = str(uuid.uuid4())
+        overrides = kwargs.get("containerOverrides", {})
+        self.jobs[job_id] = {
+            "jobId": job_id,
+            "jobName": jobName,
+            "jobQueue": jobQueue,
+            "jobDefinition": self.job_definitions.get(
+                jobDefinition, {"jobDefinitionArn": jobDefinition}
+            )["jobDefinitionArn"],
+            "status": "RUNNABLE",
+            "parameters": kwargs.get("parameters", {}),
+            "dependsOn": kwargs.get("dependsOn", []),
+            "createdAt": int(time.time() * 1000),
+            "timeout": kwargs.get("timeout", {}),
+            "attempts": [],
+            "container": {
+                "vcpus": overrides.get("vcpus", 1),
+                "memory": overrides.get("memory", 1024),
+                "command": overrides.get("command", []),
+                "environment": overrides.get("environment", []),
+                "logStreamName": "{}/default/{}".format(jobName, job_id),
+            },
+        }
+        self.jobs_by_queue[jobQueue][job_id] = self.jobs[job_id]
+        return {"jobName": jobName, "jobId": job_id}
+
+    def batch_DescribeJobs(self, jobs):
+        assert len(jobs) <= 100, "Too many jobs described at once"
+        return {"jobs": [dict(self.jobs[j]) for j in jobs if j in self.jobs]}
+
+    def batch_ListJobs(self, jobQueue, jobStatus="RUNNING", nextToken=None, maxResults=1000, filters=None):
+        # As in Batch, the status is ignored when filtering
+        if filters is not None:
+            assert filters[0]["name"] == "AFTER_CREATED_AT", "Only AFTER_CREATED_AT is supported"
+            created_after = int(filters[0]["values"][0])
+            matching = [
+                j for j in self.jobs_by_queue[jobQueue].values()
+                if j["createdAt"] > created_after
+            ]
+        else:
+            matching = [
+                j for j in self.jobs_by_queue[jobQueue].values()
+                if j["status"] == jobStatus
+            ]
+        start = int(nextToken) if nextToken is not None else 0
+        r = {
+            "jobSummaryList": [
+                {
+                    "jobId": j["jobId"],
+                    "jobName": j["jobName"],
+                    "status": j["status"],
+                    "createdAt": j["createdAt"],
+                    "startedAt": j.get("startedAt"),
+                    "stoppedAt": j.get("stoppedAt"),
+                }
+                for j in matching[start:start + maxResults]
+            ]
+        }
+        if start + maxResults < len(matching):
+            r["nextToken"] = str(start + maxResults)
+        return r
+
+    def batch_DescribeJobDefinitions(self, status=None, nextToken=None, jobDefinitions=None,
+                                     jobDefinitionName=None, **kwargs):
+        return {"jobDefinitions": [
+            jd for name, jd in self.job_definitions.items()
+            if (jobDefinitions is None or name in jobDefinitions) and
+            (jobDefinitionName is None or jd["jobDefinitionName"] == jobDefinitionName)
+        ]}
+
+    def batch_CancelJob(self, jobId, reason):
+        if jobId in self.jobs and self.jobs[jobId]["status"] in ["SUBMITTED", "PENDING", "RUNNABLE"]:
+            self.set_job_status(jobId, "FAILED")
+        return {}
+
+    def batch_TerminateJob(self, jobId, reason):
+        if jobId in self.jobs and self.jobs[jobId]["status"] not in TERMINAL:
+            self.set_job_status(jobId, "FAILED")
+        return {}
+
+    # Amazon S3
+
+    def list_folder(self, bucket, folder):
+        """Sorted names in a folder, cached until the folder changes."""
+        if (bucket, folder) not in self.sorted_names:
+            self.sorted_names[(bucket, folder)] = sorted(self.objects[bucket][folder])
+        return self.sorted_names[(bucket, folder)]
+
+    def s3_ListObjectsV2(self, Bucket, Prefix="", Delimiter=None, ContinuationToken=None, MaxKeys=1000, **kwargs):
+        folder, start = Prefix.rsplit("/", 1) if "/" in Prefix else ("", Prefix)
+
+        if Delimiter == "/":
+            folders = [folder]
+            # Only the next level of folders, as in S3
+            sub_prefixes = sorted(set([
+                Prefix + f[len(Prefix):].split("/", 1)[0] + "/"
+                for f in self.objects[Bucket]
+                if f.startswith(Prefix) and f != folder
+            ]))
+        else:
+            folders = sorted([
+                f for f in self.objects[Bucket]
+                if f == folder or f.startswith(Prefix)
+            ])
+            sub_prefixes = []
+
+        keys = []
+        for f in folders:
+            names = self.list_folder(Bucket, f)
+            if f == folder:
+                ix = bisect.bisect_left(names, start)
+                names = names[ix:]
+                names = names[:bisect.bisect_left(names, start + "￿")]
+            keys.extend([
+                "{}/{}".format(f, n) if len(f) > 0 else n
+                for n in names
+            ])
+        if Delimiter == "/" and folder != "":
+            # Only list the files directly inside the folder
+            keys = [k for k in keys if "/" not in k[len(folder) + 1:]]
+
+        offset = int(ContinuationToken) if ContinuationToken is not None else 0
+        page = keys[offset:offset + MaxKeys]
+        r = {
+            "IsTruncated": offset + MaxKeys < len(keys),
+            "KeyCount": len(page),
+            "Contents": [
+                {
+                    "Key": k,
+                    "Size": 1,
+                    "ETag": self.etag(Bucket, k),
+                    "LastModified": self.modified.get((Bucket, k), OLD_OBJECT_TIME),
+                }
+                for k in page
+            ],
+        }
+        if offset == 0 and len(sub_prefixes) > 0:
+            r["CommonPrefixes"] = [{"Prefix": p} for p in sub_prefixes]
+        if len(r["Contents"]) == 0:
+            del r["Contents"]
+        if r["IsTruncated"]:
+            r["NextContinuationToken"] = str(offset + MaxKeys)
+        return r
+
+    def etag(self, Bucket, Key):
+        """ETag of an object, which changes when an object written with PutObject is overwritten."""
+        if (Bucket, Key) in self.bodies:
+            return '"{}"'.format(hashlib.md5(self.bodies[(Bucket, Key)]).hexdigest())
+        return '"fake"'
+
+    def s3_HeadObject(self, Bucket, Key, **kwargs):
+        folder, name = Key.rsplit("/", 1) if "/" in Key else ("", Key)
+        if name not in self.objects[Bucket].get(folder, {}):
+            return ("404", 404)
+        return {"ContentLength": self.objects[Bucket][folder][name], "ETag": self.etag(Bucket, Key)}
+
+    def s3_PutObject(self, Bucket, Key, Body=b"", **kwargs):
+        if hasattr(Body, "read"):
+            Body = Body.read()
+        self.put_s3_object("s3://{}/{}".format(Bucket, Key), size=len(Body))
+        self.bodies[(Bucket, Key)] = Body
+        return {"ETag": self.etag(Bucket, Key)}
+
+    def s3_GetObject(self, Bucket, Key, IfMatch=None, Range=None, **kwargs):
+        if (Bucket, Key) not in self.bodies:
+            return ("NoSuchKey", 404)
+        if IfMatch is not None and IfMatch != self.etag(Bucket, Key):
+            return ("PreconditionFailed", 412)
+        body = self.bodies[(Bucket, Key)]
+        if Range is not None:
+            start, end = Range[len("bytes="):].split("-")
+            body = body[int(start):int(end) + 1]
+        return {"Body": StreamingBody(io.BytesIO(body), len(body)), "ETag": self.etag(Bucket, Key)}
+
+    def s3_CreateMultipartUpload(self, Bucket, Key, **kwargs):
+        upload_id = str(uuid.uuid4())
+        self.uploads[upload_id] = (Bucket, Key, {})
+        return {"Bucket": Bucket, "Key": Key, "UploadId": upload_id}
+
+    def s3_UploadPart(self, Bucket, Key, UploadId, PartNumber, Body=b"", **kwargs):
+        if UploadId not in self.uploads:
+            return ("NoSuchUpload", 404)
+        if hasattr(Body, "read"):
+            Body = Body.read()
+        self.uploads[UploadId][2][PartNumber] = Body
+        return {"ETag": '"{}"'.format(hashlib.md5(Body).hexdigest())}
+
+    def s3_CompleteMultipartUpload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        if UploadId not in self.uploads:
+            return ("NoSuchUpload", 404)
+        _, _, parts = self.uploads.pop(UploadId)
+        body = b"".join([parts[p["PartNumber"]] for p in MultipartUpload["Parts"]])
+        return self.s3_PutObject(Bucket, Key, Body=body)
+
+    def s3_AbortMultipartUpload(self, Bucket, Key, UploadId, **kwargs):
+        if self.uploads.pop(UploadId, None) is None:
+            return ("NoSuchUpload", 404)
+        return {}
+
+    # CloudWatch Logs
+
+    def logs_GetLogEvents(self, logGroupName, logStreamName, nextToken=None, startFromHead=True, **kwargs):
+        # Every stream has 25 lines, returned 10 at a time
+        start = int(nextToken.split("/")[1]) if nextToken is not None else 0
+        end = min(start + 10, 25)
+        return {
+            "events": [
+                {"timestamp": 0, "message": "line {}".format(i)}
+                for i in range(start, end)
+            ],
+            "nextForwardToken": "f/{}".format(end),
+            "nextBackwardToken": "b/{}".format(start),
+        }
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""Benchmark submitting and monitoring synthetic workflows against a simulated AWS.
+
+Every AWS call is answered in-process by benchmarks/fake_aws.py, so this can
+run without network access or credentials, e.g.:
+
+    python benchmarks/run_benchmarks.py --sizes 1000,10000 --json results.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import cProfile
+import argparse
+import resource
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+
+# The clients need a region, but are never allowed to reach AWS
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_aws import FakeAWS  # noqa: E402
+from batch_project import main as batch_main  # noqa: E402
+from batch_project.lib import submit_workflow, get_workflow_status  # noqa: E402
+from batch_helpers.api_metrics import api_metrics  # noqa: E402
+from batch_helpers.batch_task_manager import BatchTaskManager  # noqa: E402
+
+BUCKET = "bench"
+QUEUE = "bench-queue"
+ANALYSES = ["align", "call"]
+
+
+def make_workflow(folder, n_jobs, fraction_done=0.1):
+    """Write a workflow with n_jobs jobs (two per sample), returning its path and outputs."""
+    n_samples = max(1, n_jobs // len(ANALYSES))
+    config = {
+        "workflow_name": "bench",
+        "project_name": "bench_project",
+        "analyses": [
+            {
+                "job_definition": "{}:1".format(analysis),
+                "outputs": [
+                    "s3://" + BUCKET + "/{workflow_name}/" + analysis + "/{_sample}.out"
+                ],
+                "description": analysis,
+                "queue": QUEUE,
+                "parameters": {"sample": "{_sample}"},
+            }
+            for analysis in ANALYSES
+        ],
+        "samples": [
+            {"_sample": "sample_{}".format(ix), "_filepath": "s3://inputs/{}.fq".format(ix)}
+            for ix in range(n_samples)
+        ],
+    }
+    fp = os.path.join(folder, "bench.json")
+    with open(fp, "wt") as fo:
+        json.dump(config, fo)
+
+    # Outputs of the first samples already exist, and are skipped on submission
+    done = [
+        "s3://{}/bench/{}/sample_{}.out".format(BUCKET, analysis, ix)
+        for ix in range(int(n_samples * fraction_done))
+        for analysis in ANALYSES
+    ]
+    return fp, done
+
+
+def finish_jobs(fake, fraction, status="SUCCEEDED"):
+    """Move a fraction of the unfinished jobs to a new status."""
+    jobs = [
+        job_id for job_id, job in fake.jobs.items()
+        if job["status"] not in ["SUCCEEDED", "FAILED"]
+    ]
+    for job_id in jobs[:int(len(jobs) * fraction)]:
+        job = fake.jobs[job_id]
+        outputs = None
+        if job["jobQueue"] == QUEUE:
+            analysis = job["jobDefinition"].rsplit("/", 1)[-1].split(":")[0]
+            outputs = ["s3://{}/bench/{}/{}.out".format(
+                BUCKET, analysis, job["parameters"]["sample"]
+            )]
+        fake.set_job_status(job_id, status, outputs=outputs)
+
+
+def run_manager(n_jobs):
+    """Submit one job per output with a BatchTaskManager."""
+    manager = BatchTaskManager(job_queue="bench-manager-queue", monitor_interval=0)
+    for ix in range(n_jobs):
+        manager.submit_job(
+            output_files=["s3://{}/manager/task_{}.out".format(BUCKET, ix)],
+            job_name="task_{}".format(ix),
+            job_definition="align:1",
+            vcpus=1,
+            memory=1024,
+            parameters={"ix": ix},
+        )
+    return manager
+
+
+def run_benchmark(name, f, fake, profile_dir=None, trace_memory=False, size=None):
+    """Time a single call of f(), counting the simulated AWS calls it makes."""
+    calls_before = dict(fake.calls)
+    throttles_before = sum(fake.throttles.values())
+    retries_before = sum([m["retries"] for m in api_metrics.to_dict().values()])
+
+    if trace_memory:
+        tracemalloc.start()
+    profiler = cProfile.Profile() if profile_dir is not None else None
+
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    if profiler is not None:
+        profiler.enable()
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        f()
+    if profiler is not None:
+        profiler.disable()
+    wall = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+
+    result = {
+        "benchmark": name,
+        "jobs": size,
+        "wall_seconds": round(wall, 4),
+        "cpu_seconds": round(cpu, 4),
+        "api_calls": {
+            op: n - calls_before.get(op, 0)
+            for op, n in sorted(fake.calls.items())
+            if n - calls_before.get(op, 0) > 0
+        },
+        "throttled_calls": sum(fake.throttles.values()) - throttles_before,
+        "retries": sum([m["retries"] for m in api_metrics.to_dict().values()]) - retries_before,
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    if trace_memory:
+        result["peak_traced_mb"] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+        tracemalloc.stop()
+    if profiler is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+        profiler.dump_stats(os.path.join(profile_dir, "{}_{}.pstats".format(name, size)))
+
+    return result
+
+
+def run_size(n_jobs, args):
+    """Run every benchmark for a workflow of a given size."""
+    fake = FakeAWS(latency=args.latency, throttle_rps=args.throttle_rps).install()
+    for analysis in ANALYSES:
+        fake.add_job_definition(analysis)
+
+    folder = tempfile.mkdtemp(prefix="batch_bench_")
+    cwd = os.getcwd()
+    results = []
+
+    def bench(name, f):
+        if name not in args.only and len(args.only) > 0:
+            return
+        r = run_benchmark(
+            name, f, fake,
+            profile_dir=args.profile,
+            trace_memory=args.memory,
+            size=n_jobs
+        )
+        print(json.dumps(r), file=sys.stderr)
+        results.append(r)
+
+    try:
+        workflow_fp, done = make_workflow(folder, n_jobs)
+        for s3_path in done:
+            fake.put_s3_object(s3_path)
+
+        bench("submit_workflow", lambda: submit_workflow(workflow_fp))
+
+        # Half of the jobs finish, a quarter of the rest are running
+        finish_jobs(fake, 0.5)
+        finish_jobs(fake, 0.25, status="RUNNING")
+        bench("get_workflow_status", lambda: get_workflow_status(workflow_fp))
+
+        # The dashboard walks the current directory
+        def dashboard():
+            os.chdir(folder)
+            sys_argv = sys.argv
+            sys.argv = ["batch_dashboard"]
+            try:
+                batch_main.dashboard()
+            finally:
+                sys.argv = sys_argv
+                os.chdir(cwd)
+        bench("dashboard", dashboard)
+
+        # BatchTaskManager logs every job, which is not part of the benchmark
+        logging.disable(logging.INFO)
+        manager = []
+        bench("manager_submit", lambda: manager.append(run_manager(n_jobs)))
+
+        # Every job has now finished, so monitoring stops after one round
+        finish_jobs(fake, 1)
+        if len(manager) > 0:
+            bench("manager_monitor", manager[0].monitor_jobs)
+    finally:
+        logging.disable(logging.NOTSET)
+        logging.getLogger().handlers = []
+        os.chdir(cwd)
+        fake.uninstall()
+        shutil.rmtree(folder)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""
+    Benchmark workflow submission and monitoring against a simulated AWS Batch and S3.
+    """)
+
+    parser.add_argument("--sizes",
+                        type=str,
+                        default="1000,10000",
+                        help="""Comma-separated numbers of jobs (e.g. 1000,10000,100000,1000000)""")
+    parser.add_argument("--only",
+                        type=str,
+                        action="append",
+                        default=[],
+                        help="""Only run this benchmark, may be repeated
+                        (submit_workflow, get_workflow_status, dashboard,
+                        manager_submit, manager_monitor)""")
+    parser.add_argument("--latency",
+                        type=float,
+                        default=0,
+                        help="""Seconds added to every simulated AWS call""")
+    parser.add_argument("--throttle-rps",
+                        type=float,
+                        default=None,
+                        help="""Throttle each operation above this many calls per second""")
+    parser.add_argument("--memory",
+                        action="store_true",
+                        help="""Report the peak memory allocated by Python (slower)""")
+    parser.add_argument("--profile",
+                        type=str,
+                        default=None,
+                        help="""Write a cProfile .pstats file for each benchmark to this folder""")
+    parser.add_argument("--json",
+                        type=str,
+                        default=None,
+                        help="""Write all of the results to this JSON file""")
+
+    args = parser.parse_args(sys.argv[1:])
+
+    results = []
+    for size in args.sizes.split(","):
+        results.extend(run_size(int(size), args))
+
+    # Summary table
+    print("{:<22}{:>10}{:>12}{:>12}{:>12}{:>12}".format(
+        "benchmark", "jobs", "wall (s)", "cpu (s)", "API calls", "retries"))
+    for r in results:
+        print("{:<22}{:>10,}{:>12.3f}{:>12.3f}{:>12,}{:>12,}".format(
+            r["benchmark"], r["jobs"], r["wall_seconds"], r["cpu_seconds"],
+            sum(r["api_calls"].values()), r["retries"]
+        ))
+
+    if args.json is not None:
+        with open(args.json, "wt") as fo:
+            json.dump(results, fo, indent=4)
+
+
+if __name__ == "__main__":
+    main()
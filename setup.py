@@ -28,12 +28,16 @@ setup(
         'Programming Language :: Python :: 2.7',
     ],
     keywords='docker aws',
-    packages=find_packages(exclude=['tests']),
+    packages=find_packages(exclude=['tests', 'benchmarks']),
     install_requires=[
-        "boto3>=1.7.2",
-        "pandas>=0.20.3",
-        "tabulate==0.8.1"
+        "boto3>=1.26.0",
+        "pandas>=0.25"
     ],
+    extras_require={
+        "inventory": ["numpy"],
+        "parquet": ["pyarrow"],
+        "zstd": ["zstandard"],
+    },
     project_urls={  # Optional
         'Bug Reports': 'https://github.com/fredhutch/aws-batch-helpers/issues',
         'Source': 'https://github.com/fredhutch/aws-batch-helpers/',
@@ -44,6 +48,7 @@ setup(
             'batch_dashboard = batch_project.main:dashboard',
             'batch_queue_status = batch_project.main:queue_status',
             'batch_clear_queue = batch_project.main:clear_queue',
+            'batch_pack_runner = batch_helpers.pack_runner:main',
         ],
     },
 )
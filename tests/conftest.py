@@ -0,0 +1,19 @@
+import os
+import sys
+import pytest
+
+# The stand-in for AWS lives with the benchmarks
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+
+
+@pytest.fixture
+def fake_aws():
+    """Answer every AWS call made by the package in-process."""
+    from fake_aws import FakeAWS
+    fake = FakeAWS().install()
+    yield fake
+    fake.uninstall()
@@ -0,0 +1,42 @@
+from batch_helpers.analytics import jobs_frame, timing_report
+
+
+def job(job_id, created, started, stopped, job_definition="align", queue="q", depends_on=None):
+    return {
+        "jobId": job_id,
+        "job_definition": job_definition,
+        "queue": queue,
+        "status": "SUCCEEDED",
+        "attempts": 1,
+        "depends_on": depends_on,
+        "createdAt": created * 1000,
+        "startedAt": started * 1000,
+        "stoppedAt": stopped * 1000,
+    }
+
+
+def test_wait_is_measured_from_when_dependencies_stopped():
+    df = jobs_frame([
+        job("a", 0, 10, 100),
+        # Packed samples share a job, which is counted once
+        job("a", 0, 10, 100),
+        job("b", 0, 130, 200, job_definition="merge", depends_on=["a"]),
+    ])
+    assert list(df.index) == ["a", "b"]
+    assert df.loc["a", "wait_seconds"] == 10
+    assert df.loc["b", "wait_seconds"] == 30
+    assert df.loc["b", "runtime_seconds"] == 70
+
+
+def test_report_keeps_counts_as_integers():
+    report = timing_report([
+        job("a", 0, 10, 100),
+        job("b", 0, 20, 60),
+        job("c", 0, 35, 90),
+    ])
+    by_definition = report.split("\n\n")[0].splitlines()
+    assert by_definition[0] == "By job definition (seconds):"
+    header, row = by_definition[1].split(), by_definition[3].split()
+    assert header[:3] == ["Job", "definition", "jobs"]
+    assert row[:3] == ["align", "3", "3"]
+    assert row[3:5] == ["20", "33.5"]
@@ -0,0 +1,80 @@
+import json
+import threading
+from batch_helpers.api_metrics import ApiMetrics, LATENCY_BUCKETS, api_metrics, bucket_percentile
+from batch_helpers.aws import get_client
+
+
+def test_calls_and_errors_are_counted(fake_aws):
+    api_metrics.reset()
+    fake_aws.put_s3_object("s3://bucket/a/1.out")
+    s3 = get_client("s3")
+    s3.head_object(Bucket="bucket", Key="a/1.out")
+    s3.head_object(Bucket="bucket", Key="a/1.out")
+    try:
+        s3.head_object(Bucket="bucket", Key="a/2.out")
+    except Exception:
+        pass
+    get_client("batch").list_jobs(jobQueue="q", jobStatus="RUNNABLE")
+
+    metrics = api_metrics.to_dict()
+    assert sorted(metrics) == ["batch.ListJobs", "s3.HeadObject"]
+    assert metrics["s3.HeadObject"]["calls"] == 3
+    assert metrics["s3.HeadObject"]["errors"] == 1
+    assert metrics["s3.HeadObject"]["retries"] == 0
+    assert sum(metrics["s3.HeadObject"]["latency_buckets"].values()) == 3
+
+    lines = api_metrics.summary().splitlines()
+    assert len(lines) == 2
+    assert lines[1].startswith("s3.HeadObject: 3 calls, mean ")
+    assert lines[1].endswith("0 retries, 0 throttled, 1 errors")
+
+    prom = api_metrics.to_prometheus()
+    assert 'batch_helpers_aws_api_errors_total{service="s3",operation="HeadObject"} 1' in prom
+    assert 'batch_helpers_aws_api_latency_seconds_count{service="s3",operation="HeadObject"} 3' in prom
+    assert 'batch_helpers_aws_api_latency_seconds_bucket{service="s3",operation="HeadObject",le="+Inf"} 3' in prom
+
+
+def test_percentiles_come_from_the_buckets():
+    assert bucket_percentile([0] * (len(LATENCY_BUCKETS) + 1), 0.95) is None
+    counts = [0] * (len(LATENCY_BUCKETS) + 1)
+    counts[0] = 90
+    counts[3] = 10
+    assert bucket_percentile(counts, 0.5) == LATENCY_BUCKETS[0]
+    assert bucket_percentile(counts, 0.95) == LATENCY_BUCKETS[3]
+    counts[-1] = 100
+    assert bucket_percentile(counts, 0.95) is None
+
+
+def test_metrics_are_exported(tmp_path):
+    metrics = ApiMetrics()
+    metrics.record("s3", "HeadObject", {"api_metrics_start": 0, "api_metrics_attempts": 3}, False)
+    fp = str(tmp_path / "metrics.json")
+    metrics.export(fp)
+    assert json.load(open(fp))["s3.HeadObject"]["retries"] == 2
+    fp = str(tmp_path / "metrics.prom")
+    metrics.export(fp)
+    assert 'batch_helpers_aws_api_retries_total{service="s3",operation="HeadObject"} 2' in open(fp).read()
+
+
+def test_summary_can_be_read_while_calls_are_recorded():
+    metrics = ApiMetrics()
+    stop = threading.Event()
+
+    def record():
+        ix = 0
+        while not stop.is_set():
+            metrics.record("s3", "Op{}".format(ix % 50), {"api_metrics_start": 0}, False)
+            ix += 1
+
+    threads = [threading.Thread(target=record) for _ in range(4)]
+    for t in threads:
+        t.start()
+    try:
+        for _ in range(200):
+            metrics.summary()
+            metrics.to_prometheus()
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+    assert len(metrics.summary().splitlines()) == 50
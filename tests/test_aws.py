@@ -0,0 +1,49 @@
+from batch_helpers import aws
+from batch_helpers.aws import get_client, add_client_hook, remove_client_hook, reset_clients
+from batch_helpers.aws import MAX_POOL_CONNECTIONS
+
+
+def test_clients_are_shared():
+    reset_clients()
+    try:
+        s3 = get_client("s3")
+        assert get_client("s3") is s3
+        assert get_client("batch") is not s3
+        # Clients made with other arguments are kept apart
+        other = get_client("s3", region_name="eu-west-1")
+        assert other is not s3
+        assert get_client("s3", region_name="eu-west-1") is other
+        assert s3.meta.config.max_pool_connections == MAX_POOL_CONNECTIONS
+        assert s3.meta.config.retries["mode"] == "adaptive"
+
+        # New clients are made once the old ones have been dropped
+        reset_clients()
+        assert get_client("s3") is not s3
+    finally:
+        reset_clients()
+
+
+def test_hooks_see_every_client():
+    reset_clients()
+    seen = []
+
+    def hook(service, client):
+        seen.append((service, client))
+
+    try:
+        s3 = get_client("s3")
+        add_client_hook(hook)
+        # Clients which already exist are passed to the hook straight away
+        assert seen == [("s3", s3)]
+        batch = get_client("batch")
+        get_client("s3")
+        assert seen == [("s3", s3), ("batch", batch)]
+
+        remove_client_hook(hook)
+        reset_clients()
+        get_client("s3")
+        assert len(seen) == 2
+    finally:
+        if hook in aws._client_hooks:
+            remove_client_hook(hook)
+        reset_clients()
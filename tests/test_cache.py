@@ -0,0 +1,53 @@
+import time
+from batch_helpers.cache import FolderCache
+from batch_helpers.existence_store import ExistenceStore
+
+
+def test_found_files_do_not_expire():
+    cache = FolderCache(ttl=0.1)
+    cache.put("s3://bucket/a", ["1.out"])
+    time.sleep(0.2)
+    assert cache.contains("s3://bucket/a", "1.out") is True
+
+
+def test_missing_files_expire():
+    cache = FolderCache(ttl=0.1)
+    cache.put("s3://bucket/a", ["1.out"])
+    assert cache.contains("s3://bucket/a", "2.out") is False
+    time.sleep(0.2)
+    assert cache.contains("s3://bucket/a", "2.out") is None
+    assert cache.stats()["expirations"] == 1
+
+
+def test_least_recently_used_folders_are_evicted():
+    cache = FolderCache(max_folders=2)
+    cache.put("a", ["1"])
+    cache.put("b", ["1"])
+    assert cache.contains("a", "1")
+    cache.put("c", ["1"])
+    assert cache.contains("b", "1") is None
+    assert cache.contains("a", "1") and cache.contains("c", "1")
+    assert cache.stats()["evictions"] == 1
+
+
+def test_events_only_apply_to_cached_folders():
+    cache = FolderCache()
+    assert not cache.add("a", "1")
+    cache.put("a", [])
+    assert cache.add("a", "1")
+    assert cache.contains("a", "1")
+    assert cache.discard("a", "1")
+    assert cache.contains("a", "1") is False
+
+
+def test_missing_last_modified_is_stored_as_null(tmp_path):
+    store = ExistenceStore(str(tmp_path / "cache.db"))
+    objects = [{"Key": "a/1.out", "ETag": '"x"'}]
+    assert store.record_folder("s3://bucket/a", objects) == 0
+    row = store.conn.execute("SELECT last_modified FROM objects WHERE name = '1.out'").fetchone()
+    assert row == (None,)
+
+    # Listing the same object again doesn't count it as changed
+    assert store.record_folder("s3://bucket/a", objects) == 0
+    assert store.exists("s3://bucket/a", "1.out") is True
+    store.close()
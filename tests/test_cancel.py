@@ -0,0 +1,34 @@
+from batch_project.cancel import BulkCanceller
+
+
+def test_jobs_are_cancelled_or_terminated_by_status(fake_aws):
+    runnable, = fake_aws.submit_jobs("q", 1, status="RUNNABLE")
+    running, = fake_aws.submit_jobs("q", 1, status="RUNNING")
+    succeeded, = fake_aws.submit_jobs("q", 1, status="SUCCEEDED")
+
+    stopped = BulkCanceller("test", max_per_second=None).run([
+        (runnable, "RUNNABLE"),
+        (runnable, "RUNNABLE"),
+        (running, "RUNNING"),
+        (succeeded, "SUCCEEDED"),
+    ])
+    assert stopped == {runnable: "CANCELED", running: "CANCELED"}
+    assert fake_aws.calls["CancelJob"] == 1
+    assert fake_aws.calls["TerminateJob"] == 1
+    assert fake_aws.jobs[runnable]["status"] == "FAILED"
+    assert fake_aws.jobs[running]["status"] == "FAILED"
+    assert fake_aws.jobs[succeeded]["status"] == "SUCCEEDED"
+
+
+def test_jobs_which_started_before_cancelling_are_terminated(fake_aws):
+    # Last seen RUNNABLE, but started since
+    job_id, = fake_aws.submit_jobs("q", 1, status="RUNNING")
+    canceller = BulkCanceller("test", max_per_second=None)
+    assert canceller.run([(job_id, "RUNNABLE")]) == {job_id: "CANCELED"}
+    assert fake_aws.calls["CancelJob"] == 1
+    assert fake_aws.calls["TerminateJob"] == 1
+    assert fake_aws.jobs[job_id]["status"] == "FAILED"
+
+    # Jobs already stopped are not sent again
+    canceller.run([(job_id, "RUNNABLE")])
+    assert fake_aws.calls["CancelJob"] == 1
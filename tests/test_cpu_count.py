@@ -0,0 +1,78 @@
+import os
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import pytest
+from batch_helpers.helpers import container_cpu_count
+
+
+def host_cpus():
+    return len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+
+
+def write(root, path, text):
+    fp = os.path.join(str(root), path)
+    if not os.path.exists(os.path.dirname(fp)):
+        os.makedirs(os.path.dirname(fp))
+    with open(fp, "wt") as f:
+        f.write(text)
+
+
+@pytest.fixture
+def metadata():
+    """Serve the ECS task metadata for a container with the given limits."""
+    responses = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(responses[self.path]).encode("utf-8")
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield responses, "http://127.0.0.1:{}/v4".format(server.server_port)
+    server.shutdown()
+
+
+def test_cgroup_v2_quota(tmp_path):
+    write(tmp_path, "cpu.max", "100000 100000\n")
+    write(tmp_path, "cpu.weight", "100\n")
+    assert container_cpu_count(str(tmp_path)) == 1
+
+
+def test_cgroup_v1_quota(tmp_path):
+    write(tmp_path, "cpu/cpu.cfs_quota_us", "200000\n")
+    write(tmp_path, "cpu/cpu.cfs_period_us", "100000\n")
+    assert container_cpu_count(str(tmp_path)) == min(host_cpus(), 2)
+
+
+def test_default_weight_is_not_a_limit(tmp_path):
+    write(tmp_path, "cpu.max", "max 100000\n")
+    write(tmp_path, "cpu.weight", "100\n")
+    assert container_cpu_count(str(tmp_path)) == host_cpus()
+
+
+def test_shares_are_not_a_limit(tmp_path):
+    write(tmp_path, "cpu/cpu.cfs_quota_us", "-1\n")
+    write(tmp_path, "cpu/cpu.cfs_period_us", "100000\n")
+    write(tmp_path, "cpu/cpu.shares", "1024\n")
+    assert container_cpu_count(str(tmp_path)) == host_cpus()
+
+
+def test_reservation_from_task_metadata(tmp_path, metadata):
+    responses, uri = metadata
+    responses["/v4"] = {"Limits": {"CPU": 1024, "Memory": 2048}}
+    write(tmp_path, "cpu.max", "max 100000\n")
+    assert container_cpu_count(str(tmp_path), metadata_uri=uri) == 1
+
+
+def test_fargate_task_limit(tmp_path, metadata):
+    responses, uri = metadata
+    responses["/v4"] = {"Limits": {"CPU": 0}}
+    responses["/v4/task"] = {"Limits": {"CPU": 2.0, "Memory": 4096}}
+    assert container_cpu_count(str(tmp_path), metadata_uri=uri) == min(host_cpus(), 2)
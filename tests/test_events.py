@@ -0,0 +1,90 @@
+import time
+from batch_helpers.batch_task_manager import BatchTaskManager
+from batch_helpers.events import LocalQueue, JobStatusTracker
+
+
+def job_event(job_id, status, attempts=0, **times):
+    detail = {"jobId": job_id, "status": status, "attempts": [{}] * attempts}
+    detail.update(times)
+    return {
+        "source": "aws.batch",
+        "detail-type": "Batch Job State Change",
+        "detail": detail,
+    }
+
+
+def test_events_for_other_jobs_are_left_in_the_queue():
+    q = LocalQueue(visibility_timeout=0.1)
+    q.send(job_event("job-a", "RUNNING"))
+    q.send(job_event("job-b", "RUNNING"))
+
+    tracker_a = JobStatusTracker(q, min_interval=0)
+    tracker_a.track(["job-a"])
+    assert tracker_a.poll() == 2
+    assert tracker_a.drained
+
+    # The event for job-b is delivered again to the tracker following it
+    time.sleep(0.2)
+    tracker_b = JobStatusTracker(q, min_interval=0)
+    tracker_b.track(["job-b"])
+    assert tracker_b.poll() == 1
+    assert tracker_b.status == {"job-b": "RUNNING"}
+
+    time.sleep(0.2)
+    assert q.receive() == []
+
+
+def test_finished_jobs_keep_their_status():
+    q = LocalQueue()
+    q.send(job_event("job-a", "SUCCEEDED"))
+    q.send(job_event("job-a", "RUNNING"))
+
+    tracker = JobStatusTracker(q)
+    tracker.track(["job-a"])
+    tracker.poll()
+    assert tracker.status == {"job-a": "SUCCEEDED"}
+
+
+def test_poll_stops_after_max_poll_seconds():
+    q = LocalQueue()
+    for ix in range(25):
+        q.send(job_event("job-{}".format(ix), "RUNNING"))
+
+    tracker = JobStatusTracker(q, max_poll_seconds=0)
+    tracker.track(["job-{}".format(ix) for ix in range(25)])
+    assert tracker.poll() == 10
+    assert not tracker.drained
+
+
+def test_late_events_do_not_move_jobs_backwards():
+    q = LocalQueue()
+    q.send(job_event("job-a", "RUNNING", createdAt=1000, startedAt=5000))
+    q.send(job_event("job-a", "RUNNABLE", createdAt=1000))
+    q.send(job_event("job-b", "RUNNING"))
+    # Retrying a job puts it back in the queue, with one more attempt
+    q.send(job_event("job-b", "RUNNABLE", attempts=1))
+
+    tracker = JobStatusTracker(q)
+    tracker.track(["job-a", "job-b"])
+    tracker.poll()
+    assert tracker.status == {"job-a": "RUNNING", "job-b": "RUNNABLE"}
+    assert tracker.times["job-a"] == {"createdAt": 1000, "startedAt": 5000, "attempts": 0}
+
+
+def test_task_manager_keeps_event_timestamps(fake_aws):
+    job_id, = fake_aws.submit_jobs("q", 1, status="RUNNING")
+    q = LocalQueue()
+    btm = BatchTaskManager(job_queue="q", job_event_queue=q, monitor_interval=0)
+    btm.jobs_in_workflow.update(btm.current_jobs.keys())
+
+    created = fake_aws.jobs[job_id]["createdAt"]
+    q.send(job_event(job_id, "SUCCEEDED", attempts=1,
+                     createdAt=created, startedAt=created + 1000, stoppedAt=created + 61000))
+    q.send(job_event(job_id, "STARTING", createdAt=created))
+    btm.event_consumers[0].poll(force=True)
+
+    job = list(btm.current_jobs.values())[0]
+    assert job["status"] == "SUCCEEDED"
+    assert job["stoppedAt"] == created + 61000
+    report = btm.timing_report().split("\n")
+    assert report[3].split()[1:4] == ["1", "1", "1"]
@@ -0,0 +1,45 @@
+from fake_aws import FakeAWS
+from batch_helpers.api_metrics import api_metrics
+from batch_helpers.aws import get_client
+
+
+def test_throttled_calls_are_retried_by_the_client():
+    fake = FakeAWS(throttle_rps=2).install()
+    try:
+        api_metrics.reset()
+        fake.submit_jobs("q", 3)
+        fake.put_s3_object("s3://bucket/a/1.out")
+        batch = get_client("batch")
+        s3 = get_client("s3")
+
+        # The third call in a second is throttled, then retried (after a
+        # backoff which may let the fourth through)
+        for _ in range(4):
+            assert len(batch.list_jobs(jobQueue="q", jobStatus="RUNNABLE")["jobSummaryList"]) == 3
+        r = s3.list_objects_v2(Bucket="bucket", Prefix="a/", Delimiter="/")
+        assert [o["Key"] for o in r["Contents"]] == ["a/1.out"]
+
+        assert fake.calls["ListJobs"] == 4
+        assert fake.throttles["ListJobs"] >= 1
+        metrics = api_metrics.to_dict()["batch.ListJobs"]
+        assert metrics["calls"] == 4
+        assert metrics["throttles"] == fake.throttles["ListJobs"]
+        assert metrics["retries"] == fake.throttles["ListJobs"]
+        assert metrics["errors"] == 0
+    finally:
+        fake.uninstall()
+
+
+def test_errors_are_returned_after_a_throttled_attempt():
+    fake = FakeAWS(throttle_rps=1).install()
+    try:
+        s3 = get_client("s3")
+        fake.simulate_network("HeadObject")
+        try:
+            s3.head_object(Bucket="bucket", Key="missing")
+        except Exception as e:
+            assert e.response["Error"]["Code"] == "404"
+        else:
+            assert False, "HeadObject of a missing object should fail"
+    finally:
+        fake.uninstall()
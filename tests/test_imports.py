@@ -0,0 +1,38 @@
+import os
+import sys
+import json
+import subprocess
+import pytest
+
+HEAVY_MODULES = ["pandas", "boto3", "botocore", "tabulate", "numpy"]
+
+
+def heavy_modules_loaded(code):
+    """Run the code in a new interpreter, returning the heavy modules it loaded."""
+    report = "\nimport sys, json\nprint(json.dumps([m for m in {!r} if m in sys.modules]))".format(HEAVY_MODULES)
+    out = subprocess.check_output(
+        [sys.executable, "-c", code + report],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    )
+    return json.loads(out.decode("utf-8").strip().splitlines()[-1])
+
+
+@pytest.mark.parametrize("module", [
+    "batch_project.main",
+    "batch_project.lib",
+    "batch_helpers.batch_task_manager",
+])
+def test_heavy_modules_are_loaded_when_needed(module):
+    assert heavy_modules_loaded("import {}".format(module)) == []
+
+
+def test_help_does_not_load_heavy_modules():
+    code = (
+        "import sys; sys.argv = ['batch_project', 'import', '--help']\n"
+        "from batch_project.main import main\n"
+        "try:\n"
+        "    main()\n"
+        "except SystemExit:\n"
+        "    pass"
+    )
+    assert heavy_modules_loaded(code) == []
@@ -0,0 +1,110 @@
+import csv
+import gzip
+import json
+import datetime
+from fake_aws import OLD_OBJECT_TIME
+from batch_helpers.inventory import InventoryIndex, load_inventory, modified_time
+from batch_project.lib import S3FolderContents
+
+
+def write_inventory(folder, rows, schema="Bucket, Key, VersionId, IsLatest, IsDeleteMarker, Size"):
+    data = folder / "data"
+    data.mkdir()
+    with gzip.open(str(data / "part-0.csv.gz"), "wt") as f:
+        csv.writer(f).writerows(rows)
+    manifest = folder / "manifest.json"
+    json.dump({
+        "sourceBucket": "bucket",
+        "destinationBucket": "arn:aws:s3:::inventory",
+        "fileFormat": "CSV",
+        "fileSchema": schema,
+        "creationTimestamp": "1700000000000",
+        "files": [{"key": "bucket/inventory/data/part-0.csv.gz"}],
+    }, open(str(manifest), "wt"))
+    return str(manifest)
+
+
+def test_only_current_objects_are_indexed(tmp_path):
+    manifest = write_inventory(tmp_path, [
+        ["bucket", "a/current.out", "v2", "true", "false", "1"],
+        ["bucket", "a/current.out", "v1", "false", "false", "1"],
+        ["bucket", "a/old_only.out", "v1", "false", "false", "1"],
+        ["bucket", "a/deleted.out", "v3", "true", "true", "0"],
+        ["bucket", "a/with%20space.out", "v1", "true", "false", "1"],
+    ])
+    index = InventoryIndex.from_manifest(manifest)
+    assert len(index) == 2
+    assert index.contains("bucket", "a/current.out")
+    assert index.contains("bucket", "a/with space.out")
+    assert not index.contains("bucket", "a/old_only.out")
+    assert not index.contains("bucket", "a/deleted.out")
+    assert not index.contains("other", "a/current.out")
+
+
+def test_saved_index(tmp_path):
+    manifest = write_inventory(tmp_path, [
+        ["bucket", "a/{}.out".format(ix), "v1", "true", "false", "1"]
+        for ix in range(1000)
+    ])
+    InventoryIndex.from_manifest(manifest, prefixes=["a/1"]).save(str(tmp_path / "index.npy"))
+    index = load_inventory(str(tmp_path / "index.npy"))
+    assert len(index) == 111
+    assert index.contains("bucket", "a/123.out")
+    assert not index.contains("bucket", "a/234.out")
+
+
+def test_changed_prefixes_are_not_trusted(tmp_path):
+    manifest = write_inventory(tmp_path, [
+        ["bucket", "a/1.out", "v1", "true", "false", "1"],
+        ["bucket", "b/1.out", "v1", "true", "false", "1"],
+        ["bucket", "c/1.out", "v1", "true", "false", "1"],
+    ])
+    index = InventoryIndex.from_manifest(manifest)
+    before = datetime.datetime.fromtimestamp(index.snapshot_time - 60, datetime.timezone.utc)
+    after = datetime.datetime.fromtimestamp(index.snapshot_time + 60, datetime.timezone.utc)
+
+    # Nothing has changed in a
+    assert not index.prefix_changed("bucket", "a/", [{"Key": "a/1.out", "LastModified": before}])
+    assert index.contains("bucket", "a/1.out")
+
+    # An object was written to b after the snapshot
+    assert index.prefix_changed("bucket", "b/", [{"Key": "b/2.out", "LastModified": after}])
+    assert not index.contains("bucket", "b/1.out")
+
+    # An object in the snapshot is missing from c
+    assert index.prefix_changed("bucket", "c", [], missing_key="c/1.out")
+    assert not index.contains("bucket", "c/1.out")
+
+
+def test_last_modified_formats():
+    assert modified_time(datetime.datetime(2023, 11, 14, 22, 13, 20, tzinfo=datetime.timezone.utc)) == 1700000000
+    assert modified_time(datetime.datetime(2023, 11, 14, 22, 13, 20)) == 1700000000
+    assert modified_time("2023-11-14T22:13:20.000Z") == 1700000000
+    assert modified_time("2023-11-14 22:13:20+00:00") == 1700000000
+    assert modified_time(1700000000) == 1700000000
+
+
+def test_folder_listings_are_checked_against_the_snapshot(fake_aws, tmp_path):
+    manifest = write_inventory(tmp_path, [
+        ["bucket", "a/1.out", "v1", "true", "false", "1"],
+        ["bucket", "b/1.out", "v1", "true", "false", "1"],
+    ])
+    s3_contents = S3FolderContents(inventory=[InventoryIndex.from_manifest(manifest)])
+
+    # a/1.out was written before the snapshot, b/2.out after it
+    fake_aws.put_s3_object("s3://bucket/a/1.out")
+    fake_aws.modified[("bucket", "a/1.out")] = OLD_OBJECT_TIME
+    fake_aws.put_s3_object("s3://bucket/b/2.out")
+
+    assert s3_contents.exists("s3://bucket/a/1.out")
+    assert s3_contents.exists("s3://bucket/b/1.out")
+    assert fake_aws.calls["ListObjectsV2"] == 0
+
+    # Listing a shows that nothing has changed, so a/1.out is still trusted
+    assert not s3_contents.exists("s3://bucket/a/2.out")
+    assert s3_contents.inventory[0].contains("bucket", "a/1.out")
+
+    # Listing b finds a newer object, so b/1.out (which is gone) is no longer trusted
+    assert s3_contents.exists("s3://bucket/b/2.out")
+    assert not s3_contents.exists("s3://bucket/b/1.out")
+    assert fake_aws.calls["ListObjectsV2"] == 2
@@ -0,0 +1,66 @@
+import os
+from batch_project.logs import LogHarvester
+
+
+class Stream:
+    """Stand-in for CloudWatch Logs serving a single growing stream, 10 events at a time."""
+
+    def __init__(self, n_lines):
+        self.n_lines = n_lines
+        self.fail_after = None
+        self.n_calls = 0
+
+    def get_log_events(self, nextToken=None, **kwargs):
+        self.n_calls += 1
+        if self.fail_after is not None and self.n_calls > self.fail_after:
+            raise Exception("Throttled")
+        start = int(nextToken) if nextToken is not None else 0
+        end = min(start + 10, self.n_lines)
+        return {
+            "events": [{"message": "line {}".format(i)} for i in range(start, end)],
+            "nextForwardToken": str(end),
+        }
+
+
+def harvester(tmp_path, stream, compress=False):
+    h = LogHarvester(str(tmp_path / "_log_tokens.json"), n_threads=1, compress=compress)
+    h.client = stream
+    return h
+
+
+def read_lines(fp):
+    return open(fp).read().splitlines()
+
+
+def test_failed_fetch_does_not_duplicate_events(fake_aws, tmp_path):
+    fp = str(tmp_path / "job.log")
+    stream = Stream(15)
+    harvester(tmp_path, stream).harvest({"stream": (fp, False)})
+    assert len(read_lines(fp)) == 15
+
+    # The stream grows, and the next run fails after writing one page
+    stream.n_lines = 40
+    stream.n_calls = 0
+    stream.fail_after = 1
+    harvester(tmp_path, stream).harvest({"stream": (fp, False)})
+    assert len(read_lines(fp)) == 25
+
+    stream.fail_after = None
+    harvester(tmp_path, stream).harvest({"stream": (fp, True)})
+    assert read_lines(fp) == ["line {}".format(i) for i in range(40)]
+
+
+def test_final_streams_are_fetched_again_if_deleted(fake_aws, tmp_path):
+    fp = str(tmp_path / "job.log")
+    stream = Stream(15)
+    harvester(tmp_path, stream).harvest({"stream": (fp, True)})
+
+    # A finished stream is not fetched again
+    stream.n_calls = 0
+    harvester(tmp_path, stream).harvest({"stream": (fp, True)})
+    assert stream.n_calls == 0
+
+    # Unless the local copy has been removed
+    os.remove(fp)
+    harvester(tmp_path, stream).harvest({"stream": (fp, True)})
+    assert len(read_lines(fp)) == 15
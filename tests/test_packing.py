@@ -0,0 +1,174 @@
+import sys
+import json
+import logging
+import time
+import pytest
+from batch_helpers.helpers import command_telemetry, run_cmds, run_cmds_parallel, write_telemetry
+from batch_helpers.pack_runner import run_manifest
+from batch_project.lib import check_dependencies, submit_workflow
+from batch_project.packing import render_command
+
+
+def test_render_command():
+    assert render_command(
+        ["run.sh", "Ref::input", "Ref::input_2", "--threads=Ref::threads"],
+        {"input": "a.fq", "input_2": "b.fq", "threads": 4}
+    ) == ["run.sh", "a.fq", "b.fq", "--threads=4"]
+
+
+def workflow(samples_per_job, n_samples=100):
+    return {
+        "workflow_name": "wf",
+        "project_name": "proj",
+        "analyses": [
+            {
+                "job_definition": "{}:1".format(analysis),
+                "outputs": ["s3://bucket/" + analysis + "/{_sample}.out"],
+                "description": analysis,
+                "queue": "queue",
+                "parameters": {"sample": "{_sample}"},
+                "samples_per_job": n,
+            }
+            for analysis, n in zip(["align", "call"], samples_per_job)
+        ],
+        "samples": [{"_sample": "s{}".format(ix)} for ix in range(n_samples)],
+    }
+
+
+def to_run(config):
+    return [
+        [(ix, []) for ix in range(len(config["samples"]))]
+        for _ in config["analyses"]
+    ]
+
+
+def test_check_dependencies():
+    config = workflow([10, 10])
+    check_dependencies(config, to_run(config))
+
+    # Each job of the second analysis would wait for 50 jobs of the first
+    config = workflow([1, 50])
+    with pytest.raises(AssertionError):
+        check_dependencies(config, to_run(config))
+
+
+def test_nothing_is_submitted_when_fan_in_is_too_large(fake_aws, tmp_path):
+    config = workflow([1, 50])
+    fp = str(tmp_path / "wf.json")
+    json.dump(config, open(fp, "wt"))
+    for analysis in ["align", "call"]:
+        fake_aws.add_job_definition(analysis, command=["run.sh", "Ref::sample"])
+
+    with pytest.raises(AssertionError):
+        submit_workflow(fp)
+    assert fake_aws.calls["SubmitJob"] == 0
+
+
+def test_packed_submission(fake_aws, tmp_path):
+    config = workflow([10, 10])
+    fp = str(tmp_path / "wf.json")
+    json.dump(config, open(fp, "wt"))
+    for analysis in ["align", "call"]:
+        fake_aws.add_job_definition(analysis, command=["run.sh", "Ref::sample"])
+
+    submit_workflow(fp)
+    assert fake_aws.calls["SubmitJob"] == 20
+
+    config = json.load(open(fp))
+    assert len(config["jobs"]) == 200
+    assert len(set([j["jobId"] for j in config["jobs"]])) == 20
+    assert all([len(s["job_ids"]) == 2 for s in config["samples"]])
+
+
+def test_each_sample_is_timed_out(fake_aws):
+    manifest = {
+        "parallel": 2,
+        "timeout": 1,
+        "samples": [
+            {
+                "sample": "slow",
+                "command": [sys.executable, "-c", "import time; time.sleep(30)"],
+                "outputs": ["s3://bucket/slow.out"],
+            },
+        ],
+    }
+    started = time.time()
+    assert run_manifest(manifest) == ["slow"]
+    assert time.time() - started < 20
+    assert command_telemetry[-1]["exit_code"] < 0
+
+
+def test_telemetry_is_cleared_once_written(fake_aws):
+    run_cmds([sys.executable, "-c", "pass"])
+    run_cmds([sys.executable, "-c", "pass"])
+    n_commands = len(command_telemetry)
+    write_telemetry("s3://bucket/telemetry.json", sample_cgroup=False)
+
+    written = json.loads(fake_aws.bodies[("bucket", "telemetry.json")])
+    assert len(written["commands"]) == n_commands
+    assert written["commands"][-1]["exit_code"] == 0
+    assert command_telemetry == []
+
+
+def test_command_is_killed_after_timeout():
+    started = time.time()
+    exitcode = run_cmds(
+        [sys.executable, "-c", "import time; time.sleep(30)"],
+        catchExcept=True,
+        timeout=0.5,
+    )
+    assert exitcode < 0
+    assert time.time() - started < 20
+
+
+def test_command_which_finishes_in_time_is_not_killed():
+    assert run_cmds([sys.executable, "-c", "pass"], timeout=30) == 0
+    assert command_telemetry[-1]["exit_code"] == 0
+    assert command_telemetry[-1]["user_cpu_seconds"] is not None
+
+
+def test_parallel_commands_which_cannot_run_raise():
+    with pytest.raises(OSError):
+        run_cmds_parallel(
+            [[sys.executable, "-c", "pass"], ["/no/such/executable"]],
+            n_cpus=2,
+            catchExcept=True,
+        )
+
+
+def test_parallel_commands_are_limited_to_the_cpus():
+    # Two at a time, the four commands take at least twice as long as one
+    commands = [[sys.executable, "-c", "import time; time.sleep(0.3)"] for _ in range(4)]
+    started = time.time()
+    assert run_cmds_parallel(commands, n_cpus=2) == [0, 0, 0, 0]
+    assert time.time() - started >= 0.6
+
+
+def test_command_output_is_logged_as_it_is_written(tmp_path, caplog):
+    caplog.set_level(logging.INFO)
+    script = "print('short'); print('x' * 50); import sys; sys.stderr.write('oops\\n')"
+    tee = str(tmp_path / "tee.log")
+    run_cmds([sys.executable, "-c", script], tee=tee, max_line_length=20)
+
+    # Long lines are truncated in the log, but copied in full to the tee
+    assert "short" in caplog.messages
+    assert "x" * 20 + " [truncated]" in caplog.messages
+    assert "oops" in caplog.messages
+    assert sorted(open(tee).read().splitlines()) == sorted(["short", "x" * 50, "oops"])
+
+    # With stdout redirected to a file, only STDERR is logged
+    caplog.clear()
+    stdout = str(tmp_path / "stdout.txt")
+    run_cmds([sys.executable, "-c", script], stdout=stdout)
+    assert open(stdout).read().splitlines() == ["short", "x" * 50]
+    assert "oops" in caplog.messages
+    assert "short" not in caplog.messages
+
+
+def test_logging_can_be_rate_limited(caplog):
+    caplog.set_level(logging.INFO)
+    run_cmds(
+        [sys.executable, "-c", "for i in range(100): print(i)"],
+        max_lines_per_second=10,
+    )
+    assert "(90 lines not logged)" in caplog.messages
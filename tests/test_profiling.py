@@ -0,0 +1,20 @@
+from concurrent.futures import ThreadPoolExecutor
+from batch_project import profiling
+from batch_project.profiling import span, phase_count, phase_seconds
+
+
+def test_spans_in_worker_threads_are_totalled_separately(monkeypatch):
+    monkeypatch.setattr(profiling, "_enabled", True)
+    phase_seconds.clear()
+    phase_count.clear()
+
+    def call(_):
+        with span("Batch calls"):
+            pass
+
+    with span("Batch calls"), ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(call, range(1000)))
+
+    assert phase_count["Batch calls"] == 1
+    assert phase_count["Batch calls (threads)"] == 1000
+    assert phase_seconds["Batch calls"] > 0
@@ -0,0 +1,124 @@
+import json
+import time
+import threading
+from batch_project import daemon as daemon_module
+from batch_project.daemon import StatusDaemon
+from batch_project.lib import list_queues, QueueWatch
+
+
+def test_only_recently_stopped_jobs_are_counted(fake_aws):
+    now = time.time()
+    fake_aws.submit_jobs("a", 4, status="SUCCEEDED", at=now - 3600)
+    fake_aws.submit_jobs("a", 3, status="SUCCEEDED", at=now - 10)
+    fake_aws.submit_jobs("a", 2, status="FAILED", at=now - 10)
+    fake_aws.submit_jobs("a", 5)
+
+    counts, stopped = list_queues(["a"], ["RUNNABLE", "SUCCEEDED", "FAILED"], stopped_after=now - 60)
+    assert counts["a"] == {"RUNNABLE": 5, "SUCCEEDED": 7, "FAILED": 2}
+    assert stopped["a"] == [[int((now - 10) * 1000), 5]]
+
+    # Jobs which Batch has expired no longer lower the rate
+    for job_id, job in list(fake_aws.jobs.items()):
+        if job.get("stoppedAt") == int((now - 3600) * 1000):
+            del fake_aws.jobs_by_queue["a"][job_id]
+    counts, stopped = list_queues(["a"], ["SUCCEEDED"], stopped_after=now - 60)
+    assert counts["a"] == {"SUCCEEDED": 3}
+    assert stopped["a"] == [[int((now - 10) * 1000), 3]]
+
+
+def test_daemon_serves_the_same_listing_until_it_refreshes(fake_aws):
+    fake_aws.submit_jobs("a", 2, status="SUCCEEDED")
+    daemon = StatusDaemon(socket_path="unused", refresh_interval=60)
+    first = daemon.queue_status("a", ["SUCCEEDED"])
+    assert first["counts"] == {"SUCCEEDED": 2}
+    assert sum([n for _, n in first["stopped"]]) == 2
+
+    fake_aws.submit_jobs("a", 1, status="SUCCEEDED")
+    assert daemon.queue_status("a", ["SUCCEEDED"])["updated"] == first["updated"]
+    daemon.refresh_queue(("a", ("SUCCEEDED",)))
+    second = daemon.queue_status("a", ["SUCCEEDED"])
+    assert second["updated"] > first["updated"]
+    assert second["counts"] == {"SUCCEEDED": 3}
+
+
+def test_daemon_refreshes_different_workflows_at_the_same_time(tmp_path, monkeypatch):
+    def slow_status(fp, **kwargs):
+        time.sleep(0.5)
+        return {"SUCCEEDED": 1}
+    monkeypatch.setattr(daemon_module, "get_workflow_status", slow_status)
+
+    daemon = StatusDaemon(socket_path="unused", refresh_interval=60)
+    fps = []
+    for name in ["a", "b", "c"]:
+        fp = str(tmp_path / "{}.json".format(name))
+        json.dump({"status": "RUNNING"}, open(fp, "wt"))
+        fps.append(fp)
+
+    started = time.time()
+    threads = [threading.Thread(target=daemon.workflow_status, args=(fp,)) for fp in fps]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert time.time() - started < 1.4
+    assert sorted(daemon.workflows) == sorted(fps)
+
+
+def test_daemon_lists_a_queue_once_for_simultaneous_requests(fake_aws):
+    fake_aws.submit_jobs("a", 2, status="SUCCEEDED")
+    StatusDaemon(socket_path="unused", refresh_interval=60).queue_status("a", ["SUCCEEDED"])
+    n_calls = fake_aws.calls["ListJobs"]
+
+    daemon = StatusDaemon(socket_path="unused", refresh_interval=60)
+    threads = [
+        threading.Thread(target=daemon.queue_status, args=("a", ["SUCCEEDED"]))
+        for _ in range(4)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert fake_aws.calls["ListJobs"] == 2 * n_calls
+
+
+def test_finished_jobs_are_not_listed_again_between_full_listings(fake_aws):
+    now = time.time()
+    fake_aws.submit_jobs("a", 2500, status="SUCCEEDED", at=now - 30)
+    running = fake_aws.submit_jobs("a", 3, status="RUNNING")
+    watch = QueueWatch("a", ["RUNNING", "SUCCEEDED", "FAILED"], full_interval=600)
+    counts, stopped = watch.refresh(stopped_after=now - 60)
+    assert counts == {"RUNNING": 3, "SUCCEEDED": 2500, "FAILED": 0}
+    assert stopped == [[int((now - 30) * 1000), 2500]]
+
+    # One job which was running and one new job finish
+    time.sleep(0.01)
+    fake_aws.set_job_status(running[0], "SUCCEEDED", at=now + 1)
+    fake_aws.submit_jobs("a", 1, status="FAILED", at=now + 2)
+    fake_aws.calls.clear()
+    counts, stopped = watch.refresh(stopped_after=now)
+    assert counts == {"RUNNING": 2, "SUCCEEDED": 2501, "FAILED": 1}
+    assert stopped == [[int((now + 1) * 1000), 1], [int((now + 2) * 1000), 1]]
+
+    # Only the active statuses and the new jobs are listed
+    assert fake_aws.calls["ListJobs"] == 6
+    assert fake_aws.calls["DescribeJobs"] == 1
+
+    # Each job is only counted once
+    counts, stopped = watch.refresh(stopped_after=now)
+    assert counts == {"RUNNING": 2, "SUCCEEDED": 2501, "FAILED": 1}
+
+    # A full listing drops the jobs which Batch has expired
+    watch.full_interval = 0
+    for job_id in list(fake_aws.jobs_by_queue["a"])[:500]:
+        del fake_aws.jobs_by_queue["a"][job_id]
+    counts, stopped = watch.refresh(stopped_after=now)
+    assert counts == {"RUNNING": 2, "SUCCEEDED": 2001, "FAILED": 1}
+
+
+def test_daemon_keeps_stop_times_for_as_long_as_asked(fake_aws):
+    now = time.time()
+    fake_aws.submit_jobs("a", 2, status="SUCCEEDED", at=now - 1200)
+    daemon = StatusDaemon(socket_path="unused", refresh_interval=60, stopped_seconds=600)
+    assert daemon.queue_status("a", ["SUCCEEDED"])["stopped"] == []
+    stopped = daemon.queue_status("a", ["SUCCEEDED"], stopped_seconds=1800)["stopped"]
+    assert stopped == [[int((now - 1200) * 1000), 2]]
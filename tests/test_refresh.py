@@ -0,0 +1,42 @@
+from batch_project.refresh import StatusRefresh, plan_status_refresh
+
+
+def test_small_queues_are_listed_and_busy_queues_described():
+    jobs = [("job{}".format(ix), "mine", "RUNNABLE") for ix in range(1000)]
+    jobs.append(("shared-job", "shared", "RUNNABLE"))
+    to_describe, to_list = plan_status_refresh(
+        jobs, queue_counts={"shared": {"RUNNABLE": 50000}}
+    )
+    assert to_describe == ["shared-job"]
+    assert list(to_list.keys()) == ["mine"]
+    assert len(to_list["mine"]) == 1000
+
+
+def test_running_jobs_count_towards_listing():
+    # Listing costs one call per status, describing one call per 100 jobs
+    jobs = [("job{}".format(ix), "q", "RUNNABLE") for ix in range(600)]
+    to_describe, to_list = plan_status_refresh(jobs)
+    assert to_describe == [] and len(to_list["q"]) == 600
+
+    # Running jobs are likely to finish, and have to be described as well
+    jobs = [("job{}".format(ix), "q", "RUNNING") for ix in range(600)]
+    to_describe, to_list = plan_status_refresh(jobs)
+    assert len(to_describe) == 600 and to_list == {}
+
+
+def test_finished_jobs_are_described_after_listing(fake_aws):
+    running = fake_aws.submit_jobs("q", 600, status="RUNNING")
+    succeeded, = fake_aws.submit_jobs("q", 1, status="SUCCEEDED")
+    failed, = fake_aws.submit_jobs("q", 1, status="FAILED")
+    jobs = [(job_id, "q", "RUNNABLE") for job_id in running + [succeeded, failed]]
+
+    refresh = StatusRefresh(jobs)
+    assert refresh.to_describe == []
+    statuses, queue_counts, times = refresh.result(skip={succeeded})
+    assert fake_aws.calls["ListJobs"] == 5
+    assert fake_aws.calls["DescribeJobs"] == 1
+    assert statuses[failed] == "FAILED"
+    assert succeeded not in statuses
+    assert all([statuses[job_id] == "RUNNING" for job_id in running])
+    assert queue_counts["q"]["RUNNING"] == 600
+    assert "stoppedAt" in times[failed]
@@ -0,0 +1,33 @@
+from batch_helpers.routing import QueueRouter
+
+
+def test_jobs_are_spread_across_queues(fake_aws):
+    fake_aws.submit_jobs("busy", 10)
+    router = QueueRouter()
+    chosen = [router.choose(["busy", "idle"]) for _ in range(30)]
+    assert chosen[:10] == ["idle"] * 10
+    assert chosen.count("busy") == 10 and chosen.count("idle") == 20
+    assert router.stats()["busy"] == {"queued": 10, "start_latency": 0, "routed": 10}
+
+
+def test_submitted_and_pending_jobs_are_counted(fake_aws):
+    fake_aws.submit_jobs("a", 5, status="SUBMITTED")
+    fake_aws.submit_jobs("a", 5, status="PENDING")
+    fake_aws.submit_jobs("b", 8)
+    router = QueueRouter()
+    assert router.choose(["a", "b"]) == "b"
+    assert router.lookup("a") == (10, 0)
+
+
+def test_depth_is_capped(fake_aws):
+    fake_aws.submit_jobs("a", 30)
+    fake_aws.submit_jobs("a", 30, status="PENDING")
+    router = QueueRouter(max_depth=20)
+    assert router.count_queued("a") == 20
+    assert fake_aws.calls["ListJobs"] == 1
+
+
+def test_single_queue_is_not_looked_up(fake_aws):
+    router = QueueRouter()
+    assert router.choose("only") == "only"
+    assert fake_aws.calls["ListJobs"] == 0
@@ -0,0 +1,69 @@
+import time
+from batch_helpers.events import LocalQueue
+from batch_project.lib import S3FolderContents
+
+
+def s3_event(s3_path, created=True):
+    bucket, key = s3_path[5:].split("/", 1)
+    return {"Records": [{
+        "eventName": "ObjectCreated:Put" if created else "ObjectRemoved:Delete",
+        "s3": {"bucket": {"name": bucket}, "object": {"key": key}},
+    }]}
+
+
+class Inventory:
+    """Stand-in for an InventoryIndex listing a fixed set of objects."""
+
+    def __init__(self, paths):
+        self.paths = set(paths)
+
+    def contains(self, bucket, key):
+        return "s3://{}/{}".format(bucket, key) in self.paths
+
+    def prefix_changed(self, bucket, prefix, objects, missing_key=None):
+        return False
+
+
+def test_events_for_unlisted_folders_are_kept(fake_aws):
+    q = LocalQueue(visibility_timeout=0.1)
+    contents = S3FolderContents(event_queue=q)
+    contents.events.min_interval = 0
+
+    # The folder hasn't been listed, so the event can't be applied yet
+    q.send(s3_event("s3://bucket/a/1.out"))
+    assert not contents.exists("s3://bucket/a/2.out")
+    assert fake_aws.calls["ListObjectsV2"] == 1
+
+    # Once the folder is listed the event is delivered again, and applied
+    time.sleep(0.2)
+    assert contents.exists("s3://bucket/a/1.out")
+    assert fake_aws.calls["ListObjectsV2"] == 1
+    time.sleep(0.2)
+    assert q.receive() == []
+
+
+def test_removed_objects_are_not_trusted_from_the_inventory(fake_aws):
+    q = LocalQueue()
+    contents = S3FolderContents(
+        event_queue=q,
+        inventory=[Inventory(["s3://bucket/a/1.out"])]
+    )
+    contents.events.min_interval = 0
+    assert contents.exists("s3://bucket/a/1.out")
+    assert fake_aws.calls["ListObjectsV2"] == 0
+
+    q.send(s3_event("s3://bucket/a/1.out", created=False))
+    assert not contents.exists("s3://bucket/a/1.out")
+    assert fake_aws.calls["ListObjectsV2"] == 1
+
+
+def test_messages_without_events_are_deleted(fake_aws):
+    q = LocalQueue(visibility_timeout=0)
+    contents = S3FolderContents(event_queue=q)
+    contents.events.min_interval = 0
+
+    # Sent by S3 when notifications are set up for a bucket
+    q.send({"Service": "Amazon S3", "Event": "s3:TestEvent", "Bucket": "bucket"})
+    q.send({"Records": []})
+    assert contents.events.poll(force=True) == 0
+    assert q.receive() == []
@@ -0,0 +1,63 @@
+import time
+from batch_helpers.helpers import s3_ls, s3_path_exists, s3_paths_exist
+
+
+def test_small_folders_are_checked_one_path_at_a_time(fake_aws):
+    fake_aws.put_s3_object("s3://bucket/a/1.out")
+    paths = ["s3://bucket/a/{}.out".format(ix) for ix in range(1, 4)]
+    assert s3_paths_exist(paths, list_threshold=10) == {
+        "s3://bucket/a/1.out": True,
+        "s3://bucket/a/2.out": False,
+        "s3://bucket/a/3.out": False,
+    }
+    assert fake_aws.calls["HeadObject"] == 3
+    assert fake_aws.calls["ListObjectsV2"] == 0
+    assert s3_path_exists("s3://bucket/a/1.out") is True
+
+
+def test_large_folders_are_listed_once(fake_aws):
+    for ix in range(0, 20, 2):
+        fake_aws.put_s3_object("s3://bucket/b/{}.out".format(ix))
+    paths = ["s3://bucket/b/{}.out".format(ix) for ix in range(20)] + ["s3://bucket/top.out"]
+    exists = s3_paths_exist(paths, list_threshold=10)
+    assert exists == dict(
+        [("s3://bucket/b/{}.out".format(ix), ix % 2 == 0) for ix in range(20)] +
+        [("s3://bucket/top.out", False)]
+    )
+    assert fake_aws.calls["ListObjectsV2"] == 1
+    assert fake_aws.calls["HeadObject"] == 1
+
+
+def put_tree(fake_aws, n_folders, n_files, root="s3://bucket/root/"):
+    keys = []
+    for folder in range(n_folders):
+        for ix in range(n_files):
+            keys.append("f{}/{}.out".format(folder, ix))
+    keys.extend(["top.out", "f0/deeper/1.out"])
+    for key in keys:
+        fake_aws.put_s3_object(root + key)
+    return keys
+
+
+def test_listing_is_complete(fake_aws):
+    keys = put_tree(fake_aws, 3, 700)
+    # More than one page is listed
+    assert sorted(s3_ls("s3://bucket/root/")) == sorted(keys)
+    assert fake_aws.calls["ListObjectsV2"] == 3
+    assert sorted(s3_ls("s3://bucket/root/", parallel=True)) == sorted(keys)
+
+    listed = list(s3_ls("s3://bucket/root/f1/", metadata=True))
+    assert len(listed) == 700
+    assert set(listed[0].keys()) == set(["Key", "Size", "ETag"])
+    assert listed[0]["Key"] == "0.out"
+
+
+def test_queued_shards_are_not_listed_once_reading_stops(fake_aws):
+    put_tree(fake_aws, 20, 1)
+    listing = s3_ls("s3://bucket/root/", parallel=True, n_threads=1)
+    assert next(listing) == "top.out"
+    next(listing)
+    listing.close()
+    time.sleep(0.2)
+    # The top level, the shard being listed and at most one more
+    assert fake_aws.calls["ListObjectsV2"] <= 3
@@ -0,0 +1,59 @@
+import gzip
+import json
+import pytest
+from batch_helpers.helpers import write_s3_json
+from batch_helpers.s3_writer import MIN_PART_SIZE, open_s3_writer
+
+
+def test_small_objects_are_written_at_once(fake_aws):
+    write_s3_json({"a": 1}, "s3://bucket/small.json")
+    assert json.loads(fake_aws.bodies[("bucket", "small.json")]) == {"a": 1}
+    assert fake_aws.calls["PutObject"] == 1
+    assert fake_aws.calls["CreateMultipartUpload"] == 0
+
+
+def test_large_objects_are_uploaded_in_parts(fake_aws):
+    chunk = b"x" * (1024 * 1024)
+    with open_s3_writer("s3://bucket/large.bin", part_size=MIN_PART_SIZE, n_threads=2) as f:
+        for _ in range(11):
+            f.write(chunk)
+    assert fake_aws.bodies[("bucket", "large.bin")] == chunk * 11
+    assert fake_aws.calls["UploadPart"] == 3
+    assert fake_aws.calls["CompleteMultipartUpload"] == 1
+    assert fake_aws.uploads == {}
+
+
+def test_objects_can_be_compressed(fake_aws):
+    with open_s3_writer("s3://bucket/lines.txt.gz", compression="gzip") as f:
+        f.writelines(["line {}\n".format(ix) for ix in range(1000)])
+    text = gzip.decompress(fake_aws.bodies[("bucket", "lines.txt.gz")]).decode("utf-8")
+    assert text.splitlines() == ["line {}".format(ix) for ix in range(1000)]
+
+
+def test_failed_uploads_are_aborted(fake_aws, monkeypatch):
+    upload_part = fake_aws.s3_UploadPart
+
+    def fail_second_part(PartNumber, **kwargs):
+        if PartNumber == 2:
+            return ("AccessDenied", 403)
+        return upload_part(PartNumber=PartNumber, **kwargs)
+    monkeypatch.setattr(fake_aws, "s3_UploadPart", fail_second_part)
+
+    with pytest.raises(Exception):
+        with open_s3_writer("s3://bucket/failed.bin", part_size=MIN_PART_SIZE) as f:
+            f.write(b"x" * (2 * MIN_PART_SIZE + 1))
+    assert fake_aws.calls["AbortMultipartUpload"] == 1
+    assert fake_aws.calls["CompleteMultipartUpload"] == 0
+    assert fake_aws.uploads == {}
+    assert ("bucket", "failed.bin") not in fake_aws.bodies
+
+
+def test_uploads_are_aborted_when_writing_fails(fake_aws):
+    with pytest.raises(ValueError):
+        with open_s3_writer("s3://bucket/partial.bin", part_size=MIN_PART_SIZE) as f:
+            f.write(b"x" * MIN_PART_SIZE)
+            raise ValueError("The data could not be made")
+    assert fake_aws.calls["UploadPart"] == 1
+    assert fake_aws.calls["AbortMultipartUpload"] == 1
+    assert fake_aws.uploads == {}
+    assert ("bucket", "partial.bin") not in fake_aws.bodies
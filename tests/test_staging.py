@@ -0,0 +1,97 @@
+import os
+import threading
+from batch_helpers.aws import get_client
+from batch_helpers.staging import staged_s3_input, stage_s3_input
+
+
+def put(s3_path, body):
+    bucket, key = s3_path[5:].split("/", 1)
+    get_client("s3").put_object(Bucket=bucket, Key=key, Body=body)
+
+
+def test_downloads_once(fake_aws, tmp_path):
+    put("s3://bucket/ref/db.fasta", b">a\nACGT\n")
+
+    with staged_s3_input("s3://bucket/ref/db.fasta", cache_dir=str(tmp_path)) as local_path:
+        assert open(local_path, "rb").read() == b">a\nACGT\n"
+    assert stage_s3_input("s3://bucket/ref/db.fasta", cache_dir=str(tmp_path)) == local_path
+    assert fake_aws.calls["GetObject"] == 1
+
+
+def test_readers_share_the_entry(fake_aws, tmp_path):
+    put("s3://bucket/ref/db.fasta", b"ACGT")
+
+    # A second reader is not blocked while the first is using the file
+    finished = threading.Event()
+    with staged_s3_input("s3://bucket/ref/db.fasta", cache_dir=str(tmp_path)):
+        def read():
+            with staged_s3_input("s3://bucket/ref/db.fasta", cache_dir=str(tmp_path)):
+                finished.set()
+        t = threading.Thread(target=read)
+        t.start()
+        assert finished.wait(5)
+        t.join()
+
+
+def test_entries_in_use_are_not_evicted(fake_aws, tmp_path):
+    put("s3://bucket/ref/a.txt", b"a" * 100)
+    put("s3://bucket/ref/b.txt", b"b" * 100)
+
+    with staged_s3_input("s3://bucket/ref/a.txt", cache_dir=str(tmp_path)) as a_path:
+        # Staging b would evict a, but a is still in use
+        with staged_s3_input("s3://bucket/ref/b.txt", cache_dir=str(tmp_path), max_cache_bytes=150):
+            assert os.path.exists(a_path)
+
+    # Once a is no longer in use it is evicted first
+    with staged_s3_input("s3://bucket/ref/b.txt", cache_dir=str(tmp_path), max_cache_bytes=150) as b_path:
+        assert not os.path.exists(a_path)
+        assert os.path.exists(b_path)
+
+
+def test_large_objects_are_downloaded_in_parts(fake_aws, tmp_path):
+    body = bytes(range(256)) * 40
+    put("s3://bucket/ref/big.bin", body)
+
+    with staged_s3_input("s3://bucket/ref/big.bin", cache_dir=str(tmp_path), part_size=1000) as local_path:
+        assert open(local_path, "rb").read() == body
+    assert fake_aws.calls["GetObject"] == 11
+
+
+def test_objects_overwritten_during_download_are_fetched_again(fake_aws, tmp_path):
+    put("s3://bucket/ref/big.bin", b"a" * 3000)
+
+    # The object is replaced after the first part has been fetched
+    get_object = fake_aws.s3_GetObject
+
+    def overwrite_after_first_part(**kwargs):
+        r = get_object(**kwargs)
+        if fake_aws.calls["GetObject"] == 1:
+            fake_aws.bodies[("bucket", "ref/big.bin")] = b"b" * 3000
+        return r
+    fake_aws.s3_GetObject = overwrite_after_first_part
+
+    with staged_s3_input(
+        "s3://bucket/ref/big.bin", cache_dir=str(tmp_path), part_size=1000, n_threads=1
+    ) as local_path:
+        assert open(local_path, "rb").read() == b"b" * 3000
+
+    # Nothing is left of the old version
+    entries = os.listdir(str(tmp_path))
+    old = [e for e in entries if not os.path.exists(os.path.join(str(tmp_path), e, ".complete"))]
+    assert len(old) == 1
+    assert sorted(os.listdir(os.path.join(str(tmp_path), old[0]))) == [".download.lock", ".lock"]
+
+
+def test_evicted_entries_are_removed(fake_aws, tmp_path):
+    put("s3://bucket/ref/a.txt", b"a" * 100)
+    put("s3://bucket/ref/b.txt", b"b" * 100)
+
+    a_path = stage_s3_input("s3://bucket/ref/a.txt", cache_dir=str(tmp_path))
+    stage_s3_input("s3://bucket/ref/b.txt", cache_dir=str(tmp_path), max_cache_bytes=150)
+    assert not os.path.exists(os.path.dirname(a_path))
+    # Only the entry for b and the eviction lock are left
+    assert len(os.listdir(str(tmp_path))) == 2
+
+    # An evicted object is staged again when it is next used
+    assert stage_s3_input("s3://bucket/ref/a.txt", cache_dir=str(tmp_path)) == a_path
+    assert open(a_path, "rb").read() == b"a" * 100
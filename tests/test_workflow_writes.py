@@ -0,0 +1,49 @@
+import os
+import json
+import argparse
+from batch_project.lib import save_workflow_status, workflow_lock, write_workflow
+from batch_project.main import use_daemon
+
+
+def write(fp, config):
+    write_workflow(str(fp), config)
+    return os.stat(str(fp)).st_mtime_ns
+
+
+def test_status_is_saved_when_unchanged(tmp_path):
+    fp = tmp_path / "workflow.json"
+    loaded_mtime = write(fp, {"jobs": []})
+    assert save_workflow_status(str(fp), {"jobs": [], "status": "COMPLETED"}, loaded_mtime)
+    assert json.load(open(str(fp)))["status"] == "COMPLETED"
+
+
+def test_status_does_not_overwrite_new_jobs(tmp_path):
+    fp = tmp_path / "workflow.json"
+    loaded_mtime = write(fp, {"jobs": []})
+
+    # Another command adds a job after the status was read
+    os.utime(str(fp), ns=(loaded_mtime + 10 ** 9, loaded_mtime + 10 ** 9))
+    write_workflow(str(fp), {"jobs": [{"jobId": "new"}]})
+
+    assert not save_workflow_status(str(fp), {"jobs": []}, loaded_mtime)
+    assert json.load(open(str(fp)))["jobs"] == [{"jobId": "new"}]
+
+
+def test_status_is_not_saved_while_locked(tmp_path):
+    fp = tmp_path / "workflow.json"
+    loaded_mtime = write(fp, {"jobs": [{"jobId": "old"}]})
+
+    with workflow_lock(str(fp)):
+        assert not save_workflow_status(str(fp), {"jobs": []}, loaded_mtime)
+    assert json.load(open(str(fp)))["jobs"] == [{"jobId": "old"}]
+
+
+def test_options_for_checking_directly_skip_the_daemon():
+    args = argparse.Namespace(
+        no_daemon=False, s3_cache=None, s3_inventory=[], s3_events=None,
+        job_events=None, api_metrics=None
+    )
+    assert use_daemon(args)
+    assert not use_daemon(argparse.Namespace(**dict(vars(args), job_events="https://sqs/queue")))
+    assert not use_daemon(argparse.Namespace(**dict(vars(args), api_metrics="metrics.json")))
+    assert not use_daemon(argparse.Namespace(**dict(vars(args), no_daemon=True)))